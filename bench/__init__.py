@@ -0,0 +1 @@
+'''benchmarks for diagnose. Run one with `python -m bench.<name>` from the repository root'''
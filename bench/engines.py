@@ -0,0 +1,69 @@
+'''
+Benchmark the thread and asyncio engines on diagnostics with many devices.
+
+    python -m bench.engines [--diagnostics N] [--devices N] [--workers N] [--sleep S]
+'''
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+
+import diagnose as dg
+
+
+def fixtures(diagnostics, devices, sleep):
+    '''diagnostics that run a short command per device, failing on every 10th device. The
+    commands of each are different, so that none are shared through cmd_cache'''
+    return dg.OrderedDict(
+        ('diag{0}'.format(i), dg.Diagnose('sleep {0}; echo {1} {{device}}'.format(sleep, i),
+                                          devices=['dev{0}'.format(d) for d in range(devices)],
+                                          fail_pats=[r'dev\d*0$']))
+        for i in range(diagnostics))
+
+
+def measure(run):
+    '''(seconds, most threads alive at once, output) of calling run'''
+    peak, stop = [threading.active_count()], threading.Event()
+
+    def sample():
+        while not stop.wait(0.005):
+            peak[0] = max(peak[0], threading.active_count())
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    start = time.time()
+    try:
+        output = run()
+    finally:
+        stop.set()
+        sampler.join()
+    return time.time() - start, peak[0] - 1, output
+
+
+def run_threads(diagnostics):
+    return [t.join() for t in dg.start_parallel_diagnostics(diagnostics)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--diagnostics', type=int, default=10)
+    parser.add_argument('--devices', type=int, default=60)
+    parser.add_argument('--workers', type=int, default=16,
+                        help='device commands each diagnostic runs at once')
+    parser.add_argument('--sleep', type=float, default=0.05)
+    args = parser.parse_args()
+    dg.cmd_cache.ttl = 0
+    dg.Diagnose.device_workers = args.workers
+
+    diagnostics = fixtures(args.diagnostics, args.devices, args.sleep)
+    results = [('thread', measure(lambda: run_threads(diagnostics))),
+               ('asyncio', measure(lambda: dg.AsyncEngine().run(diagnostics)))]
+    assert repr(results[0][1][2]) == repr(results[1][1][2])
+    commands = args.diagnostics * args.devices
+    for name, (seconds, threads, _) in results:
+        print("{0:<8} {1:8.3f}s {2:8.0f} commands/s {3:5} threads".format(
+              name, seconds, commands / seconds, threads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+'''
+Benchmark the parsing hot paths on large synthetic outputs, failing if any is slower (or
+uses more memory) than the stored baseline by more than the threshold.
+
+    python -m bench.parsing [--scale S] [--threshold T] [--save]
+
+Throughput depends on the machine: store a baseline with --save on the machine that
+compares against it.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:  # python2
+    tracemalloc = None
+
+import diagnose as dg
+
+from .patterns import synthetic_dmesg, best_of
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'tests', 'examples')
+
+
+def synthetic_sensors(cores, seed=0):
+    '''sensors output of a box with `cores` cores, 32 to a package, none of them too hot'''
+    rand = random.Random(seed)
+    limits = '(high = +95.0\xb0C, crit = +105.0\xb0C)'
+    lines = ['acpitz-virtual-0', 'Adapter: Virtual device',
+             'temp1:        +27.8\xb0C  (crit = +105.0\xb0C)', '']
+    for package in range(0, cores, 32):
+        lines.extend(['coretemp-isa-{0:04d}'.format(package // 32), 'Adapter: ISA adapter',
+                      'Package id {0}:  +{1:.1f}\xb0C  {2}'.format(
+                          package // 32, rand.uniform(30, 80), limits)])
+        lines.extend('Core {0}:        +{1:.1f}\xb0C  {2}'.format(core, rand.uniform(30, 80), limits)
+                     for core in range(package, min(package + 32, cores)))
+        lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def synthetic_df(mounts, seed=0):
+    '''df output with `mounts` mounts, none of them full'''
+    rand = random.Random(seed)
+    lines = ['Filesystem     1K-blocks     Used Available Use% Mounted on']
+    for i in range(mounts):
+        size = rand.randint(1 << 10, 1 << 30)
+        used = int(size * rand.uniform(0, 0.9))
+        lines.append('/dev/mapper/vg{0}-lv{1} {2:>12} {3:>12} {4:>12} {5:>3}% /srv/volumes/{1}'
+                     .format(i // 100, i, size, used, size - used, used * 100 // size))
+    return '\n'.join(lines).encode()
+
+
+def synthetic_smart(drives):
+    '''the `smartctl -a` output of each of `drives` healthy drives'''
+    with open(os.path.join(EXAMPLES, 'smart.pass'), 'rb') as f:
+        output = f.read()
+    return [output.replace(b'151592400279', str(151592400279 + i).encode())
+            for i in range(drives)]
+
+
+def count_lines(outputs):
+    return sum(o.count(b'\n') + 1 for o in outputs)
+
+
+def cases(scale):
+    '''[(name, func, lines)] of everything that is benchmarked'''
+    dmesg = synthetic_dmesg(int(2000000 * scale))
+    sensors = synthetic_sensors(256)
+    df = synthetic_df(int(5000 * scale))
+    smart = synthetic_smart(100)
+    free = b'\n'.join([
+        b'              total        used        free      shared  buff/cache   available',
+        b'Mem:           7891        1512        5277         136        1102        6175',
+        b'Swap:          1906           0        1906'])
+    frees = int(20000 * scale)
+    loops = 20  # the sensors, df and smartctl outputs are parsed many times over
+    df_lines = dg.decode(df).split('\n')
+    sensor_lines = dg.decode(sensors).split('\n') * 20
+    infodict = {'temp': r'^[^:+\n]*:.*?([\d.]+)',
+                'high': r'\(.*high\s*=\s*\+?([\d.]+)',
+                'crit': r'\(.*crit\s*=\s*\+?([\d.]+)'}
+    diagnostics = dg.system_diagnostics
+    return [
+        ('dmesg', lambda: diagnostics['dmesg']._find_failures('dmesg', dmesg),
+         count_lines([dmesg])),
+        ('df', lambda: [diagnostics['df']._find_failures('df', df) for _ in range(loops)],
+         count_lines([df]) * loops),
+        ('smart', lambda: [diagnostics['smart']._find_failures('smartctl', s)
+                           for _ in range(loops) for s in smart],
+         count_lines(smart) * loops),
+        ('process_temperatures', lambda: [dg.process_temperatures(sensors)
+                                          for _ in range(loops)],
+         count_lines([sensors]) * loops),
+        ('process_free_mem', lambda: [dg.process_free_mem(free) for _ in range(frees)],
+         count_lines([free]) * frees),
+        ('get_table', lambda: dg.get_table(df_lines[0].split(), df_lines[1:]), len(df_lines)),
+        ('get_info', lambda: [dg.get_info(infodict, l) for l in sensor_lines],
+         len(sensor_lines)),
+    ]
+
+
+def peak_memory(func):
+    '''bytes allocated by python at the peak of calling func (None without tracemalloc)'''
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def regressions(results, baseline, threshold):
+    '''descriptions of the results worse than baseline by more than threshold'''
+    found = []
+    for name, (lines_per_s, peak) in sorted(results.items()):
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        if lines_per_s < base['lines_per_s'] * (1 - threshold):
+            found.append('{0}: {1:.0f} lines/s, baseline {2:.0f}'.format(
+                         name, lines_per_s, base['lines_per_s']))
+        if peak and base['peak_bytes'] and peak > base['peak_bytes'] * (1 + threshold):
+            found.append('{0}: peak {1} bytes, baseline {2}'.format(
+                         name, peak, base['peak_bytes']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the size of the dmesg, df and free inputs')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction slower (or more memory) than the baseline that fails')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    args = parser.parse_args()
+
+    results = {}
+    print("{0:<22} {1:>9} {2:>10} {3:>14} {4:>12}".format(
+          'case', 'lines', 'seconds', 'lines/s', 'peak bytes'))
+    for name, func, lines in cases(args.scale):
+        seconds = best_of(func, args.repeat)
+        peak = peak_memory(func)
+        results[name] = (lines / seconds, peak)
+        print("{0:<22} {1:>9} {2:>10.4f} {3:>14.0f} {4:>12}".format(
+              name, lines, seconds, lines / seconds, '-' if peak is None else peak))
+
+    if args.save:
+        dg.write_atomic(args.baseline, json.dumps({'scale': args.scale, 'cases': dict(
+            (name, {'lines_per_s': round(l, 1), 'peak_bytes': p})
+            for name, (l, p) in results.items())}, indent=2, sort_keys=True).encode() + b'\n')
+        return
+    if not os.path.exists(args.baseline):
+        return print('no baseline at {0}, store one with --save'.format(args.baseline))
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['scale'] != args.scale:
+        return print('the baseline was run with --scale {0}, not comparing'.format(
+                     baseline['scale']))
+    found = regressions(results, baseline, args.threshold)
+    for regression in found:
+        print('REGRESSION ' + regression)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
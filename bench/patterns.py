@@ -0,0 +1,63 @@
+'''
+Benchmark PatternSet against the match_pats path and against a single scan with
+one tagged alternation of all the patterns.
+
+    python -m bench.patterns [--lines N]
+'''
+from __future__ import print_function
+
+import re
+import time
+import random
+import argparse
+
+import diagnose as dg
+
+
+def synthetic_dmesg(lines, seed=0):
+    '''kernel ring buffer without any failures in it'''
+    rand = random.Random(seed)
+    msgs = [b'usb 1-1: new high-speed USB device number 2 using xhci_hcd',
+            b'EXT4-fs (sda1): mounted filesystem with ordered data mode. Opts: (null)',
+            b'e1000e 0000:00:19.0 eth0: NIC Link is Up 1000 Mbps Full Duplex',
+            b'audit: type=1130 audit(1448295625.771:87): pid=1 uid=0 auid=4294967295',
+            b'ata1.00: configured for UDMA/133',
+            b'nfs: server fileserver OK']
+    return b'\n'.join(b'[' + '{0:12.6f}'.format(i * 0.01).encode() + b'] ' + rand.choice(msgs)
+                      for i in range(lines))
+
+
+def alternation(pats):
+    '''all of pats as one regex with a tagged group per pattern'''
+    tagged = [b'(?P<_' + str(i).encode() + b'>' + p + b')' for i, p in enumerate(pats.raw)]
+    return re.compile(b'|'.join(tagged), pats.pats[0].flags)
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--lines', type=int, default=1000000)
+    args = parser.parse_args()
+
+    pats = dg.system_diagnostics['dmesg'].fail_pats
+    combined = alternation(pats)
+    text = synthetic_dmesg(args.lines)
+    assert pats.findall(text) == dg.match_pats(pats.pats, text) == []
+
+    results = [('match_pats', best_of(lambda: dg.match_pats(pats.pats, text))),
+               ('PatternSet', best_of(lambda: pats.findall(text))),
+               ('alternation', best_of(lambda: list(combined.finditer(text)), repeat=1))]
+    for name, seconds in results:
+        print("{0:<12} {1:8.3f}s {2:12.0f} lines/s".format(name, seconds, args.lines / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Benchmark starting the short diagnostics' commands through a shell (how they used to be
+run) against running their argv lists directly, in processes started and seconds per run.
+
+    python -m bench.spawn [--runs N] [--load N]
+
+Processes are counted from /proc/stat, so the machine should otherwise be quiet. --load
+keeps N busy processes running to measure fork latency under load.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import diagnose as dg
+
+# the commands the diagnostics ran before they were argv lists, with their pipelines
+SHELL_CMDS = ['systemctl --failed', 'ls -ld /', 'ip link', 'df', 'df -i',
+              'free -m | grep "total\\s*used\\|Mem:\\|Swap:"']
+ARGV_CMDS = [(['systemctl', '--failed'], None), (['ls', '-ld', '/'], None),
+             (['ip', 'link'], None), (['df'], None), (['df', '-i'], None),
+             (['free', '-m'], dg.grep_lines(r'total\s*used|Mem:|Swap:'))]
+
+
+def forks():
+    '''processes started on the machine since it booted'''
+    with open('/proc/stat') as f:
+        return next(int(l.split()[1]) for l in f if l.startswith('processes '))
+
+
+def shell_run():
+    for cmd in SHELL_CMDS:
+        subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         preexec_fn=os.setsid).communicate()
+
+
+def argv_run():
+    for cmd, pipe in ARGV_CMDS:
+        stdout = dg.call_cmd(cmd, raise_on_error=False)[0]
+        if pipe:
+            pipe(stdout)
+
+
+def measure(run, runs):
+    '''(processes, seconds) per run'''
+    start, started = forks(), time.time()
+    for _ in range(runs):
+        run()
+    return (forks() - start) / float(runs), (time.time() - started) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--load', type=int, default=0)
+    args = parser.parse_args()
+
+    load = [subprocess.Popen([sys.executable, '-c', 'while True: pass']) for _ in range(args.load)]
+    try:
+        results = [('shell', measure(shell_run, args.runs)),
+                   ('argv', measure(argv_run, args.runs))]
+    finally:
+        for p in load:
+            p.kill()
+            p.wait()
+    for name, (processes, seconds) in results:
+        print("{0:<6} {1:6.1f} processes/run {2:8.1f}ms/run".format(
+              name, processes, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Benchmark starting python and running a single check with main, the way cron jobs and
+health probes call it: as a script (`./diagnose`, compiling the whole source every
+run), importing the module (bin/diagnose, using its cached bytecode) and importing it
+while building every diagnostic up front.
+
+    python -m bench.startup [--runs N] [--check NAME] [--baseline-rev REV]
+
+With --baseline-rev, the script and import cases are also run with diagnose.py from that
+git revision, i.e. from before a series of changes. The cases take turns, so that whatever
+else the machine does slows all of them alike. Wall time and the cpu time of the processes
+are shown. The python running this is the one benchmarked, and bytecode is written even if
+PYTHONDONTWRITEBYTECODE is set.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import resource
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = '''
+import sys, diagnose
+sys.argv[1:] = ['-s', {check!r}]
+diagnose.main()
+'''
+EAGER = '''
+import sys, diagnose, multiprocessing
+diagnose.import_asyncio()
+diagnose.system_diagnostics.values(), diagnose.long_system_diagnostics.values()
+sys.argv[1:] = ['-s', {check!r}]
+diagnose.main()
+'''
+
+
+ENV = dict(os.environ)
+ENV.pop('PYTHONDONTWRITEBYTECODE', None)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def spawn_seconds(cmd, cwd):
+    '''(wall, cpu) seconds of a process running cmd (whatever it exits with, a check may
+    fail on this machine)'''
+    with open(os.devnull, 'w') as devnull:
+        start, cpu = time.time(), cpu_seconds()
+        subprocess.call(cmd, cwd=cwd, stdout=devnull, stderr=devnull, env=ENV)
+        return time.time() - start, cpu_seconds() - cpu
+
+
+def cases(directory, check, eager=True):
+    '''[(name, cmd)] of running check with the diagnose.py in directory'''
+    found = [('script', [sys.executable, os.path.join(directory, 'diagnose.py'), '-s', check]),
+             ('import', [sys.executable, '-c', IMPORT.format(check=check)])]
+    if eager:
+        found.append(('eager', [sys.executable, '-c', EAGER.format(check=check)]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--check', default='readonly')
+    parser.add_argument('--baseline-rev', metavar='REV',
+                        help='also time diagnose.py as of this git revision')
+    args = parser.parse_args()
+
+    runs = [('', ROOT, cases(ROOT, args.check))]
+    tmp = None
+    if args.baseline_rev:
+        tmp = tempfile.mkdtemp()
+        with open(os.path.join(tmp, 'diagnose.py'), 'wb') as f:
+            f.write(subprocess.check_output(
+                ['git', 'show', args.baseline_rev + ':diagnose.py'], cwd=ROOT))
+        runs.append((args.baseline_rev + ' ', tmp, cases(tmp, args.check, eager=False)))
+    try:
+        for _, directory, _ in runs:
+            # compile the .pyc that importing uses
+            subprocess.check_call([sys.executable, '-c', 'import diagnose'], cwd=directory,
+                                  env=ENV)
+        timed = [(prefix + name, cmd, directory, [])
+                 for prefix, directory, found in runs for name, cmd in found]
+        for _ in range(args.runs):
+            for _, cmd, directory, times in timed:
+                times.append(spawn_seconds(cmd, directory))
+        for name, _, _, times in timed:
+            wall, cpu = sorted(t[0] for t in times), sorted(t[1] for t in times)
+            print("{0:<20} best {1:6.1f}ms  median {2:6.1f}ms  median cpu {3:6.1f}ms".format(
+                  name, wall[0] * 1000, wall[len(wall) // 2] * 1000, cpu[len(cpu) // 2] * 1000))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,11 @@ the health of that computer, such as:
     curl -L https://raw.githubusercontent.com/vitiral/diagnose/master/diagnose.py > diagnose
     sudo ./diagnose
 
+It can also be run from another python program, yielding results as they finish:
+
+    for result in diagnose.run(['memory', 'df']):
+        print(result.name, result.status, result.metrics)
+
 It is written using a simple and easy to understand approach that is also easy to
 test and extend. If you have new features or find any bugs, please visit:
     https://github.com/vitiral/diagnose
@@ -20,14 +25,30 @@ test and extend. If you have new features or find any bugs, please visit:
 
 from __future__ import print_function
 
+import os
 import sys
 import time
+import signal
 import re
+import math
+import errno
+import functools
+import contextlib
+import collections
+from array import array
 import argparse
 import subprocess
 import threading
 import logging
 
+# json, runpy and shlex are slow to import and most runs do not need them, so they are
+# imported where they are used
+
+try:
+    import resource
+except ImportError:  # not unix
+    resource = None
+
 try:
     from collections import OrderedDict
 except ImportError:
@@ -48,19 +69,177 @@ except ImportError:
                 raise KeyError(key)
 
 
-def call_cmd(cmd, raise_on_error=True):
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    rc = p.returncode
+# without a preexec_fn, python 3 can start processes with vfork or posix_spawn
+_new_session = ({'start_new_session': True} if sys.version_info[0] >= 3 else
+                {'preexec_fn': getattr(os, 'setsid', None)})
+
+
+def is_argv(cmd):
+    '''whether cmd is a list of arguments, run without a shell'''
+    return isinstance(cmd, (list, tuple))
+
+
+def quote(arg):
+    '''shlex.quote'''
+    try:
+        from shlex import quote as _quote
+    except ImportError:  # python2
+        from pipes import quote as _quote
+    return _quote(arg)
+
+
+def cmdline(cmd):
+    '''cmd the way a shell would run it'''
+    return ' '.join(quote(a) for a in cmd) if is_argv(cmd) else cmd
+
+
+def format_cmd(cmd, **kwargs):
+    '''cmd.format(**kwargs), formatting each argument of an argv command'''
+    return tuple(a.format(**kwargs) for a in cmd) if is_argv(cmd) else cmd.format(**kwargs)
+
+
+def popen(cmd, cancellable=True):
+    '''start cmd in its own process group so that it can be killed with all of its children.
+    Shell strings are run by /bin/sh, argv lists directly. The caller must discard it from
+    `running` once it has exited. Unless cancellable, cancel_run does not kill it.
+    '''
+    p = subprocess.Popen(cmd, shell=not is_argv(cmd), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, **_new_session)
+    if cancellable:
+        running.add(p.pid)
+    return p
+
+
+def kill_pgid(pid):
+    '''kill the process group of the command started as pid (with popen, or by
+    AsyncEngine), i.e. the command and everything it started'''
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except OSError:  # already exited
+        pass
+
+
+def process_rss(pid):
+    '''the peak resident memory in bytes of pid, or of one of the processes it started that
+    are running, 0 once it has exited (or without /proc)'''
+    peak, pids = 0, [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open('/proc/{0}/status'.format(pid), 'rb') as f:
+                status = f.read()
+            with open('/proc/{0}/task/{0}/children'.format(pid), 'rb') as f:
+                pids.extend(int(p) for p in f.read().split())
+        except (IOError, OSError, ValueError):  # it exited
+            continue
+        hwm = re.search(br'^VmHWM:\s*(\d+) kB', status, re.M)
+        if hwm:
+            peak = max(peak, int(hwm.group(1)) * 1024)
+    return peak
+
+
+def sample_rss(process):
+    '''keep the peak resident memory of a running process as process.max_rss. It has to be
+    read while the process runs: the ru_maxrss of a child that was forked also counts the
+    memory of the process that forked it, i.e. this one
+    '''
+    process.max_rss = max(getattr(process, 'max_rss', 0), process_rss(process.pid))
+
+
+def poll(process, rusage=False, block=False):
+    '''process.poll(), or process.wait() if block. With rusage the process is reaped with
+    wait4 so that its resource usage is kept as process.rusage, and its memory is sampled
+    (see sample_rss) each time it is polled
+    '''
+    if not rusage or process.returncode is not None or not hasattr(os, 'wait4'):
+        return process.wait() if block else process.poll()
+    sample_rss(process)
+    try:
+        pid, status, usage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    except OSError:  # reaped by process.poll() in another thread
+        return process.wait() if block else process.poll()
+    if pid:
+        process.rusage = usage
+        process.returncode = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                              else os.WEXITSTATUS(status))
+    return process.returncode
+
+
+def communicate(process, rusage=False):
+    '''process.communicate(), keeping the resource usage of the process with rusage. Its
+    memory is sampled every RSS_INTERVAL seconds until it closes its output'''
+    if not rusage:
+        return process.communicate()
+    stdout, stderr = Thread.spawn(process.stdout.read), Thread.spawn(process.stderr.read)
+    while stdout.is_alive() or stderr.is_alive():
+        sample_rss(process)
+        stdout.join(RSS_INTERVAL)
+    stdout, stderr = stdout.join(), stderr.join()
+    process.stdout.close()
+    process.stderr.close()
+    poll(process, rusage, block=True)
+    return stdout, stderr
+
+
+def call_cmd(cmd, raise_on_error=True, timeout=None, respect_deadline=True):
+    '''call cmd, killing it and raising CommandTimeout if it runs past timeout or the deadline.
+    Without respect_deadline only the timeout applies, and cancel_run does not kill it (for
+    commands that restore the system, i.e. a teardown)
+    '''
+    if respect_deadline:
+        timeout = deadline.timeout(timeout)
+        if timeout is not None and timeout <= 0:
+            raise deadline.exception(cmd)
+    exception = deadline.exception if respect_deadline else CommandTimeout
+    profile = profiler.current()
+    try:
+        p = popen(cmd, cancellable=respect_deadline)
+    except OSError as e:  # an argv command that could not be run, which a shell exits 127 for
+        return check_rc(cmd, (b'', str(e).encode(), 127), raise_on_error)
+    if profile:
+        profile.add(subprocesses=1)
+    try:
+        if timeout is None:
+            stdout, stderr = communicate(p, rusage=bool(profile))
+        else:
+            reader = Thread.spawn(communicate, p, rusage=bool(profile))
+            reader.join(timeout)
+            if reader.is_alive():
+                kill_pgid(p.pid)
+                # a process stuck in uninterruptible IO (i.e. a hung NFS mount) can outlive
+                # SIGKILL, in which case the reader is abandoned
+                reader.join(KILL_GRACE)
+                raise exception(cmd, timeout)
+            stdout, stderr = reader.join()
+    finally:
+        running.discard(p.pid)
+    if respect_deadline and deadline.cancelled:  # killed by cancel_run, whatever it printed
+        raise CommandCancelled(cmd)
+    if profile:
+        profile.add_output(len(stdout), len(stderr), getattr(p, 'rusage', None),
+                           getattr(p, 'max_rss', 0))
+    return check_rc(cmd, (stdout, stderr, p.returncode), raise_on_error)
+
+
+def check_rc(cmd, result, raise_on_error=True):
+    stdout, stderr, rc = result
     if rc and raise_on_error:
         raise RuntimeError("Command [{0}] got rc {1}: stdout={2}\nstderr={3}".format(
-                           cmd, rc, stdout, stderr))
-    return stdout, stderr, rc
+                           cmdline(cmd), rc, stdout, stderr))
+    return result
 
 __version__ = '0.0.1'
 
-logging.basicConfig(level=logging.DEBUG)
+# seconds to wait for a killed command to exit before giving up on it
+KILL_GRACE = 1.0
+# seconds between samples of the memory of a profiled command
+RSS_INTERVAL = 0.01
+
 _log = logging.getLogger('diagnose')
+_log.addHandler(logging.NullHandler())  # logging is configured by main, or the embedding program
 
 
 ##################################################
@@ -68,13 +247,18 @@ _log = logging.getLogger('diagnose')
 
 def get_keys(dict, *keys):
     keys = set(keys)
-    return OrderedDict((k, v) for (k, v) in dict.items() if k in keys)
+    return OrderedDict((k, dict[k]) for k in dict if k in keys)
 
 
 def decode(data):
     return data.decode('utf-8')
 
 
+def to_text(value):
+    '''value as text, replacing bytes that are not utf-8'''
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+
 def match_pats(pats, text):
     matches = (pat.search(text) for pat in pats)
     return [m.groups() for m in matches if m is not None]
@@ -100,11 +284,139 @@ def get_info(infodict, line):
     return out
 
 
+def memoize(func):
+    '''cache the result of a function without arguments. func.reset() forgets it'''
+    cache = []
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper():
+        with lock:
+            if not cache:
+                cache.append(func())
+            return cache[0]
+    wrapper.reset = lambda: cache.__delitem__(slice(None))
+    return wrapper
+
+
+@memoize
+def path_index():
+    '''{name: [directories on PATH containing it]}, only listing each directory once'''
+    index = {}
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        try:
+            names = os.listdir(directory or '.')
+        except OSError:
+            continue
+        for name in names:
+            index.setdefault(name, []).append(directory)
+    return index
+
+
+def which(name):
+    '''the path to an executable, found the same way as `which`, or None'''
+    for directory in path_index().get(name, ()):
+        path = os.path.join(directory, name)
+        if os.access(path, os.X_OK) and not os.path.isdir(path):
+            return path
+    return None
+
+
+@memoize
+def import_asyncio():
+    '''the asyncio module (None on python 2), only imported when needed as it is slow to
+    import'''
+    try:
+        import asyncio
+    except ImportError:  # python2
+        return None
+    return asyncio
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def is_private(path):
+    '''whether path is owned by this user (or root) and nobody else can write to it (a
+    symlink never is)'''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return st.st_uid in (0, os.geteuid()) and not st.st_mode & 0o022
+
+
+def read_private(path):
+    '''read_file, refusing a file that someone else could have written, i.e. one planted
+    in a shared directory like /var/tmp'''
+    if not is_private(path):
+        if os.path.lexists(path):
+            _log.warning("ignoring {0}: not owned by this user or writable by others".format(path))
+        raise IOError(errno.EACCES, 'not private', path)
+    return read_file(path)
+
+
+def make_dirs(path, mode=0o755):
+    '''os.makedirs, fine with path existing (i.e. made by a run at the same time)'''
+    try:
+        os.makedirs(path, mode)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+_seek_lock = threading.Lock()
+
+
+def pread(fd, size, offset=0):
+    '''os.pread (read without moving the file position, safe from any thread)'''
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with _seek_lock:  # python2
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def read_chunk(stream, size=1 << 16):
+    '''read whatever is available from a pipe, up to size bytes ('' at the end)'''
+    if hasattr(stream, 'read1'):
+        return stream.read1(size)
+    return os.read(stream.fileno(), size)
+
+
+def write_atomic(path, data, mode=0o644):
+    '''write data to path so that other processes never see a partially written file.
+    It is readable by everyone unless mode says otherwise (i.e. by node_exporter)'''
+    # like tempfile.mkstemp (which is slow to import): O_EXCL never opens a file or link
+    # that someone else put there
+    tmp = os.path.join(os.path.dirname(os.path.abspath(path)), '.{0}.{1}.{2}'.format(
+                       os.path.basename(path), os.getpid(), threading.current_thread().ident))
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), mode)  # umask does not apply
+            f.write(data)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
 def get_table(header, lines, separator=None):
     return [dict((k, convert_value(v)) for (k, v) in zip(header, l.split(separator)))
             for l in lines if l]
 
 
+def reraise(exc_info):
+    '''raise an exception gotten from sys.exc_info() in another thread'''
+    if sys.version_info[0] == 3:
+        raise exc_info[1]
+    else:
+        exec('raise exc_info[0], exc_info[1], exc_info[2]')
+
+
 ##################################################
 # Classes
 
@@ -128,10 +440,7 @@ class Thread(threading.Thread):
     def join(self, *args, **kwargs):
         super(Thread, self).join(*args, **kwargs)
         if self.exc_info:
-            if sys.version_info[0] == 3:
-                raise self.exc_info[0]
-            else:
-                exec('e=self.exc_info; raise e[0], e[1], e[2]')
+            reraise(self.exc_info)
         return self.output
 
     @classmethod
@@ -142,6 +451,658 @@ class Thread(threading.Thread):
         return t
 
 
+class CommandTimeout(RuntimeError):
+    '''Raised when a command is killed for running past its timeout'''
+    def __init__(self, cmd, timeout):
+        super(CommandTimeout, self).__init__(
+            "Command [{0}] timed out after {1:.1f}s".format(cmdline(cmd), timeout))
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def failure(self):
+        return Timeout(self.cmd, self.timeout)
+
+
+class CommandCancelled(CommandTimeout):
+    '''Raised when a command is killed, or not started, because the run was cancelled'''
+    def __init__(self, cmd):
+        RuntimeError.__init__(self, "Command [{0}] was cancelled".format(cmdline(cmd)))
+        self.cmd = cmd
+        self.timeout = 0
+
+    def failure(self):
+        return Cancelled(self.cmd)
+
+
+class Deadline(object):
+    '''A time limit for the whole run that every command's timeout is bounded by.
+    Cancelling it ends the run now.
+    '''
+    def __init__(self, seconds=None):
+        self._cancel = threading.Event()
+        self.start(seconds)
+
+    def start(self, seconds):
+        self.cancelled = False
+        self._cancel.clear()
+        self.end = None if seconds is None else time.time() + seconds
+
+    def cancel(self):
+        self.cancelled = True
+        self.end = time.time()
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        '''sleep for timeout seconds, waking up as soon as the run is cancelled or runs out
+        of time. Returns whether it has'''
+        self._cancel.wait(self.timeout(timeout))
+        return self.cancelled or self.expired
+
+    def exception(self, cmd, timeout=0):
+        '''the exception for cmd running out of time'''
+        return CommandCancelled(cmd) if self.cancelled else CommandTimeout(cmd, timeout)
+
+    def remaining(self):
+        return None if self.end is None else max(self.end - time.time(), 0)
+
+    def timeout(self, timeout=None):
+        '''return timeout limited by the time remaining (None means no limit)'''
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    @property
+    def expired(self):
+        return self.remaining() == 0
+
+
+class ProcessGroups(object):
+    '''The process groups of the commands that are running, so that they can all be killed
+    when the run is cancelled. One started after that is killed as soon as it is added.
+    '''
+    def __init__(self):
+        self._pids = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pids)
+
+    def add(self, pid):
+        with self._lock:
+            self._pids.add(pid)
+        if deadline.cancelled:
+            kill_pgid(pid)
+
+    def discard(self, pid):
+        with self._lock:
+            self._pids.discard(pid)
+
+    def kill_all(self):
+        with self._lock:
+            pids = list(self._pids)
+        for pid in pids:
+            kill_pgid(pid)
+
+
+class Profile(object):
+    '''What a diagnostic spent: seconds in each phase, the subprocesses it started, what
+    they wrote and their CPU time and peak memory (of the largest one)
+    '''
+    # (attribute, prometheus metric, help) of everything that is measured
+    metrics = (
+        ('wall', 'diagnose_wall_seconds', 'Seconds the diagnostic took to run'),
+        ('skip', 'diagnose_skip_seconds', 'Seconds spent checking whether to skip it'),
+        ('commands', 'diagnose_commands_seconds',
+         'Seconds spent getting its commands (i.e. listing devices)'),
+        ('parse', 'diagnose_parse_seconds', 'Seconds spent searching output for failures'),
+        ('subprocesses', 'diagnose_subprocesses', 'Subprocesses it started'),
+        ('stdout_bytes', 'diagnose_stdout_bytes', 'Bytes read from the stdout of subprocesses'),
+        ('stderr_bytes', 'diagnose_stderr_bytes', 'Bytes read from the stderr of subprocesses'),
+        ('cpu_user', 'diagnose_cpu_user_seconds', 'User CPU seconds of its subprocesses'),
+        ('cpu_system', 'diagnose_cpu_system_seconds', 'System CPU seconds of its subprocesses'),
+        ('max_rss', 'diagnose_max_rss_bytes', 'Peak resident memory of its largest subprocess'),
+    )
+    def __init__(self):
+        for attr, _, _ in self.metrics:
+            setattr(self, attr, 0)
+        self._lock = threading.Lock()
+
+    def add(self, **values):
+        with self._lock:
+            for attr, value in values.items():
+                setattr(self, attr, getattr(self, attr) + value)
+
+    def add_output(self, stdout_bytes, stderr_bytes, rusage=None, max_rss=0):
+        '''add what a subprocess wrote, its CPU time if it is known and its peak memory in
+        bytes (see sample_rss)'''
+        self.add(stdout_bytes=stdout_bytes, stderr_bytes=stderr_bytes)
+        if rusage is not None:
+            self.add(cpu_user=rusage.ru_utime, cpu_system=rusage.ru_stime)
+        with self._lock:
+            self.max_rss = max(self.max_rss, max_rss)
+
+
+class Profiler(object):
+    '''The Profile of each diagnostic, recorded only while enabled.
+
+    The profile of the diagnostic being run is kept for its thread, so that call_cmd can
+    add the subprocesses it starts to it.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.profiles = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def profile(self, diagnose):
+        with self._lock:
+            return self.profiles.setdefault(diagnose, Profile())
+
+    def current(self):
+        '''the profile of the diagnostic running in this thread, None if not profiling'''
+        return getattr(self._local, 'profile', None) if self.enabled else None
+
+    @contextlib.contextmanager
+    def timing(self, diagnose, phase=None):
+        '''make diagnose's profile the current one in the block, adding the seconds it
+        takes to phase
+        '''
+        profile, outer = self.profile(diagnose), self.current()
+        self._local.profile = profile
+        start = time.time()
+        try:
+            yield profile
+        finally:
+            self._local.profile = outer
+            if phase:
+                profile.add(**{phase: time.time() - start})
+
+    def table(self, diagnostics):
+        '''the profiles of {name: Diagnose} formatted as a table'''
+        row = '{0:<12} {1:>8} {2:>7} {3:>7} {4:>7} {5:>5} {6:>9} {7:>8} {8:>7} {9:>7} {10:>8}'
+        lines = [row.format('name', 'wall(s)', 'skip', 'cmds', 'parse', 'procs', 'stdout(B)',
+                            'stderr', 'user', 'sys', 'rss(MiB)')]
+        for name, diagnose in diagnostics.items():
+            p = self.profiles.get(diagnose)
+            if p is None:
+                continue
+            lines.append(row.format(
+                name, '{0:.3f}'.format(p.wall), '{0:.3f}'.format(p.skip),
+                '{0:.3f}'.format(p.commands), '{0:.3f}'.format(p.parse), p.subprocesses,
+                p.stdout_bytes, p.stderr_bytes, '{0:.2f}'.format(p.cpu_user),
+                '{0:.2f}'.format(p.cpu_system), '{0:.1f}'.format(p.max_rss / float(1 << 20))))
+        return lines
+
+    def records(self, diagnostics):
+        '''the profiles of {name: Diagnose} as dicts, i.e. for JSON'''
+        return [dict([('name', name)] + [(attr, getattr(self.profiles[d], attr))
+                                         for attr, _, _ in Profile.metrics])
+                for name, d in diagnostics.items() if d in self.profiles]
+
+    def prometheus(self, diagnostics):
+        '''the profiles of {name: Diagnose} in the prometheus text format, i.e. for the
+        node exporter's textfile collector
+        '''
+        profiles = [(name, self.profiles[d]) for (name, d) in diagnostics.items()
+                    if d in self.profiles]
+        lines = []
+        for attr, metric, doc in Profile.metrics:
+            lines.append('# HELP {0} {1}'.format(metric, doc))
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for name, p in profiles:
+                lines.append('{0}{{diagnostic="{1}"}} {2}'.format(metric, name, getattr(p, attr)))
+        return '\n'.join(lines) + '\n'
+
+
+def profiled(phase=None):
+    '''decorate a Diagnose method to profile it (see Profiler.timing)'''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not profiler.enabled:
+                return method(self, *args, **kwargs)
+            with profiler.timing(self, phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PatternSet(object):
+    '''A diagnostic's regular expressions, compiled once and searched together.
+
+    Each pattern is searched separately: the regex engine jumps straight to a pattern's
+    literal prefix, which is far faster than scanning once with an alternation of them
+    (see bench/patterns.py). Iterates over the compiled patterns like a list of them.
+    '''
+    def __init__(self, pats, flags=0):
+        self.raw = list(pats)
+        self.pats = [re.compile(p, flags) for p in self.raw]
+
+    def __iter__(self):
+        return iter(self.pats)
+
+    def __len__(self):
+        return len(self.pats)
+
+    def search(self, text):
+        '''return True if any pattern matches text, stopping at the first that does'''
+        return any(pat.search(text) is not None for pat in self.pats)
+
+    def findall(self, text):
+        '''return the groups of the first match of each pattern that matches text'''
+        return match_pats(self.pats, text)
+
+
+class State(object):
+    '''A small JSON file that diagnostics keep information in between runs.
+
+    Nothing is kept until a path is loaded.
+    '''
+    quiet = False  # whether failing to save is not logged
+
+    def __init__(self):
+        self.path = None
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        self.path = path
+        try:
+            self.data = self.loads(decode(read_private(path)))
+        except (IOError, OSError, ValueError):
+            self.data = {}
+
+    @staticmethod
+    def loads(text):
+        import json  # only once there is something to load
+        return json.loads(text)
+
+    @staticmethod
+    def dumps(data):
+        import json
+        return json.dumps(data, indent=1, sort_keys=True)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            data = self.dumps(self.data)
+        try:
+            make_dirs(os.path.dirname(os.path.abspath(self.path)))
+            write_atomic(self.path, data.encode())
+        except (IOError, OSError) as e:  # i.e. not root, the results were still reported
+            if not self.quiet:
+                _log.warning("saving {0} failed: {1}".format(self.path, e))
+
+
+class StreamScanner(object):
+    '''Searches a stream for patterns as it is written.
+
+    If a stream is given, it is read in a thread, otherwise chunks are given to feed().
+    Each chunk is searched along with the last `overlap` bytes before it, so that
+    matches spanning chunks are found. Only the first and last `keep` bytes of the
+    stream are kept in `output`, so memory does not grow with the stream's size.
+    on_match is called as soon as a pattern first matches.
+    '''
+    keep = 1 << 20
+    overlap = 1 << 16
+
+    def __init__(self, stream=None, pats=None, on_match=None):
+        self.stream = stream
+        self.pats = pats
+        self.on_match = on_match
+        self.matches = {}  # {index of pattern: groups of its first match}
+        self.size = 0
+        self._head = b''
+        self._tail = b''
+        self._window = b''
+        self._thread = Thread.spawn(self._read) if stream is not None else None
+
+    def _read(self):
+        while True:
+            chunk = read_chunk(self.stream)
+            if not chunk:
+                return
+            self.feed(chunk)
+
+    def feed(self, chunk):
+        self._store(chunk)
+        if self.pats:
+            window = self._window[-self.overlap:]
+            self._window = window[window.find(b'\n') + 1:] + chunk  # start at a line
+            self._search(self._window)
+
+    def _store(self, chunk):
+        self.size += len(chunk)
+        if len(self._head) < self.keep:
+            split = self.keep - len(self._head)
+            self._head, chunk = self._head + chunk[:split], chunk[split:]
+        if chunk:
+            self._tail = (self._tail + chunk)[-self.keep:]
+
+    def _search(self, window):
+        found = False
+        for i, pat in enumerate(self.pats):
+            if i not in self.matches:
+                m = pat.search(window)
+                if m is not None:
+                    self.matches[i] = m.groups()
+                    found = True
+        if found and self.on_match:
+            self.on_match()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
+        return self
+
+    @property
+    def output(self):
+        if self.size > len(self._head) + len(self._tail):
+            return self._head + b'\n[...]\n' + self._tail
+        return self._head + self._tail
+
+    def findall(self):
+        '''the same as match_pats on the whole stream (for matches within overlap)'''
+        return [self.matches[i] for i in sorted(self.matches)]
+
+
+class CommandCache(object):
+    '''Shares the result of a command between everything that calls it within `ttl` seconds.
+
+    Callers of a command that is already running wait for it to finish instead of
+    running it again, even if ttl is 0.
+    '''
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._results = {}  # {cmd: (time finished, (stdout, stderr, rc))}
+        self._running = {}  # {cmd: Task}
+
+    def call(self, cmd, raise_on_error=True, timeout=None):
+        '''the same as call_cmd, but shared with other callers of cmd'''
+        with self._lock:
+            now = time.time()
+            cached = self._results.get(cmd)
+            if cached and now - cached[0] < self.ttl:
+                return check_rc(cmd, cached[1], raise_on_error)
+            task = self._running.get(cmd)
+            leader = task is None
+            if leader:
+                task = self._running[cmd] = Task(call_cmd, (cmd, False, timeout))
+        if leader:
+            task.run()
+            with self._lock:
+                del self._running[cmd]
+                now = time.time()
+                self._results = dict((c, r) for (c, r) in self._results.items()
+                                     if now - r[0] < self.ttl)
+                if self.ttl and task.exc_info is None:
+                    self._results[cmd] = (now, task.output)
+        return check_rc(cmd, task.join(), raise_on_error)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+class ResultCache(object):
+    '''Keeps the output of slow device commands on disk between runs, one file for each
+    diagnostic and device, reused while it is less than `max_age` seconds old.
+
+    Only the output of commands that succeeded is kept, as a failure or timeout could be
+    transient. Nothing is kept until max_age is set. Entries are written atomically, so runs
+    at the same time (i.e. from cron) never read a partly written one. A directory that
+    someone else could write to is never used, as they could plant results in it.
+    '''
+    def __init__(self, path='/var/cache/diagnose', max_age=None):
+        self.path = path
+        self.max_age = max_age
+
+    @property
+    def enabled(self):
+        return self.max_age is not None
+
+    def _entry(self, name, identity):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', name) + '@' +
+                            re.sub(r'[^\w.-]', '_', identity))
+
+    def get(self, name, identity):
+        '''the output kept for the device with identity, None if it is missing or stale'''
+        if identity is None or not is_private(self.path):
+            return None
+        path = self._entry(name, identity)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.max_age:
+                return read_private(path)
+        except (IOError, OSError):
+            pass
+        return None
+
+    def set(self, name, identity, output):
+        if identity is None:
+            return
+        try:
+            make_dirs(self.path, 0o700)
+            if not is_private(self.path):
+                raise IOError(errno.EACCES, 'not owned by this user or writable by others',
+                              self.path)
+            write_atomic(self._entry(name, identity), output, mode=0o600)
+        except (IOError, OSError) as e:
+            _log.debug("caching the output of {0} failed: {1}".format(name, e))
+
+
+class DurationStats(State):
+    '''How long each diagnostic has taken on this host, kept in a small file between runs,
+    so that the longest can be started first when there are few workers (see order).
+
+    Durations are exponentially weighted averages. Diagnostics that have not run yet are
+    estimated from what they do: little for collectors, more for a command per device.
+    Nothing is kept on disk until a path is loaded and a duration recorded. Not being able
+    to keep them (i.e. when not root) only makes the order less good, so it is not warned about.
+    '''
+    weight = 0.3  # of the newest duration in the average
+    quiet = True
+
+    def __init__(self):
+        super(DurationStats, self).__init__()  # data is {host: {name: seconds}}
+        self.host = os.uname()[1] if hasattr(os, 'uname') else 'localhost'
+        self.recorded = False
+
+    @staticmethod
+    def prior(diagnose):
+        '''the estimate for a diagnostic that has never run'''
+        if isinstance(diagnose, DiagnoseLong):
+            return 600.0
+        if diagnose.collect and diagnose.collect.available():
+            return 0.01
+        return 5.0 if diagnose.devices else 0.5
+
+    def estimate(self, name, diagnose):
+        with self._lock:
+            seconds = self.data.get(self.host, {}).get(name)
+        return self.prior(diagnose) if seconds is None else seconds
+
+    @staticmethod
+    def loads(text):
+        '''a line of "host name seconds" for each diagnostic: this is read and written by
+        every run, even of a single check, and json is slow to import. Names can have spaces
+        (host names do not), lines that cannot be read are left out'''
+        data = {}
+        for line in text.split('\n'):
+            try:
+                rest, seconds = line.rsplit(' ', 1)
+                host, name = rest.split(' ', 1)
+                data.setdefault(host, {})[name] = float(seconds)
+            except ValueError:
+                continue
+        return data
+
+    @staticmethod
+    def dumps(data):
+        return ''.join('{0} {1} {2!r}\n'.format(host, name, seconds)
+                       for host in sorted(data) for name, seconds in sorted(data[host].items())
+                       if '\n' not in name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            host = self.data.setdefault(self.host, {})
+            last = host.get(name)
+            host[name] = seconds if last is None else last + self.weight * (seconds - last)
+            self.recorded = True
+
+    def recorder(self, on_result=None):
+        '''an on_result that records the duration of each result (that was not cancelled)
+        and passes it on to on_result'''
+        def record(name, diagnose, failed, started, duration):
+            if get_status(failed) != 'CANCELLED':
+                self.record(name, duration)
+            if on_result:
+                on_result(name, diagnose, failed, started, duration)
+        return record
+
+    def save(self):
+        if self.recorded:  # something ran
+            super(DurationStats, self).save()
+
+    def order(self, diagnostics):
+        '''the names of {name: diagnose}, longest expected first'''
+        return sorted(diagnostics, key=lambda n: -self.estimate(n, diagnostics[n]))
+
+    def makespan(self, diagnostics, workers=None):
+        '''the seconds expected to run {name: diagnose} on `workers` threads, started
+        longest first'''
+        estimates = [self.estimate(n, diagnostics[n]) for n in self.order(diagnostics)]
+        if workers is None or workers >= len(estimates):
+            return max(estimates) if estimates else 0.0
+        loads = [0.0] * workers
+        for seconds in estimates:
+            loads[loads.index(min(loads))] += seconds
+        return max(loads)
+
+
+class TimerWheel(object):
+    '''Hashed timer wheel: items wait in one of `size` slots of `tick` seconds each, so
+    scheduling an item and finding the items that are due costs the same however many
+    items are waiting and however far in the future they are due.
+    '''
+    def __init__(self, tick=1.0, size=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.now = 0  # ticks since the wheel started
+
+    def schedule(self, delay, item):
+        '''schedule item to be due after delay seconds (at least one tick)'''
+        due = self.now + max(1, int(math.ceil(delay / self.tick)))
+        self.slots[due % len(self.slots)].append((due, item))
+
+    def advance(self):
+        '''move forward one tick, returning the items that are now due'''
+        self.now += 1
+        slot = self.slots[self.now % len(self.slots)]
+        due = [item for (t, item) in slot if t <= self.now]
+        slot[:] = [(t, item) for (t, item) in slot if t > self.now]
+        return due
+
+
+class Task(object):
+    '''A function scheduled on a Scheduler. join() works like Thread.join()'''
+    def __init__(self, target, args=(), kwargs=None):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.output = None
+        self.exc_info = None
+        self.started = self.finished = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.output = self.target(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.finished = time.time()
+            with self._lock:
+                callbacks, self._callbacks = self._callbacks, None
+            for callback in callbacks:  # join only returns once they have run
+                try:
+                    callback(self)
+                except Exception:  # i.e. a closed stdout, which must not stop the worker
+                    _log.exception("done callback of {0} raised".format(self.target))
+            self._done.set()
+
+    def add_done_callback(self, callback):
+        '''call callback(task) in the thread that finishes the task (now if it has finished)'''
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+        if self.exc_info:
+            reraise(self.exc_info)
+        return self.output
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+
+class Scheduler(object):
+    '''Runs tasks on at most `workers` threads at a time (unbounded if None).
+
+    Worker threads are started as tasks are submitted and exit when there is
+    nothing left to do, so a Scheduler is cheap to create for a single fan-out.
+    '''
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._queue = collections.deque()  # only used under _lock
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def submit(self, target, *args, **kwargs):
+        task = Task(target, args, kwargs)
+        with self._lock:
+            self._queue.append(task)
+            if self.workers is None or self._active < self.workers:
+                self._active += 1
+                Thread.spawn(self._work)
+        return task
+
+    def map(self, target, items):
+        '''call target on every item, returning the outputs in the order of items'''
+        tasks = [self.submit(target, item) for item in items]
+        return [t.join() for t in tasks]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._active -= 1
+                    return
+                task = self._queue.popleft()
+            task.run()
+
+
 class Valid(object):
     '''Useful for testing validity in a table'''
     def __init__(self, min=None, max=None, equal=None, isin=None):
@@ -159,16 +1120,61 @@ class Valid(object):
 
 class Failure(object):
     '''Used for formatting failures'''
+    status = 'FAIL'
+
     def __init__(self, cmd, failures):
-        self.cmd = cmd
+        self.cmd = cmdline(cmd)
         self.failures = failures
 
+    def to_dict(self):
+        return {'status': self.status, 'cmd': self.cmd,
+                'failures': [to_text(f) for f in self.failures]}
+
     def __repr__(self):
-        header = 'FAIL [{0}]:\n'.format(self.cmd)
+        header = '{0} [{1}]:\n'.format(self.status, self.cmd)
         lines = [' :: {0}'.format(l) for l in self.failures]
         return header + '\n'.join(lines)
 
 
+class Timeout(Failure):
+    '''A command that was killed before it finished. Neither a PASS nor a FAIL'''
+    status = 'TIMEOUT'
+
+    def __init__(self, cmd, timeout):
+        super(Timeout, self).__init__(cmd, [['killed after {0:.1f}s'.format(timeout)]])
+
+
+class Cancelled(Timeout):
+    '''A command that was killed or never started because the run was cancelled'''
+    status = 'CANCELLED'
+
+    def __init__(self, cmd):
+        Failure.__init__(self, cmd, [['cancelled']])
+
+
+class Collector(object):
+    '''Gets in-process (i.e. from /proc) the output a diagnostic's command would print.
+
+    Diagnostics use their command instead when any of `paths` does not exist or
+    the collector raises an error.
+    '''
+    def __init__(self, func, *paths):
+        self.func = func
+        self.paths = paths
+        self.name = ' '.join(paths)
+
+    def available(self):
+        return all(os.path.exists(p) for p in self.paths)
+
+    def __call__(self):
+        return self.func()
+
+    def outputs(self, timeout=None):
+        '''[(cmd, output or CommandTimeout)] for the diagnostic to check. timeout is the
+        seconds the diagnostic gives each of its commands'''
+        return [(self.name, self())]
+
+
 class Skip(object):
     def __init__(self, cmd, process=None):
         '''
@@ -184,38 +1190,82 @@ class Skip(object):
         self.process = process or default_process
 
     def __call__(self):
-        out, _, rc = self._call_subprocess()
+        try:
+            out, _, rc = self._call_subprocess()
+        except CommandTimeout:
+            return True
         if rc:
             return True
         return self.process(out.strip())
 
     def _call_subprocess(self):
-        return call_cmd(self.cmd, raise_on_error=False)
+        args = self.cmd.split()
+        if len(args) == 2 and args[0] == 'which':  # answered without a subprocess
+            path = which(args[1])
+            return (path.encode(), b'', 0) if path else (b'', b'', 1)
+        return cmd_cache.call(self.cmd, raise_on_error=False, timeout=Diagnose.default_timeout)
 
 
 class Diagnose(object):
     """Class to handle diagnostics from a command"""
+    # default number of device commands run at once when a diagnostic has no `workers`
+    device_workers = 8
+    # default seconds a command can run when a diagnostic has no `timeout`
+    default_timeout = 60
+    # default seconds between runs with --watch when a diagnostic has no `interval`
+    default_interval = 60
+
     def __init__(self, cmd, skip_pats=None, fail_pats=None, pass_pats=None, fail_on_output=False,
-                 process=None, devices=None, parallel=True, skip=None, requires=None, msg=''):
+                 process=None, pipe=None, metrics=None, collect=None, cursor=None, devices=None,
+                 parallel=True, workers=None, timeout=None, interval=None, cache=None, skip=None,
+                 requires=None, msg=''):
         '''
         :str cmd: the command to run to diagnose. Can have {device} in it for each device
-            gotten from `devices`
+            gotten from `devices`. A list of arguments is run without a shell
+        :func pipe: filters the output of each command before it is checked, in place of a
+            shell pipeline (i.e. `grep_lines`)
+        :func metrics: gets {name: number} from each output for `run`. The highest of each
+            is kept when there are several outputs
         :list fail_pats: list of regular expression patterns that command output FAILS on
         :list pass_pats: list of regular expression patterns that command output FAILS if
             not true
         :bool fail_on_output: if true, fails on any non-empty output from call
         :func process: function to process each output function. Should return a
             list of str matches that failed or an empty list
-        :str devices: command to run to get a list of devices (split by '\n')
+        :Collector collect: gets the output of cmd without running it when available.
+            `skip` only applies when it is not
+        :Cursor cursor: if the state file is loaded, only scan output logged since the
+            last run
+        :str devices: command to run to get a list of devices (split by '\n'), a list of
+            devices or a function returning them (i.e. Devices)
+        :bool parallel: if true, the command for each device is run in parallel
+        :int workers: maximum number of device commands to run at once. Defaults to
+            Diagnose.device_workers
+        :float timeout: seconds before each command is killed and reported as TIMEOUT.
+            Defaults to Diagnose.default_timeout
+        :float interval: seconds between runs with --watch. Defaults to
+            Diagnose.default_interval
+        :str cache: name to keep the output of each device's command under in result_cache,
+            so that runs within --max-age of each other reuse it. Only devices with a WWN or
+            serial number are kept
         :Skip skip: skip function. Return True to skip
         :str requires: documentation for the package needed if skipped
         :str msg: message to display on PASS
         '''
-        self.cmd = cmd
+        self.cmd = tuple(cmd) if is_argv(cmd) else cmd
         self.devices = devices
         self.process = process
+        self.pipe = pipe
+        self.metrics = metrics
+        self.collect = collect
+        self.cursor = cursor
         self.parallel = parallel
+        self.workers = workers
+        self._timeout = timeout
+        self._interval = interval
+        self.cache = cache
         self._skip = skip
+        self._skipped = None
         self.requires = requires
         self.fail_on_output = fail_on_output
         self.msg = msg
@@ -229,84 +1279,816 @@ class Diagnose(object):
             pat = pat.encode()
             return pat
 
-        self.skip_pats = [re.compile(format_pat(f), re.S) for f in skip_pats] if skip_pats else None
-        self.fail_pats = [re.compile(format_pat(f), re.S + re.M) for f in fail_pats] if fail_pats else None
-        self.pass_pats = [re.compile(format_pat(f), re.S) for f in pass_pats] if pass_pats else None
+        self.skip_pats = PatternSet(map(format_pat, skip_pats), re.S) if skip_pats else None
+        self.fail_pats = PatternSet(map(format_pat, fail_pats), re.S + re.M) if fail_pats else None
+        self.pass_pats = PatternSet(map(format_pat, pass_pats), re.S) if pass_pats else None
 
-    def _find_failures(self, cmd, output):
+    @profiled('parse')
+    def _find_failures(self, cmd, output, fail_matches=None):
+        '''fail_matches: matches of fail_pats if they were already searched for'''
         matches = []
         if self.fail_on_output and output:
             matches.append([repr(output[:80]) + '...'])
         if self.skip_pats:
-            if match_pats(self.skip_pats, output):
+            if self.skip_pats.search(output):
                 return []
         if self.pass_pats:
-            if not match_pats(self.pass_pats, output):
+            if not self.pass_pats.search(output):
                 matches.append([repr(output[:80]) + '...'])
         if self.process:
             matches.extend(self.process(output))
-        if self.fail_pats:
-            matches.extend(match_pats(self.fail_pats, output))
+        if fail_matches is not None:
+            matches.extend(fail_matches)
+        elif self.fail_pats:
+            matches.extend(self.fail_pats.findall(output))
         return [Failure(cmd, m) for m in matches]
 
-    def __call__(self):
+    @profiled('wall')
+    def __call__(self, metrics=None):
+        ''':dict metrics: updated with the metrics of the outputs'''
+        if deadline.cancelled:
+            return [Cancelled(self.cmd)]
+        try:
+            outputs = self._call_subprocesses()
+        except CommandTimeout as e:  # getting the devices timed out
+            return [e.failure()]
+        return self._check(outputs, metrics)
+
+    def _check(self, outputs, metrics=None):
+        '''the failures in [(cmd, output or CommandTimeout)]'''
         failed = []
-        for cmd, output in self._call_subprocesses():
-            failures = self._find_failures(cmd, output)
+        for cmd, output in outputs:
+            if isinstance(output, CommandTimeout):
+                failed.append(output.failure())
+                continue
+            if metrics is not None and self.metrics:
+                self._add_metrics(metrics, cmd, output)
+            if self.cursor and state.enabled:
+                output, position = self.cursor.filter(output)
+                failures = self.cursor.update(position, self._find_failures(cmd, output))
+            else:
+                failures = self._find_failures(cmd, output)
             if failures:
                 failed.extend(failures)
         return failed
 
+    def _add_metrics(self, metrics, cmd, output):
+        try:
+            found = self.metrics(output)
+        except (ValueError, IndexError, KeyError, ZeroDivisionError) as e:
+            _log.debug("no metrics in the output of {0}: {1!r}".format(cmdline(cmd), e))
+            return
+        for name, value in found.items():
+            metrics[name] = max(value, metrics.get(name, value))
+
+    @property
+    def timeout(self):
+        return self.default_timeout if self._timeout is None else self._timeout
+
+    @property
+    def interval(self):
+        return self.default_interval if self._interval is None else self._interval
+
+    def _get_devices(self):
+        if isinstance(self.devices, str):
+            devices, _, _ = cmd_cache.call(self.devices, timeout=self.timeout)
+            devices = (d.strip() for d in devices.split(b'\n'))
+            return [decode(d) for d in devices if d]
+        elif callable(self.devices):
+            return self.devices()
+        return self.devices
+
+    def _format(self, device):
+        return format_cmd(self.cmd, device=device)
+
+    @profiled('commands')
     def _get_commands(self):
         if self.devices:
-            if isinstance(self.devices, str):
-                devices, _, _ = call_cmd(self.devices)
-                devices = (d.strip() for d in devices.split(b'\n'))
-                devices = [decode(d) for d in devices if d]
-            else:
-                devices = self.devices
-            return [self.cmd.format(device=d) for d in devices]
+            return [self._format(d) for d in self._get_devices()]
+        elif self.cursor and state.enabled:
+            return [self.cursor.command(self.cmd)]
         else:
             return [self.cmd]
 
     def _call_subprocesses(self):
-        return [(cmd, call_cmd(cmd, raise_on_error=False)[0]) for cmd in self._get_commands()]
+        if self.collect and self.collect.available():
+            try:
+                return self.collect.outputs(self.timeout)
+            except (IOError, OSError, ValueError, KeyError, IndexError) as e:
+                _log.debug("collecting {0} failed, calling {1}: {2}".format(
+                           self.collect.name, cmdline(self.cmd), e))
+        if self.cache and self.devices and result_cache.enabled:
+            return self._call_cached()
+        return self._map(self._call_subprocess, self._get_commands())
+
+    def _map(self, func, cmds):
+        if self.parallel and len(cmds) > 1:
+            scheduler = Scheduler(self.workers or self.device_workers)
+            return scheduler.map(func, cmds)
+        return [func(cmd) for cmd in cmds]
+
+    def _call_cached(self):
+        '''[(cmd, output)] of each device, only calling the commands whose output in
+        result_cache is missing or stale'''
+        outputs, stale = [], []
+        for device in self._get_devices():
+            cmd = self._format(device)
+            identity = getattr(device, 'identity', None)
+            output = result_cache.get(self.cache, identity)
+            if output is None:
+                stale.append((len(outputs), identity))
+            outputs.append((cmd, output))
+        called = self._map(self._call_command, [outputs[i][0] for i, _ in stale])
+        for (i, identity), (cmd, output, rc) in zip(stale, called):
+            outputs[i] = cmd, output
+            if rc == 0:
+                result_cache.set(self.cache, identity, output)
+        return outputs
+
+    def _call_subprocess(self, cmd):
+        return self._call_command(cmd)[:2]
+
+    @profiled()
+    def _call_command(self, cmd):
+        '''(cmd, output, rc), or (cmd, CommandTimeout, None) when it timed out'''
+        try:
+            output, _, rc = cmd_cache.call(cmd, raise_on_error=False, timeout=self.timeout)
+        except CommandTimeout as e:
+            return cmd, e, None
+        return cmd, self._pipe(output), rc
+
+    def _pipe(self, output):
+        '''output filtered by pipe, unless it is a CommandTimeout'''
+        if self.pipe is None or isinstance(output, CommandTimeout):
+            return output
+        return self.pipe(output)
 
     @property
     def skip(self):
+        '''whether to skip this diagnostic. Only checked once (until rescan)'''
+        if self._skipped is None:
+            if self.collect and self.collect.available():
+                self._skipped = False
+            else:
+                self._skipped = self._check_skip()
+        return self._skipped
+
+    def rescan(self):
+        '''check whether to skip it again the next time'''
+        self._skipped = None
+
+    @profiled('skip')
+    def _check_skip(self):
         return self._skip() if self._skip else False
 
 
+class Monitor(object):
+    '''Runs a long test's checkers on a thread of its own, calling on_failure as soon as they
+    find failures.
+
+    sample() returns the (degrees, limit) of the hottest sensor, or None. The samples are
+    kept in `times` and `temperatures`, arrays of 8 bytes a sample rather than lists of
+    float objects, and set how often the checkers run: every `interval` seconds, down to
+    `min_interval` as the sensor gets within `margin` degrees of its limit.
+    '''
+    def __init__(self, checkers, sample=None, interval=0.5, min_interval=0.05, margin=10.0,
+                 on_failure=None):
+        self.checkers = checkers
+        self.sample = sample
+        self.interval = interval
+        self.min_interval = min_interval
+        self.margin = margin
+        self.on_failure = on_failure
+        self.times = array('d')
+        self.temperatures = array('d')
+        self.failures = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.checkers:
+            self._thread = Thread.spawn(self._run)
+        return self
+
+    def stop(self):
+        '''stop checking, returning the failures found with the temperatures attached (and
+        raising what a checker raised)
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        summary = self.summary()
+        if summary:
+            for failure in self.failures:
+                failure.failures = list(failure.failures) + [summary]
+        return self.failures
+
+    def next_interval(self, sample):
+        if sample is None:
+            return self.interval
+        degrees, limit = sample
+        headroom = min(max((limit - degrees) / self.margin, 0), 1)
+        return self.min_interval + (self.interval - self.min_interval) * headroom
+
+    def summary(self):
+        '''the peak temperature and its trend in degrees per minute, None without samples'''
+        n = len(self.temperatures)
+        if not n:
+            return None
+        trend = 0.0
+        if n > 1:  # least squares slope
+            mean_t, mean_d = sum(self.times) / n, sum(self.temperatures) / n
+            var = sum((t - mean_t) ** 2 for t in self.times)
+            if var:
+                trend = sum((t - mean_t) * (d - mean_d) for t, d in
+                            zip(self.times, self.temperatures)) / var * 60
+        return 'peak {0:.1f}C, trend {1:+.1f}C/min over {2} samples'.format(
+            max(self.temperatures), trend, n)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                sample = self.sample() if self.sample else None
+                if sample is not None:
+                    self.times.append(time.time())
+                    self.temperatures.append(sample[0])
+                for checker in self.checkers:
+                    self.failures.extend(checker() or [])
+                if self.failures:
+                    break
+                self._stop.wait(self.next_interval(sample))
+        finally:
+            if (self.failures or sys.exc_info()[0]) and self.on_failure:
+                self.on_failure()
+
+
 class DiagnoseLong(Diagnose):
     ''' Diagnostic tool for long running tests, including ability to run Diagnostics side by side
         and fail if they fail. (i.e. for temperature monitoring during cpu stress test '''
-    def __init__(self, cmd, checkers=None, loop_sleep=0.5, **kwargs):
+    # long tests are only limited by their own timeout or the deadline
+    default_timeout = None
+    # whether tests with `partitions` run their devices at the same time (--partition)
+    partitioned = False
+    # what the command is formatted with when it is not partitioned (see Partition.options)
+    unpartitioned = {'workers': "'-1'", 'affinity': '', 'memory': ''}
+
+    def __init__(self, cmd, checkers=None, loop_sleep=0.5, sample=None, partitions=None,
+                 setup=None, teardown=None, **kwargs):
+        '''
+        :str cmd: can also have {workers}, {affinity} and {memory} in it, see Partition.options
+        :list checkers: diagnostics (or Specs of them) run alongside the test by a Monitor.
+            The test is killed as soon as they fail
+        :float loop_sleep: seconds between checks (when temperatures are not near limits)
+        :func sample: (degrees, limit) of the hottest sensor, checks run faster near it
+        :CpuPartitions partitions: when partitioned, the command for each device runs at the
+            same time as the others, each on a partition of the CPUs
+        :str setup: command run once before the test (i.e. swapoff). FAILs if it fails
+        :str teardown: command run once after the test, even if it (or setup) fails, times
+            out or is cancelled. Setup and teardown are only limited by
+            Diagnose.default_timeout, not by the deadline
+        '''
         super(DiagnoseLong, self).__init__(cmd, **kwargs)
-        self.checkers = checkers or []
+        self.checkers = [c.build() if isinstance(c, Spec) else c for c in checkers or []]
         self.loop_sleep = loop_sleep
+        self.sample = sample
+        self.partitions = partitions
+        self.setup = setup
+        self.teardown = teardown
+
+    def monitor(self, on_failure=None):
+        return Monitor(self.checkers, self.sample, self.loop_sleep, on_failure=on_failure)
+
+    def _format(self, device, partition=None):
+        options = partition.options() if partition else self.unpartitioned
+        return format_cmd(self.cmd, device=device, **options)
+
+    def _get_batches(self):
+        '''the commands to run, in batches of commands that run at the same time'''
+        if not (self.partitioned and self.partitions and self.devices):
+            return [[cmd] for cmd in self._get_commands()]
+        devices = self._get_devices()
+        partitions = self.partitions.split(len(devices))
+        cmds = [self._format(d, partitions[i % len(partitions)]) for i, d in enumerate(devices)]
+        return [cmds[i:i + len(partitions)] for i in range(0, len(cmds), len(partitions))]
+
+    def _setup(self):
+        '''run the setup command, returning the failures if it fails'''
+        if not self.setup:
+            return []
+        try:
+            call_cmd(self.setup, timeout=Diagnose.default_timeout, respect_deadline=False)
+        except CommandTimeout as e:
+            return [e.failure()]
+        except RuntimeError as e:
+            return [Failure(self.setup, [str(e)])]
+        return []
+
+    def _teardown(self):
+        if self.teardown:
+            try:
+                call_cmd(self.teardown, raise_on_error=False, timeout=Diagnose.default_timeout,
+                         respect_deadline=False)
+            except CommandTimeout:
+                _log.warning("teardown [{0}] timed out".format(self.teardown))
 
+    @profiled('wall')
     def __call__(self):
-        failures = []
-        for cmd, process in self._popen_all():
-            _log.debug("Starting long test: " + cmd)
-            while process.poll() is None:
-                for p in self.checkers:
-                    failures.extend(p())
-                if failures:
-                    process.kill()
-                    break
-                time.sleep(self.loop_sleep)
-            stdout, stderr = process.communicate()
-            if stderr:
-                _log.debug("stderr from {0}: {1}".format(cmd, stderr))
-            failures.extend(self._find_failures(cmd, stdout))
+        if deadline.cancelled:
+            return [Cancelled(self.cmd)]
+        batches = self._get_batches()
+        try:  # once setup is attempted, i.e. swapoff failing partway, the teardown undoes it
+            failures = self._setup()
             if failures:
                 return failures
+            for batch in batches:
+                failures = self._run(batch)
+                if failures:
+                    return failures
+        finally:
+            self._teardown()
+
+    def _run(self, cmds):
+        '''run cmds at the same time, killing all of them at the first failure'''
+        profile = profiler.current()
+        started = self._popen_all(cmds)
+        kill = lambda: [self._abort(p) for _, p in started]
+        scanners = []
+        for cmd, process in started:
+            _log.debug("Starting long test: " + cmdline(cmd))
+            # fail patterns are searched as the output is written and kill the test at once
+            scanners.append((StreamScanner(process.stdout, self.fail_pats, on_match=kill),
+                             StreamScanner(process.stderr)))
+        monitor = self.monitor(on_failure=kill)
+        monitor.start()
+        timeout = deadline.timeout(self.timeout)
+        start = time.time()
+        timed_out = set()
+        while any(poll(p, rusage=bool(profile)) is None for _, p in started):
+            if timeout is not None and time.time() - start > timeout:
+                timed_out.update(cmd for cmd, p in started if p.poll() is None)
+                kill()
+                break
+            time.sleep(self.loop_sleep)
+        for _, process in started:
+            poll(process, rusage=bool(profile), block=True)
+            running.discard(process.pid)
+        failures = monitor.stop()
+        for (cmd, process), (stdout, stderr) in zip(started, scanners):
+            stdout.join()
+            if stderr.join().size:
+                _log.debug("stderr from {0}: {1}".format(cmdline(cmd), stderr.output))
+            if profile:
+                profile.add(subprocesses=1)
+                profile.add_output(stdout.size, stderr.size, getattr(process, 'rusage', None),
+                                   getattr(process, 'max_rss', 0))
+            if cmd in timed_out:
+                failures.append(Timeout(cmd, timeout))
+            failures.extend(self._find_failures(cmd, stdout.output, stdout.findall()))
+        if deadline.cancelled:  # killed by cancel_run, not by running out of time
+            failures = [f for f in failures if not isinstance(f, Timeout)]
+            return failures + [Cancelled(cmd) for cmd in cmds]
+        return failures
+
+    @staticmethod
+    def _abort(process):
+        if process.poll() is None:
+            kill_pgid(process.pid)
+
+    def _popen_all(self, cmds):
+        '''start cmds, returning [(cmd, process)]. The caller must discard them from
+        `running` once they have exited'''
+        return [(cmd, popen(cmd)) for cmd in cmds]
+
+
+def self_test_remaining(output):
+    '''the percent of a drive's SMART self-test remaining, None if it is not running'''
+    output = decode(output)
+    match = re.search(r'Self-test execution status:\s*\(\s*(\d+)\)', output)  # ATA
+    if match:
+        status = int(match.group(1))
+        return (status & 0xf) * 10 if status >> 4 == 0xf else None
+    match = re.search(r'Self-test status:.*in progress \((\d+)% completed\)', output)  # NVMe
+    return 100 - int(match.group(1)) if match else None
+
+
+def format_duration(seconds):
+    minutes = int(seconds) // 60
+    return '{0}h{1:02d}m'.format(minutes // 60, minutes % 60)
+
+
+class SmartTest(DiagnoseLong):
+    '''Runs the long SMART self-test of every drive at once.
+
+    A single poller checks the progress of all the drives still testing every
+    `poll_interval` seconds, stopping as soon as the run is cancelled or times out. Each
+    drive is checked (with `smartctl -a`) and reported with on_progress as soon as its test
+    finishes, along with the ETA of the rest. Drives still testing when it stops for any
+    reason have their test aborted.
+    '''
+    start_cmd = 'smartctl -t long {device}'
+    status_cmd = 'smartctl -c -l selftest {device}'  # NVMe only reports progress in the log
+    abort_cmd = 'smartctl -X {device}'
+
+    def __init__(self, devices, poll_interval=10, on_progress=None, **kwargs):
+        super(SmartTest, self).__init__('smartctl -a {device}', devices=devices, **kwargs)
+        self.poll_interval = poll_interval
+        self.on_progress = on_progress or _log.info
+
+    def _smartctl(self, cmd, respect_deadline=True):
+        '''stdout of cmd. smartctl's return code is a bit mask of drive problems, the
+        output is checked instead'''
+        return call_cmd(cmd.split(), raise_on_error=False, timeout=Diagnose.default_timeout,
+                        respect_deadline=respect_deadline)[0]
+
+    def _start(self, device):
+        '''start the test of device, returning a Failure if it did not start (a Timeout if
+        it may have)'''
+        cmd = self.start_cmd.format(device=device)
+        try:
+            output = decode(self._smartctl(cmd))
+        except CommandTimeout as e:
+            return e.failure()
+        # a test that is already running is waited for instead
+        if not re.search(r'has begun|without aborting current test', output):
+            return Failure(cmd, [output.strip().split('\n')[-1]])
+
+    def _status(self, device):
+        '''(percent remaining or None if done, recommended minutes) of device's test, or
+        None if smartctl timed out'''
+        try:
+            output = self._smartctl(self.status_cmd.format(device=device))
+        except CommandTimeout:
+            return None
+        minutes = re.search(br'Extended self-test routine\s*recommended polling time:'
+                            br'\s*\(\s*(\d+)\)', output)
+        return self_test_remaining(output), int(minutes.group(1)) if minutes else None
+
+    def _result(self, device):
+        cmd = self.cmd.format(device=device)
+        try:
+            return self._find_failures(cmd, self._smartctl(cmd))
+        except CommandTimeout as e:
+            return [e.failure()]
 
-    def _popen_all(self):
-        for cmd in self._get_commands():
-            yield (cmd, subprocess.Popen(
-                   cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+    def _stop(self, device):
+        '''abort device's test, even once the run is cancelled'''
+        cmd = self.abort_cmd.format(device=device)
+        try:
+            self._smartctl(cmd, respect_deadline=False)
+        except CommandTimeout:
+            _log.warning("[{0}] timed out, the test of {1} may still be running".format(
+                         cmd, device))
+
+    @profiled('wall')
+    def __call__(self):
+        if deadline.cancelled:
+            return [Cancelled(self.cmd)]
+        try:
+            devices = self._get_devices()
+        except CommandTimeout as e:  # getting the devices timed out
+            return [e.failure()]
+        scheduler = Scheduler(self.workers or self.device_workers)
+        failures, testing = [], {}
+        unsure = []  # drives whose start timed out, which may be testing
+        start = time.time()
+        try:
+            for device, failure in zip(devices, scheduler.map(self._start, devices)):
+                if isinstance(failure, Timeout):
+                    unsure.append(device)
+                if failure:
+                    failures.append(failure)
+                else:
+                    testing[device] = None  # the estimated seconds remaining
+            timeout = deadline.timeout(self.timeout)
+            while testing:
+                elapsed = time.time() - start
+                deadline.wait(self.poll_interval if timeout is None
+                              else min(self.poll_interval, max(timeout - elapsed, 0)))
+                elapsed = time.time() - start
+                if deadline.cancelled or (timeout is not None and elapsed > timeout):
+                    failed = (Cancelled if deadline.cancelled
+                              else lambda cmd: Timeout(cmd, elapsed))
+                    failures.extend(failed(self.cmd.format(device=d)) for d in testing)
+                    break
+                finished = []
+                for device, status in zip(list(testing),
+                                          scheduler.map(self._status, list(testing))):
+                    if status is None:  # polled again next time
+                        continue
+                    remaining, minutes = status
+                    if remaining is None:
+                        finished.append(device)
+                    elif remaining < 100:  # extrapolate from how far it has got
+                        testing[device] = elapsed * remaining / (100.0 - remaining)
+                    elif minutes:
+                        testing[device] = max(minutes * 60 - elapsed, 0)
+                for device, result in zip(finished, scheduler.map(self._result, finished)):
+                    del testing[device]
+                    failures.extend(result)
+                    self.on_progress('{0} {1}: {2} ({3} of {4} drives done{5})'.format(
+                        'smart_test', device, get_status(result), len(devices) - len(testing),
+                        len(devices), self._eta(testing)))
+        finally:  # however it stops, no drive is left testing
+            scheduler.map(self._stop, unsure + list(testing))
+        return failures or None
+
+    @staticmethod
+    def _eta(testing):
+        estimates = [e for e in testing.values() if e is not None]
+        return ', ETA ' + format_duration(max(estimates)) if estimates else ''
+
+
+deadline = Deadline()
+running = ProcessGroups()
+profiler = Profiler()
+state = State()
+cmd_cache = CommandCache(ttl=2)
+result_cache = ResultCache()
+durations = DurationStats()
+
+
+def cancel_run():
+    '''kill every command that is running and cancel the ones that have not started'''
+    deadline.cancel()
+    running.kill_all()
+
+
+##################################################
+# asyncio engine (python 3 only)
+
+class _CommandProtocol(object):
+    '''Gets a command's stdout for AsyncEngine. `finished` is resolved once the command has
+    exited and its pipes are closed.
+
+    It implements all of asyncio.SubprocessProtocol so that asyncio need not be imported.
+    '''
+    def __init__(self, finished):
+        self.finished = finished
+        self.transport = None
+        self.stdout = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pipe_data_received(self, fd, data):
+        if fd == 1:
+            self.stdout.append(data)
+
+    def pipe_connection_lost(self, fd, exc):
+        pass
+
+    def process_exited(self):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def connection_lost(self, exc):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+
+class _Slots(object):
+    '''Starts at most `size` things at once (all of them if None), the rest wait until one
+    that was started is released'''
+    def __init__(self, size=None):
+        self.size = size
+        self._active = 0
+        self._waiting = collections.deque()
+
+    def start(self, start):
+        if self.size is None or self._active < self.size:
+            self._active += 1
+            start()
+        else:
+            self._waiting.append(start)
+
+    def release(self):
+        if self._waiting:
+            self._waiting.popleft()()
+        else:
+            self._active -= 1
+
+
+class AsyncEngine(object):
+    '''Runs diagnostics from one asyncio event loop instead of a thread per diagnostic.
+
+    At most `workers` diagnostics run at once (all of them if None). The commands of a
+    Diagnose are asyncio subprocesses, at most its `workers` (or Diagnose.device_workers) at
+    once, and their output is checked with Diagnose._check. Diagnostics running the same
+    command at the same time share it, like they do through cmd_cache. Collectors, cached
+    results, long diagnostics (with their setup, checkers and teardown) and profiled runs
+    call the diagnostic itself in the loop's executor. Results are the same as calling the
+    diagnostics.
+    '''
+    def __init__(self, workers=None, on_result=None):
+        '''on_result(name, diagnose, failed, started, duration) is called as each finishes'''
+        if import_asyncio() is None:
+            raise RuntimeError("the asyncio engine requires python 3")
+        self.workers = workers
+        self.on_result = on_result
+        self._loop = None
+        self._executor = None
+        self._slots = None
+        self._commands = {}  # {cmd: future of its output} of those running
+
+    def run(self, diagnostics):
+        '''run {name: Diagnose}, returning their results in order'''
+        return self.run_groups((diagnostics, False))[0]
+
+    def run_groups(self, *groups):
+        '''run groups of (diagnostics, sequential) at the same time, returning the results
+        of each group. The diagnostics in a sequential group run one after another.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        asyncio = import_asyncio()
+        self._executor = ThreadPoolExecutor(max(self.workers or sum(len(d) for d, _ in groups), 1))
+        self._slots = _Slots(self.workers)
+        self._loop = asyncio.new_event_loop()
+        watcher = self._watch_children(asyncio, self._loop)
+        try:
+            futures = [self._group(d, sequential) for (d, sequential) in groups]
+            return self._loop.run_until_complete(self._gather(futures))
+        finally:
+            if watcher:
+                asyncio.set_child_watcher(None)
+                watcher.close()
+            self._loop.close()
+            self._executor.shutdown()
+            self._loop = self._executor = self._slots = None
+
+    @staticmethod
+    def _watch_children(asyncio, loop):
+        '''before python 3.12 asyncio waits for each subprocess in a thread of its own, unless
+        told to use a pidfd (linux 5.3 and later). Returns the watcher set, if any'''
+        if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+            return None
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except (AttributeError, OSError):  # an older kernel
+            return None
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.set_child_watcher(watcher)
+        return watcher
+
+    def _group(self, diagnostics, sequential):
+        if sequential:
+            return self._chain([functools.partial(self._report, name, d)
+                                for (name, d) in diagnostics.items()])
+        started = dict((name, self._report(name, diagnostics[name]))
+                       for name in durations.order(diagnostics))  # longest first
+        return self._gather([started[name] for name in diagnostics])
+
+    def _report(self, name, diagnose):
+        '''a future of a diagnostic's results, started once the engine has room for it'''
+        done = self._loop.create_future()
+
+        def start():
+            started = time.time()
+
+            def finished(future):
+                self._slots.release()
+                if future.exception() is not None:
+                    return done.set_exception(future.exception())
+                if self.on_result:
+                    self.on_result(name, diagnose, future.result(), started,
+                                   time.time() - started)
+                done.set_result(future.result())
+            self._diagnose(diagnose).add_done_callback(finished)
+        self._slots.start(start)
+        return done
+
+    def _gather(self, futures):
+        '''a future of the results of futures'''
+        if not futures:
+            done = self._loop.create_future()
+            done.set_result([])
+            return done
+        return import_asyncio().gather(*futures)
+
+    def _chain(self, starts):
+        '''a future of the results of starts, functions returning futures, each called
+        after the future of the one before it is done
+        '''
+        done = self._loop.create_future()
+        results = []
+
+        def step(future=None):
+            if future is not None:
+                if future.exception() is not None:
+                    return done.set_exception(future.exception())
+                results.append(future.result())
+            if len(results) == len(starts):
+                return done.set_result(results)
+            starts[len(results)]().add_done_callback(step)
+        step()
+        return done
+
+    @staticmethod
+    def _resolve(future, func, *args):
+        '''set the result of future to func(*args), or the exception it raised'''
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _diagnose(self, diagnose):
+        '''a future of a diagnostic's results'''
+        cls = type(diagnose)  # long ones and others running their commands their own way
+        if (cls.__call__ is not Diagnose.__call__ or profiler.enabled
+                or cls._call_subprocesses is not Diagnose._call_subprocesses
+                or (diagnose.collect and diagnose.collect.available())
+                or (diagnose.cache and diagnose.devices and result_cache.enabled)):
+            return self._loop.run_in_executor(self._executor, diagnose)
+        done = self._loop.create_future()
+        if deadline.cancelled:
+            done.set_result([Cancelled(diagnose.cmd)])
+        elif isinstance(diagnose.devices, str):  # listing them runs a command
+            listed = self._loop.run_in_executor(self._executor, diagnose._get_commands)
+            listed.add_done_callback(lambda f: self._commands_of(diagnose, f.result, done))
+        else:
+            self._commands_of(diagnose, diagnose._get_commands, done)
+        return done
+
+    def _commands_of(self, diagnose, get_commands, done):
+        '''run the commands get_commands() returns, resolving done with their failures'''
+        try:
+            cmds = get_commands()
+        except CommandTimeout as e:  # getting the devices timed out
+            return done.set_result([e.failure()])
+        except Exception as e:
+            return done.set_exception(e)
+        slots = _Slots((diagnose.workers or diagnose.device_workers) if diagnose.parallel else 1)
+        outputs = self._gather([self._command(cmd, diagnose.timeout, slots) for cmd in cmds])
+        outputs.add_done_callback(lambda f: self._resolve(
+            done, lambda: diagnose._check([(c, diagnose._pipe(o))
+                                           for c, o in zip(cmds, f.result())])))
+
+    def _command(self, cmd, timeout, slots):
+        '''a future of a command's stdout (or CommandTimeout), started once slots have room
+        for it, or shared with a call of the same command that is running'''
+        if cmd in self._commands:
+            return self._commands[cmd]
+        done = self._commands[cmd] = self._loop.create_future()
+        slots.start(lambda: self._start(cmd, timeout, done))
+
+        def finished(_):
+            del self._commands[cmd]
+            slots.release()
+        done.add_done_callback(finished)
+        return done
+
+    def _start(self, cmd, timeout, done):
+        timeout = deadline.timeout(timeout)
+        if timeout is not None and timeout <= 0:
+            return done.set_result(deadline.exception(cmd))
+        finished = self._loop.create_future()
+        protocol = _CommandProtocol(finished)
+        timers, timed_out = [], []
+
+        def finish(result):
+            if not done.done():
+                done.set_result(result)
+
+        def on_started(f):
+            if is_argv(cmd) and isinstance(f.exception(), OSError):  # what a shell exits 127 for
+                return finish(b'')
+            if f.exception() is not None:
+                return done.set_exception(f.exception())
+            running.add(protocol.transport.get_pid())
+            if timeout is not None:
+                timers.append(self._loop.call_later(timeout, on_timeout))
+
+        def on_timeout():
+            timed_out.append(True)
+            kill_pgid(protocol.transport.get_pid())
+            # a process stuck in uninterruptible IO can outlive SIGKILL, give up on it
+            self._loop.call_later(KILL_GRACE, finish, deadline.exception(cmd, timeout))
+
+        def on_finished(_):
+            for timer in timers:
+                timer.cancel()
+            running.discard(protocol.transport.get_pid())
+            protocol.transport.close()
+            if deadline.cancelled:  # killed by cancel_run
+                return finish(CommandCancelled(cmd))
+            finish(deadline.exception(cmd, timeout) if timed_out else b''.join(protocol.stdout))
+
+        if is_argv(cmd):
+            start = self._loop.subprocess_exec(lambda: protocol, *cmd, stdin=None,
+                                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                               start_new_session=True)
+        else:
+            start = self._loop.subprocess_shell(lambda: protocol, cmd, stdin=None,
+                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                start_new_session=True)
+        started = self._loop.create_task(start)
+        started.add_done_callback(on_started)
+        finished.add_done_callback(on_finished)
 
 
 ##################################################
@@ -318,187 +2100,1464 @@ class ProcessCurrentMax(object):
         self.name = name
         self.max = max
 
-    def __call__(self, stdout):
+    def usage(self, stdout):
         fo, max = [int(re.search('(\d+)', l).group(1)) for l in decode(stdout).split('\n') if l]
-        return [['{} > {}%'.format(self.name, int(self.max * 100))]] if fo * 1.0 / max > self.max else []
+        return fo * 1.0 / max
 
+    def __call__(self, stdout):
+        if self.usage(stdout) > self.max:
+            return [['{} > {}%'.format(self.name, int(self.max * 100))]]
+        return []
 
-def process_free_mem(stdout):
-    '''free -m processing'''
+    def metrics(self, stdout):
+        return {self.name + '_percent': self.usage(stdout) * 100}
+
+
+def grep_lines(pattern):
+    '''a pipe keeping the lines of output that match pattern, like `| grep -E pattern`'''
+    pattern = re.compile(pattern.encode())
+
+    def grep(output):
+        return b'\n'.join(l for l in output.split(b'\n') if pattern.search(l))
+    return grep
+
+
+def free_mem_usage(stdout):
+    '''(memory used, swap used or None without swap) as fractions, from free -m'''
     stdout = decode(stdout)
-    failures = []
     stdout = [l.strip() for l in stdout.split('\n') if l.strip()]
     header = [h.lower() for h in ['type'] + stdout[0].split()[:3]]
     mem = get_table(header, [stdout[1]])[0]
-    if mem['used'] * 1.0 / mem['total'] > 0.90:
+    swap = get_table(header, [stdout[2]])[0] if len(stdout) > 2 else None  # swap exists
+    return (mem['used'] * 1.0 / mem['total'],
+            swap['used'] * 1.0 / swap['total'] if swap and swap['total'] else None)
+
+
+def process_free_mem(stdout):
+    '''free -m processing'''
+    failures = []
+    mem, swap = free_mem_usage(stdout)
+    if mem > 0.90:
         failures.append(['mem usage > 90%'])
-    if len(stdout) > 2:  # swap exists
-        swap = get_table(header, [stdout[2]])[0]
-        if swap['total'] and swap['used'] * 1.0 / swap['total'] > 0.25:
-            failures.append(['swap usage > 25%'])
+    if swap is not None and swap > 0.25:
+        failures.append(['swap usage > 25%'])
     return failures
 
 
+def free_mem_metrics(stdout):
+    mem, swap = free_mem_usage(stdout)
+    metrics = {'mem_percent': mem * 100}
+    if swap is not None:
+        metrics['swap_percent'] = swap * 100
+    return metrics
+
+
+def usage_metrics(name):
+    '''metrics of df (or df -i) output: {name: the Use% of the fullest mount}'''
+    def metrics(stdout):
+        percents = [int(p) for p in re.findall(br'(\d+)%', stdout)]
+        return {name: max(percents)} if percents else {}
+    return metrics
+
+
+_temperature_info = {'temp': r'^[^:+\n]*:.*?([\d.]+)',
+                     'high': r'\(.*high\s*=\s*\+?([\d.]+)',
+                     'crit': r'\(.*crit\s*=\s*\+?([\d.]+)'}
+
+
+def temperature_limit(high=None, crit=None):
+    '''the temperature a sensor fails above: its high limit or 10 under its critical one,
+    whichever is lower (95 if it has neither)'''
+    limits = list(filter(None, (high, (10 if crit is None else crit) - 10)))
+    return min(limits) if limits else 95
+
+
 def process_temperatures(stdout):
     '''sensors processing'''
+    if isinstance(stdout, Temperatures):  # read by HwmonCollector, no need to parse it
+        return stdout.failures()
     stdout = decode(stdout).split('\n')
     failures = []
-    infodict = {'temp': r'^[^:+\n]*:.*?([\d.]+)',
-                'high': r'\(.*high\s*=\s*\+?([\d.]+)',
-                'crit': r'\(.*crit\s*=\s*\+?([\d.]+)'}
     for line in stdout:
-        linfo = get_info(infodict, line)
+        linfo = get_info(_temperature_info, line)
         if not linfo:
             continue
         temp = linfo.get('temp')
         if not temp:
             continue
-        high = list(filter(None, (linfo.get('high'), linfo.get('crit', 10) - 10)))
-        high = min(high) if high else 95
-        if temp > high:
+        if temp > temperature_limit(linfo.get('high'), linfo.get('crit')):
             failures.append([line])
     return failures
 
 
+def temperature_metrics(stdout):
+    '''{'temperature': degrees of the hottest sensor} from sensors output'''
+    if isinstance(stdout, Temperatures):
+        temps = [degrees for _, degrees in stdout.readings]
+        return {'temperature': max(temps)} if temps else {}
+    temps = [info['temp'] for info in (get_info(_temperature_info, l)
+                                       for l in decode(stdout).split('\n')) if info.get('temp')]
+    return {'temperature': max(temps)} if temps else {}
+
+
+##################################################
+# Collectors: read /proc instead of calling commands
+
+def collect_file_desc(path='/proc/sys/fs/file-nr'):
+    '''open file handles and their maximum, as `lsof | wc -l && sysctl fs.file-max` prints'''
+    allocated, unused, maximum = read_file(path).split()
+    return '{0}\n{1}\n'.format(int(allocated) - int(unused), int(maximum)).encode()
+
+
+def collect_threads(path='/proc/loadavg'):
+    '''threads on the system and the max user processes, as `ps ... && ulimit -u` prints'''
+    # the 4th field of loadavg is runnable/total kernel scheduling entities (threads)
+    threads = int(read_file(path).split()[3].split(b'/')[1])
+    limit = resource.getrlimit(resource.RLIMIT_NPROC)[0] if resource else -1
+    if limit < 0 or (resource and limit == resource.RLIM_INFINITY):
+        limit = int(read_file('/proc/sys/kernel/threads-max'))
+    return '{0}\n{1}\n'.format(threads, limit).encode()
+
+
+def collect_memory(path='/proc/meminfo'):
+    '''/proc/meminfo formatted like `free -m`'''
+    info = {}
+    for line in read_file(path).split(b'\n'):
+        if b':' in line:
+            key, value = line.split(b':', 1)
+            info[decode(key)] = int(value.split()[0])  # kB
+    mb = lambda kb: kb // 1024
+    total, free = info['MemTotal'], info['MemFree']
+    cache = info.get('Buffers', 0) + info.get('Cached', 0) + info.get('SReclaimable', 0)
+    available = info.get('MemAvailable', free + cache)
+    line = '{0:<7}' + '{1:>12}{2:>12}{3:>12}{4:>12}{5:>12}{6:>12}'
+    out = [line.format('', 'total', 'used', 'free', 'shared', 'buff/cache', 'available'),
+           line.format('Mem:', mb(total), mb(total - available), mb(free),
+                       mb(info.get('Shmem', 0)), mb(cache), mb(available)),
+           line.format('Swap:', mb(info.get('SwapTotal', 0)),
+                       mb(info.get('SwapTotal', 0) - info.get('SwapFree', 0)),
+                       mb(info.get('SwapFree', 0)), '', '', '').rstrip()]
+    return ('\n'.join(out) + '\n').encode()
+
+
+class Sensor(object):
+    '''A temperature sensor in /sys, read through a file descriptor kept open'''
+    __slots__ = ('chip', 'label', 'fd', 'high', 'crit')
+
+    def __init__(self, chip, label, path, high=None, crit=None):
+        self.chip = chip
+        self.label = label
+        self.fd = os.open(path, os.O_RDONLY)
+        self.high = high
+        self.crit = crit
+
+    def read(self):
+        '''degrees celsius (the kernel reports millidegrees)'''
+        return int(pread(self.fd, 32)) / 1000.0
+
+    @property
+    def limit(self):
+        return temperature_limit(self.high, self.crit)
+
+    def format(self, degrees):
+        '''the line `sensors` prints for it'''
+        limits = ', '.join(u'{0} = +{1:.1f}\xb0C'.format(name, value) for name, value in
+                           (('high', self.high), ('crit', self.crit)) if value)
+        return u'{0}:  {1:+.1f}\xb0C  {2}'.format(re.sub(r'[:+]', ' ', self.label), degrees,
+                                                   '(' + limits + ')' if limits else '').rstrip()
+
+
+class Temperatures(bytes):
+    '''The [(Sensor, degrees)] readings of a HwmonCollector, which are checked against the
+    limits of their sensors directly. As bytes, they are printed the way `sensors` does.
+    '''
+    def __new__(cls, readings):
+        lines, chip = [], None
+        for sensor, degrees in readings:
+            if sensor.chip != chip:
+                chip = sensor.chip
+                lines.extend(['', chip] if lines else [chip])
+            lines.append(sensor.format(degrees))
+        self = super(Temperatures, cls).__new__(cls, (u'\n'.join(lines) + u'\n').encode('utf-8'))
+        self.readings = readings
+        return self
+
+    def failures(self):
+        '''the sensors above their limit (see temperature_limit)'''
+        return [[sensor.format(degrees)] for sensor, degrees in self.readings
+                if degrees > sensor.limit]
+
+
+def _read_millidegrees(path):
+    try:
+        return int(read_file(path)) / 1000.0 or None
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _read_text(path, default=None):
+    try:
+        return decode(read_file(path)).strip() or default
+    except (IOError, OSError):
+        return default
+
+
+def scan_hwmon(root='/sys/class/hwmon'):
+    '''the temperature sensors of the hwmon devices in root'''
+    sensors = []
+    for hwmon in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        path = os.path.join(root, hwmon)
+        chip = _read_text(os.path.join(path, 'name'), hwmon)
+        inputs = (re.match(r'^temp(\d+)_input$', f) for f in os.listdir(path))
+        for n in sorted(int(m.group(1)) for m in inputs if m):
+            attr = lambda a: os.path.join(path, 'temp{0}_{1}'.format(n, a))
+            sensors.append(Sensor(chip, _read_text(attr('label'), 'temp{0}'.format(n)),
+                                  attr('input'), _read_millidegrees(attr('max')),
+                                  _read_millidegrees(attr('crit'))))
+    return sensors
+
+
+def scan_thermal(root='/sys/class/thermal', skip=()):
+    '''the sensors of the thermal zones in root, except those of a type in skip (the kernel
+    also registers most zones as hwmon devices named after their type)'''
+    sensors = []
+    zones = os.listdir(root) if os.path.isdir(root) else []
+    for zone in sorted(z for z in zones if z.startswith('thermal_zone')):
+        path = os.path.join(root, zone)
+        chip = _read_text(os.path.join(path, 'type'), zone)
+        if chip in skip or not os.path.exists(os.path.join(path, 'temp')):
+            continue
+        trips = {}
+        for trip in (f for f in os.listdir(path) if re.match(r'^trip_point_\d+_type$', f)):
+            temp = _read_millidegrees(os.path.join(path, trip.replace('_type', '_temp')))
+            trips[_read_text(os.path.join(path, trip))] = temp
+        sensors.append(Sensor(chip, 'temp1', os.path.join(path, 'temp'),
+                              trips.get('hot'), trips.get('critical')))
+    return sensors
+
+
+class HwmonCollector(Collector):
+    '''Temperatures from /sys/class/hwmon and /sys/class/thermal, checked by
+    process_temperatures against the limits of each sensor, without parsing `sensors` output.
+
+    The sensors are found the first time and their files kept open, so each reading is a
+    pread per sensor, until close (called by rescan). Available when there are any sensors.
+    '''
+    def __init__(self, root='/sys/class'):
+        super(HwmonCollector, self).__init__(self.collect, os.path.join(root, 'hwmon'))
+        self.root = root
+        self._sensors = None
+        self._lock = threading.Lock()
+
+    def sensors(self):
+        with self._lock:
+            return self._found()
+
+    def _found(self):
+        if self._sensors is None:
+            hwmon = scan_hwmon(os.path.join(self.root, 'hwmon'))
+            self._sensors = hwmon + scan_thermal(os.path.join(self.root, 'thermal'),
+                                                 skip=set(s.chip for s in hwmon))
+        return self._sensors
+
+    def available(self):
+        return bool(self.sensors())
+
+    def hottest(self):
+        '''(degrees, limit) of the sensor closest to its limit, None without sensors'''
+        readings = [(degrees, sensor.limit) for sensor, degrees in self.readings()]
+        return max(readings, key=lambda r: r[0] - r[1]) if readings else None
+
+    def close(self):
+        '''close the files of the sensors, which are found again when next collected'''
+        with self._lock:
+            for sensor in self._sensors or []:
+                os.close(sensor.fd)
+            self._sensors = None
+
+    def readings(self):
+        '''[(Sensor, degrees)] of the sensors that could be read'''
+        readings = []
+        with self._lock:  # not while close reuses their fds
+            for sensor in self._found():
+                try:
+                    readings.append((sensor, sensor.read()))
+                except (OSError, ValueError):  # i.e. a sensor that is powered down
+                    continue
+        return readings
+
+    def collect(self):
+        return Temperatures(self.readings())
+
+
+##################################################
+# Disk usage: statvfs of every mount instead of df
+
+# filesystems that df leaves out as they hold no data
+pseudo_filesystems = frozenset([
+    'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs', 'devpts',
+    'efivarfs', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'proc', 'pstore', 'rpc_pipefs',
+    'securityfs', 'selinuxfs', 'sysfs', 'tracefs'])
+
+
+class Mount(object):
+    __slots__ = ('path', 'fstype', 'source')
+
+    def __init__(self, path, fstype, source):
+        self.path = path
+        self.fstype = fstype
+        self.source = source
+
+    def __repr__(self):
+        return 'Mount({0}, {1}, {2})'.format(self.path, self.fstype, self.source)
+
+
+def _unescape_mount(field):
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+    '''the mounts in /proc/self/mountinfo text that hold data, a mount point hidden by
+    one mounted over it only once
+    '''
+    mounts = OrderedDict()
+    for line in decode(text).split('\n'):
+        fields, _, fs = line.partition(' - ')
+        fields, fs = fields.split(), fs.split()
+        if len(fields) < 5 or len(fs) < 2 or fs[0] in pseudo_filesystems:
+            continue
+        path = _unescape_mount(fields[4])
+        mounts.pop(path, None)
+        mounts[path] = Mount(path, fs[0], _unescape_mount(fs[1]))
+    return list(mounts.values())
+
+
+def percent_used(used, available):
+    '''rounded up, the way df does'''
+    total = used + available
+    return '-' if not total else '{0}%'.format(-(-used * 100 // total))
+
+
+class StatvfsCollector(object):
+    '''The block and inode usage of every mount from os.statvfs, shared by the df and
+    df_inode diagnostics (see `blocks` and `inodes`) within cmd_cache.ttl of each other.
+
+    Each mount is statted on a Scheduler of `workers` threads with its own timeout, so a
+    stuck mount (i.e. NFS) is reported as a TIMEOUT of its own without holding up the rest.
+    The timeout is that of the diagnostic collecting, unless `timeout` is set. Later passes
+    do not stat a mount again until its stuck call returns.
+    '''
+    def __init__(self, mountinfo='/proc/self/mountinfo', timeout=None, workers=8):
+        self.mountinfo = mountinfo
+        self.timeout = timeout
+        self.workers = workers
+        self.blocks = UsageCollector(self, inodes=False)
+        self.inodes = UsageCollector(self, inodes=True)
+        self._lock = threading.Lock()
+        self._stats = None  # (time finished, [(Mount, statvfs result or CommandTimeout)])
+        self._stuck = {}  # {path: Task}
+
+    def available(self):
+        return hasattr(os, 'statvfs') and os.path.exists(self.mountinfo)
+
+    def stats(self, timeout=None):
+        '''[(Mount, statvfs result or CommandTimeout)] of the mounts holding data, each
+        statted for at most `timeout` seconds (default: Diagnose.default_timeout) unless the
+        collector has a timeout of its own'''
+        if self.timeout is not None:
+            timeout = self.timeout
+        elif timeout is None:
+            timeout = Diagnose.default_timeout
+        with self._lock:
+            if self._stats is None or time.time() - self._stats[0] >= cmd_cache.ttl:
+                mounts = parse_mountinfo(read_file(self.mountinfo))
+                self._stats = time.time(), self._statvfs(mounts, timeout)
+            return self._stats[1]
+
+    def _statvfs(self, mounts, timeout):
+        scheduler = Scheduler(self.workers)
+        tasks = []
+        for mount in mounts:
+            task = self._stuck.pop(mount.path, None)
+            tasks.append(task if task and not task.done else scheduler.submit(os.statvfs,
+                                                                              mount.path))
+        timeout = deadline.timeout(timeout)
+        start = time.time()
+        stats = []
+        for mount, task in zip(mounts, tasks):
+            while not task.done:  # tasks time out from when they start, not from when queued
+                remaining = (task.started or start) + timeout - time.time()
+                if remaining <= 0:
+                    break
+                task.join(min(remaining, 0.1))
+            if not task.done:
+                _log.debug("statvfs {0} is stuck".format(mount.path))
+                self._stuck[mount.path] = task
+                stats.append((mount, deadline.exception('statvfs ' + mount.path, timeout)))
+                continue
+            try:
+                stat = task.join()
+            except OSError as e:  # i.e. not allowed, or unmounted since mountinfo was read
+                _log.debug("statvfs {0} failed: {1}".format(mount.path, e))
+                continue
+            if stat.f_blocks:  # like df, leave out filesystems with no blocks
+                stats.append((mount, stat))
+        return stats
+
+
+class UsageCollector(Collector):
+    '''What `df` (or `df -i`) prints for each mount of a StatvfsCollector, one output for
+    each mount so that failures and timeouts are reported for the mount they are on.
+    '''
+    def __init__(self, statvfs, inodes=False):
+        super(UsageCollector, self).__init__(self.collect, statvfs.mountinfo)
+        self.statvfs = statvfs
+        self.inodes = inodes
+        self.name = 'df -i' if inodes else 'df'
+
+    def available(self):
+        return self.statvfs.available()
+
+    def format(self, mount, stat):
+        if self.inodes:
+            used = stat.f_files - stat.f_ffree
+            return '{0} {1} {2} {3} {4} {5}'.format(
+                mount.source, stat.f_files, used, stat.f_ffree,
+                percent_used(used, stat.f_ffree), mount.path)
+        kb = stat.f_frsize / 1024.0
+        used = stat.f_blocks - stat.f_bfree
+        return '{0} {1:.0f} {2:.0f} {3:.0f} {4} {5}'.format(
+            mount.source, stat.f_blocks * kb, used * kb, stat.f_bavail * kb,
+            percent_used(used, stat.f_bavail), mount.path)
+
+    def outputs(self, timeout=None):
+        outputs = []
+        for mount, stat in self.statvfs.stats(timeout):
+            cmd = '{0} {1}'.format(self.name, mount.path)
+            if isinstance(stat, CommandCancelled):  # stats are shared with other collectors
+                outputs.append((cmd, CommandCancelled(cmd)))
+            elif isinstance(stat, CommandTimeout):
+                outputs.append((cmd, CommandTimeout(cmd, stat.timeout)))
+            else:
+                outputs.append((cmd, self.format(mount, stat).encode('utf-8')))
+        return outputs
+
+    def collect(self):
+        return b'\n'.join(o for _, o in self.outputs() if not isinstance(o, CommandTimeout))
+
+
+##################################################
+# Cursors: only scan logs written since the last run
+
+@memoize
+def _dmesg_time():
+    '''the [seconds] timestamps of dmesg, compiled when first used instead of at every start'''
+    return re.compile(br'^\[\s*(\d+\.\d+)\]', re.M)
+
+
+def boot_id():
+    try:
+        return decode(read_file('/proc/sys/kernel/random/boot_id')).strip()
+    except (IOError, OSError):
+        return None
+
+
+class Cursor(object):
+    '''Remembers in `state` how far through a log a diagnostic has scanned.
+
+    Everything is scanned again after a reboot. If keep_failures is set, failures
+    found by earlier runs are reported until then as well.
+    '''
+    keep_failures = False
+
+    def __init__(self, key):
+        self.key = key
+
+    def saved(self):
+        saved = state.get(self.key) or {}
+        return saved if saved.get('boot') == boot_id() else {}
+
+    def command(self, cmd):
+        return cmd
+
+    def filter(self, output):
+        '''return (the new part of output, the position to start from next run)'''
+        raise NotImplementedError
+
+    def update(self, position, failures):
+        saved = self.saved()
+        new = [[f.cmd, [to_text(m) if isinstance(m, bytes) else m for m in f.failures]]
+               for f in failures]
+        old = [f for f in saved.get('failures', []) if f not in new]
+        if position is None:  # nothing was logged
+            position = saved.get('position')
+        state.set(self.key, {'boot': boot_id(), 'position': position, 'failures': old + new})
+        if self.keep_failures:
+            return failures + [Failure(cmd, tuple(f)) for cmd, f in old]
+        return failures
+
+
+class DmesgCursor(Cursor):
+    '''position is the [seconds] timestamp of the last kernel message scanned'''
+    def filter(self, output):
+        last = self.saved().get('position')
+        start = 0 if last is None else self._find_after(output, last)
+        times = _dmesg_time().findall(output, output.rfind(b'\n[', 0, len(output) - 1) + 1)
+        return output[start:], float(times[-1]) if times else None
+
+    @staticmethod
+    def _find_after(output, last):
+        '''offset of the first message after `last`, by binary search (timestamps increase)'''
+        lo, hi = 0, len(output)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            m = _dmesg_time().search(output, mid)
+            if m is None or float(m.group(1)) > last:
+                hi = mid
+            else:
+                lo = m.end()
+        m = _dmesg_time().search(output, lo)
+        return m.start() if m and float(m.group(1)) > last else len(output)
+
+
+class JournalCursor(Cursor):
+    '''position is the journal cursor of the last entry scanned'''
+    marker = b'-- cursor: '
+
+    def command(self, cmd):
+        last = self.saved().get('position')
+        cmd += ' --show-cursor'
+        return cmd + ' --after-cursor ' + quote(last) if last else cmd
+
+    def filter(self, output):
+        start = output.rfind(self.marker)
+        if start < 0 or (start and output[start - 1:start] != b'\n'):
+            return output, None
+        return output[:start], decode(output[start + len(self.marker):]).strip()
+
+
+##################################################
+# Devices: disks found in /sys/block
+
+class Device(object):
+    '''A whole disk. Formats as its path, i.e. in "smartctl -a {device}"'''
+    def __init__(self, name, transport, rotational=None, removable=False, identity=None):
+        self.name = name
+        self.path = '/dev/' + name
+        self.transport = transport  # sata, sas, scsi, nvme, usb or virtio
+        self.rotational = rotational
+        self.removable = removable
+        self.identity = identity  # WWN or serial number, which unlike the name never changes
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return 'Device({0}, {1}, rotational={2}, removable={3})'.format(
+            self.name, self.transport, self.rotational, self.removable)
+
+
+def _read_flag(path):
+    try:
+        return read_file(path).strip() == b'1'
+    except (IOError, OSError):
+        return None
+
+
+def get_identity(sys_path):
+    '''the WWN or serial number of the disk at sys_path, None if it has neither'''
+    for attr in ('wwid', 'device/wwid', 'serial', 'device/serial'):
+        identity = _read_text(os.path.join(sys_path, attr))
+        if identity:
+            return identity
+    return None
+
+
+def get_transport(name, sys_path):
+    '''how a disk is attached, from its name and where it is in the /sys/devices tree'''
+    if name.startswith('nvme'):
+        return 'nvme'
+    real = os.path.realpath(sys_path)
+    for part, transport in (('/virtual/', None), ('/usb', 'usb'), ('/virtio', 'virtio'),
+                            ('/ata', 'sata'), ('/end_device-', 'sas')):
+        if part in real:
+            return transport
+    return 'scsi' if name.startswith('sd') else None
+
+
+def scan_block_devices(root='/sys/block'):
+    '''the disks in root, in name order (sdz comes before sdaa)'''
+    devices = []
+    for name in sorted(os.listdir(root), key=lambda n: (len(n), n)):
+        path = os.path.join(root, name)
+        transport = get_transport(name, path)
+        if transport is None or name.startswith('sr'):  # partition tables, cdroms, ram...
+            continue
+        devices.append(Device(name, transport,
+                              rotational=_read_flag(os.path.join(path, 'queue', 'rotational')),
+                              removable=_read_flag(os.path.join(path, 'removable')),
+                              identity=get_identity(path)))
+    return devices
+
+
+@memoize
+def block_devices():
+    '''the disks in /sys/block, only looked up once per run (until rescan)'''
+    return scan_block_devices()
+
+
+def rescan():
+    '''forget the disks, sensors and programs on PATH found so far, so that runs that last
+    (watch, or run in a program that embeds diagnose) find swapped disks and new programs'''
+    block_devices.reset()
+    path_index.reset()
+    hwmon.close()
+
+
+class Devices(object):
+    '''Selects the disks a diagnostic runs on, for its `devices`.
+
+    Disks are found in /sys/block, or by calling `fallback` where there is no /sys.
+    '''
+    def __init__(self, transports=None, rotational=None, removable=False,
+                 fallback="ls /dev/sd* | grep -P '^/dev/sd[a-z]+$'"):
+        '''
+        :tuple transports: only include disks attached with one of these
+        :bool rotational: if not None, only include (non) spinning disks
+        :bool removable: if not None, only include (non) removable disks
+        :str fallback: command listing device paths (split by '\n')
+        '''
+        self.transports = transports
+        self.rotational = rotational
+        self.removable = removable
+        self.fallback = fallback
+
+    def select(self, device):
+        return ((self.transports is None or device.transport in self.transports)
+                and (self.rotational is None or device.rotational == self.rotational)
+                and (self.removable is None or bool(device.removable) == self.removable))
+
+    def __call__(self):
+        if not os.path.isdir('/sys/block'):
+            devices, _, _ = cmd_cache.call(self.fallback, timeout=Diagnose.default_timeout)
+            return [decode(d.strip()) for d in devices.split(b'\n') if d.strip()]
+        return [d for d in block_devices() if self.select(d)]
+
+
+##################################################
+# CPU partitions: run the methods of a long test at the same time
+
+def parse_cpulist(text):
+    '''the cpus in a /sys cpulist, i.e. "0-3,8-11"'''
+    cpus = []
+    for part in to_text(text).strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    '''cpus formatted as a cpulist (the format of taskset and stress-ng --taskset)'''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{0}-{1}'.format(a, b) for a, b in ranges)
+
+
+def _node_free_memory(node_path):
+    '''bytes of free memory on a NUMA node, from its meminfo'''
+    for line in read_file(os.path.join(node_path, 'meminfo')).split(b'\n'):
+        if b'MemFree:' in line:
+            return int(line.split(b'MemFree:')[1].split()[0]) * 1024
+    raise ValueError('no MemFree in ' + node_path)
+
+
+def scan_nodes(root='/sys/devices/system/node', allowed=None):
+    '''[(cpus, free memory in bytes)] of each NUMA node with cpus that are allowed (by
+    default the cpus this process may run on), or of the whole machine as one node where
+    there is no NUMA information
+    '''
+    if allowed is None and hasattr(os, 'sched_getaffinity'):
+        allowed = os.sched_getaffinity(0)
+    allowed = None if allowed is None else set(allowed)
+    nodes = []
+    names = os.listdir(root) if os.path.isdir(root) else []
+    for name in sorted((n for n in names if re.match(r'^node\d+$', n)), key=lambda n: int(n[4:])):
+        path = os.path.join(root, name)
+        cpus = parse_cpulist(read_file(os.path.join(path, 'cpulist')))
+        cpus = [c for c in cpus if allowed is None or c in allowed]
+        if cpus:
+            nodes.append((cpus, _node_free_memory(path)))
+    if nodes:
+        return nodes
+    import multiprocessing  # only imported when needed, as it is slow to import
+    cpus = sorted(allowed) if allowed else list(range(multiprocessing.cpu_count()))
+    info = dict(l.split(b':', 1) for l in read_file('/proc/meminfo').split(b'\n') if b':' in l)
+    return [(cpus, int(info[b'MemFree'].split()[0]) * 1024)]
+
+
+class Partition(object):
+    '''The CPUs and memory given to one of the methods of a long test running at once'''
+    __slots__ = ('cpus', 'memory')
+
+    def __init__(self, cpus, memory):
+        self.cpus = cpus
+        self.memory = memory
+
+    def options(self):
+        '''what a partitioned DiagnoseLong formats its command with: the number of stress-ng
+        workers, the stress-ng options pinning them to the cpus and sizing their memory
+        '''
+        return {'workers': len(self.cpus),
+                'affinity': ' --taskset ' + format_cpulist(self.cpus),
+                'memory': ' --vm-bytes {0}k'.format(self.memory // len(self.cpus) // 1024)}
+
+    def __repr__(self):
+        return 'Partition({0}, {1})'.format(format_cpulist(self.cpus), self.memory)
+
+
+class CpuPartitions(object):
+    '''Splits the CPUs (and free memory) of each NUMA node among the methods of a long test,
+    so that they can run at the same time without sharing CPUs or remote memory.
+    '''
+    def __init__(self, root='/sys/devices/system/node', memory_fraction=0.8,
+                 max_partitions=None, cpus=None):
+        '''
+        :float memory_fraction: how much of the free memory of a node its partitions share
+        :int max_partitions: most methods run at once. Defaults to one per CPU
+        :list cpus: the cpus to use. Defaults to those this process may run on
+        '''
+        self.root = root
+        self.memory_fraction = memory_fraction
+        self.max_partitions = max_partitions
+        self.cpus = cpus
+
+    def split(self, methods):
+        '''partitions for running up to `methods` at once. Nodes are shared out in proportion
+        to their CPUs; each partition only has the CPUs and memory of one node (unless there
+        are more nodes than methods)
+        '''
+        nodes = scan_nodes(self.root, self.cpus)
+        total = sum(len(cpus) for cpus, _ in nodes)
+        n = min(methods, total, self.max_partitions or total)
+        if n < len(nodes):  # fewer methods than nodes: give each a few whole nodes
+            groups = [nodes[i::n] for i in range(n)]
+            return [Partition(sum((cpus for cpus, _ in g), []),
+                              int(sum(m for _, m in g) * self.memory_fraction)) for g in groups]
+        # largest remainder shares, at least one per node
+        shares = [max(1, len(cpus) * n // total) for cpus, _ in nodes]
+        while sum(shares) > n:
+            shares[shares.index(max(shares))] -= 1
+        by_remainder = sorted(range(len(nodes)), key=lambda i: -(len(nodes[i][0]) * n % total))
+        for i in by_remainder[:n - sum(shares)]:
+            shares[i] += 1
+        partitions = []
+        for (cpus, memory), share in zip(nodes, shares):
+            share = min(share, len(cpus))
+            for k in range(share):
+                part = cpus[k * len(cpus) // share:(k + 1) * len(cpus) // share]
+                partitions.append(Partition(part, int(memory * self.memory_fraction / share)))
+        return partitions
+
+
 ##################################################
 # System Diagnostics definitions
 
-drive_devices = "ls /dev/sd* | grep -P '^/dev/sd[a-z]+$'"
+class Spec(object):
+    '''A diagnostic declared without building it: cls(*args, **kwargs) is only called, and
+    its patterns compiled, the first time it is needed. Specs among its arguments (or in
+    lists of them) are built along with it.
+    '''
+    _lock = threading.RLock()
+
+    def __init__(self, cls, *args, **kwargs):
+        self.cls = cls
+        self.args = args
+        self.kwargs = kwargs
+        self._built = None
+
+    @property
+    def built(self):
+        return self._built is not None
+
+    def build(self):
+        with self._lock:
+            if self._built is None:
+                self._built = self.cls(*[self._build(a) for a in self.args],
+                                       **dict((k, self._build(v)) for k, v in self.kwargs.items()))
+            return self._built
+
+    @classmethod
+    def _build(cls, value):
+        if isinstance(value, Spec):
+            return value.build()
+        if isinstance(value, list):
+            return [cls._build(v) for v in value]
+        return value
+
+
+class Registry(object):
+    '''Diagnostics by name, in the order they were registered. Used like an OrderedDict of
+    them, but each one is only built (see Spec) when it is looked up.
+    '''
+    def __init__(self, specs=()):
+        self._specs = OrderedDict()
+        for name, spec in specs:
+            self.register(name, spec)
+
+    def register(self, name, spec):
+        '''add a Spec (or an already built diagnostic), replacing any with the same name'''
+        self._specs[name] = spec
+
+    def spec(self, name):
+        return self._specs[name]
+
+    def built(self):
+        '''the names of the diagnostics built so far'''
+        return [n for n, s in self._specs.items() if not isinstance(s, Spec) or s.built]
+
+    def __getitem__(self, name):
+        spec = self._specs[name]
+        return spec.build() if isinstance(spec, Spec) else spec
+
+    def get(self, name, default=None):
+        return self[name] if name in self._specs else default
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
+    def keys(self):
+        return list(self._specs)
+
+    def values(self):
+        return [self[name] for name in self._specs]
+
+    def items(self):
+        return [(name, self[name]) for name in self._specs]
 
-system_diagnostics = OrderedDict((
+
+drive_devices = Devices(transports=('sata', 'sas', 'scsi', 'nvme'))
+mount_usage = StatvfsCollector()
+file_desc_usage = ProcessCurrentMax('file_desc', 0.7)
+threads_usage = ProcessCurrentMax('threads', 0.7)
+ata_devices = Devices(transports=('sata',))
+hwmon = HwmonCollector()
+
+# shared by smart and smart_test
+smart_skip_pats = [r'Device does not support Self Test logging']
+smart_fail_pats = [r'(overall-health[^\n]*test result: (?!PASSED)[^\n]*)']
+# ATA drives pass when their last self-test completed without error. NVMe drives have no
+# self-test execution status, they pass on their overall health (and NVMe health log)
+smart_pass_pats = [r'(Self-test execution status:\s*\(\s*0\s*\)'
+                   r'|test result: PASSED\s*\n\s*SMART/Health Information \(NVMe Log)']
+# the newest entry of an NVMe self-test log, which smartctl -a prints since 7.3
+smart_test_fail_pats = smart_fail_pats + [
+    r'^\s*0\s+Extended\s+((?!Completed without error)\S[^\n]*?)\s*$']
+
+system_diagnostics = Registry((
     # System Journals
     ('dmesg',
-        Diagnose('dmesg', msg='no concerning error logs detected',
-                 fail_pats=[r'UncorrectableError',  # drive has uncorrectable error
-                            r'Hardware Error[^\n]*',
-                            r'Remounting filesystem read-only',
-                            r'hung_task_timeout_secs',               # kernel task hung
-                            r'BUG: soft lockup',                     # kernel soft lockup
-                            r'nfs: server [^\n]* not responding',    # NFS timeout
-                            r'invoked oom-killer'])),                # Out of Memory
-    ('journalctl', Diagnose('journalctl -p 0..3 -xn --since "-240"', skip=Skip('which journalctl'),
-                            pass_pats=[r'^-- No entries --$'], requires='systemd',
-                            msg='No emergency->error journals')),
+        Spec(Diagnose, ['dmesg'], msg='no concerning error logs detected',
+             cursor=DmesgCursor('dmesg'), interval=30,
+             fail_pats=[r'UncorrectableError',  # drive has uncorrectable error
+                        r'Hardware Error[^\n]*',
+                        r'Remounting filesystem read-only',
+                        r'hung_task_timeout_secs',               # kernel task hung
+                        r'BUG: soft lockup',                     # kernel soft lockup
+                        r'nfs: server [^\n]* not responding',    # NFS timeout
+                        r'invoked oom-killer'])),                # Out of Memory
+    ('journalctl', Spec(Diagnose, 'journalctl -p 0..3 -xn --since "-240"',
+                        skip=Skip('which journalctl'), cursor=JournalCursor('journalctl'),
+                        pass_pats=[r'^-- No entries --$'], requires='systemd',
+                        msg='No emergency->error journals')),
 
     # Services + System
-    ('systemctl', Diagnose('systemctl --failed', skip=Skip('which systemctl'),
-                           fail_pats=[r'\sfailed\s'], msg='no failed services')),
-    ('file_desc', Diagnose('lsof | wc -l && sysctl fs.file-max', skip=Skip('which lsof'),
-                           process=ProcessCurrentMax('file_desc', 0.7), requires='lsof',
-                           msg='file descriptors < 70% usage')),
-    ('threads', Diagnose("ps -eo nlwp | tail -n +2 | awk '{ num_threads += $1 }"
-                         " END { print num_threads }' && bash -c 'ulimit -u'",
-                         process=ProcessCurrentMax('threads', 0.7), msg='threads < 70% usage')),
+    ('systemctl', Spec(Diagnose, ['systemctl', '--failed'], skip=Skip('which systemctl'),
+                       fail_pats=[r'\sfailed\s'], msg='no failed services')),
+    ('file_desc', Spec(Diagnose, 'lsof | wc -l && sysctl fs.file-max', skip=Skip('which lsof'),
+                       collect=Collector(collect_file_desc, '/proc/sys/fs/file-nr'),
+                       process=file_desc_usage, metrics=file_desc_usage.metrics,
+                       requires='lsof', msg='file descriptors < 70% usage')),
+    ('threads', Spec(Diagnose, "ps -eo nlwp | tail -n +2 | awk '{ num_threads += $1 }"
+                               " END { print num_threads }' && bash -c 'ulimit -u'",
+                     collect=Collector(collect_threads, '/proc/loadavg'),
+                     process=threads_usage, metrics=threads_usage.metrics,
+                     msg='threads < 70% usage')),
 
     # HDD / disk
-    ('readonly', Diagnose('ls -ld /', pass_pats=[r'^drwx'], msg='/ is read+write+exec by root')),
+    ('readonly', Spec(Diagnose, ['ls', '-ld', '/'], pass_pats=[r'^drwx'],
+                      msg='/ is read+write+exec by root')),
     ('hdparm',
-        Diagnose('hdparm -I {device}', devices=drive_devices,
-                 fail_pats=[r'Security:.*((?<!not)\slocked)',
-                            r'(Checksum: (?!correct))'],
-                 msg='hardrives unlocked', skip=Skip('which hdparm'))),
-    ('df', Diagnose('df', fail_pats=[r'((?:9[5-9]|100)%.*$)'], msg='disk usage < 95%')),
-
-    ('df_inode', Diagnose('df -i', fail_pats=[r'((?:[7-9]\d|100)%.*$)'], msg='inodes < 70%')),
-    ('smart', Diagnose('smartctl -a {device}', devices=drive_devices,
-                      skip_pats=[r'Device does not support Self Test logging'],
-                      fail_pats=[r'(overall-health[^\n]*test result: (?!PASSED)[^\n]*)'],
-                      pass_pats=[r'(Self-test execution status:\s*\(\s*0\s*\))'],
-                      skip=Skip('which smartctl'), requires='smartmontools',
-                      msg='drives in usable health')),
+        Spec(Diagnose, ['hdparm', '-I', '{device}'], devices=ata_devices,
+             fail_pats=[r'Security:.*((?<!not)\slocked)',
+                        r'(Checksum: (?!correct))'],
+             msg='hardrives unlocked', skip=Skip('which hdparm'), interval=3600,
+             cache='hdparm')),
+    ('df', Spec(Diagnose, ['df'], fail_pats=[r'((?:9[5-9]|100)%.*$)'], collect=mount_usage.blocks,
+                metrics=usage_metrics('disk_percent'), msg='disk usage < 95%', interval=10)),
+
+    ('df_inode', Spec(Diagnose, ['df', '-i'], fail_pats=[r'((?:[7-9]\d|100)%.*$)'],
+                      collect=mount_usage.inodes, metrics=usage_metrics('inode_percent'),
+                      msg='inodes < 70%', interval=10)),
+    ('smart', Spec(Diagnose, ['smartctl', '-a', '{device}'], devices=drive_devices,
+                   skip_pats=smart_skip_pats, fail_pats=smart_fail_pats,
+                   pass_pats=smart_pass_pats, skip=Skip('which smartctl'),
+                   requires='smartmontools', msg='drives in usable health', interval=3600,
+                   cache='smart')),
 
     # Network
-    ('iplink', Diagnose('ip link', fail_pats=['^\d+:.*state DOWN.*$'], msg='network links up',
-                        skip=Skip('which ip'))),
-    ('internet', Diagnose('ping -c 1 8.8.8.8', fail_pats=[r'0 received, 100% packet loss'],
-                          msg='connected to google DNS')),
-    ('website', Diagnose('ping -c 1 google.com', fail_pats=[r'0 received, 100% packet loss'],
-                          msg='connected to google website')),
+    ('iplink', Spec(Diagnose, ['ip', 'link'], fail_pats=[r'^\d+:.*state DOWN.*$'],
+                    msg='network links up', skip=Skip('which ip'))),
+    ('internet', Spec(Diagnose, ['ping', '-c', '1', '8.8.8.8'],
+                      fail_pats=[r'0 received, 100% packet loss'],
+                      msg='connected to google DNS', interval=30)),
+    ('website', Spec(Diagnose, ['ping', '-c', '1', 'google.com'],
+                     fail_pats=[r'0 received, 100% packet loss'],
+                     msg='connected to google website')),
 
     # Misc Hardware
-    ('memory', Diagnose('free -m | grep "total\s*used\|Mem:\|Swap:"', process=process_free_mem, msg='mem < 90%, swap < 25%')),
-    ('sensors', Diagnose('sensors', process=process_temperatures, requires='lm_sensors',
-                        skip=Skip('which sensors-detect'), msg='temps look adequate')),
+    ('memory', Spec(Diagnose, ['free', '-m'], pipe=Spec(grep_lines, r'total\s*used|Mem:|Swap:'),
+                    process=process_free_mem, metrics=free_mem_metrics,
+                    collect=Collector(collect_memory, '/proc/meminfo'),
+                    msg='mem < 90%, swap < 25%', interval=10)),
+    ('sensors', Spec(Diagnose, ['sensors'], process=process_temperatures,
+                     metrics=temperature_metrics, collect=hwmon,
+                     requires='lm_sensors', skip=Skip('which sensors-detect'),
+                     msg='temps look adequate', interval=10)),
 ))
 
+# run alongside cpu_burn and mem_burn, as Specs (or diagnostics) built along with them
+cpu_checkers = [system_diagnostics.spec('sensors'),
+                Spec(Diagnose, ['dmesg'], fail_pats=[r'Hardware Error[^\n]*'])]
+hottest_sensor = hwmon.hottest
+cpu_partitions = CpuPartitions()
+
+long_system_diagnostics = Registry((
+    ('cpu_burn', Spec(DiagnoseLong, "stress-ng --cpu {workers} --cpu-method {device} -t 60"
+                                    " --metrics-brief --maximize{affinity}",
+                      devices=['bitops', 'callfunc',                        # verification
+                               'decimal64', 'decimal128',                   # decimal
+                               'int128longdouble', 'in128decimal128',       # int
+                               'fft', 'hanoi', 'ackermann', 'matrixprod'],  # diverse
+                      requires='stress-ng', fail_pats=['unsuccessful run completed'],
+                      checkers=cpu_checkers, sample=hottest_sensor,
+                      partitions=cpu_partitions, parallel=False)),
+    ('mem_burn', Spec(DiagnoseLong, "stress-ng --vm {workers} --vm-method {device} -t 60"
+                                    " --maximize{affinity}{memory}",
+                      devices=['zero-one', 'galpat-0', 'galpat-1', 'swap', 'modulo-x'],
+                      requires='stress-ng', fail_pats=['unsuccessful run completed'],
+                      checkers=cpu_checkers, sample=hottest_sensor,
+                      partitions=cpu_partitions, setup='swapoff -a',
+                      teardown='swapon -a', parallel=False)),
+    ('smart_test', Spec(SmartTest, devices=drive_devices, skip_pats=smart_skip_pats,
+                        fail_pats=smart_test_fail_pats, pass_pats=smart_pass_pats)),
+))
+
+
+def register(name, spec, long=False):
+    '''Add a diagnostic (usually a Spec) to system_diagnostics, or long_system_diagnostics
+    if long, replacing any with the same name. For plugins, see load_plugins
+    '''
+    (long_system_diagnostics if long else system_diagnostics).register(name, spec)
+
+
+def load_plugins(path=None):
+    '''Run the python files in each directory of path (default: $DIAGNOSE_PLUGINS, or
+    /etc/diagnose.d), in name order, so that sites can add their own checks. The files are
+    given this module as `diagnose`, i.e.:
+
+        diagnose.register('ntp', diagnose.Spec(diagnose.Diagnose, ['ntpstat'],
+                                               fail_pats=['unsynchronised']))
+
+    diagnose.cpu_checkers is a list of Specs (or diagnostics) run alongside cpu_burn and
+    mem_burn, which plugins can add to before those are built.
+
+    Directories and files that someone else could have written are skipped (see is_private),
+    as they are usually run as root.
+    '''
+    if path is None:
+        path = os.environ.get('DIAGNOSE_PLUGINS', '/etc/diagnose.d')
+    module = sys.modules[__name__]
+    for directory in path.split(os.pathsep):
+        if not os.path.isdir(directory):
+            continue
+        if not is_private(directory):
+            _log.warning("skipping the plugins in {0}: not owned by this user or root, or"
+                         " writable by others".format(directory))
+            continue
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.py'):
+                continue
+            if not is_private(os.path.join(directory, name)):
+                _log.warning("skipping the plugin {0}: not owned by this user or root, or"
+                             " writable by others".format(os.path.join(directory, name)))
+                continue
+            import runpy
+            try:
+                runpy.run_path(os.path.join(directory, name), init_globals={'diagnose': module})
+            except Exception:
+                _log.exception("loading the plugin {0} failed".format(name))
+
 
 ##################################################
 # Main functions
 
-cpu_checkers = [system_diagnostics['sensors'],
-                Diagnose('dmesg', fail_pats=[r'Hardware Error[^\n]*'])]
-
-long_system_diagnostics = OrderedDict((
-    ('cpu_burn', DiagnoseLong("stress-ng --cpu '-1' --cpu-method {device} -t 60"
-                              " --metrics-brief --maximize",
-                              devices=['bitops', 'callfunc',                        # verification
-                                       'decimal64', 'decimal128',                   # decimal
-                                       'int128longdouble', 'in128decimal128',       # int
-                                       'fft', 'hanoi', 'ackermann', 'matrixprod'],  # diverse
-                             requires='stress-ng', fail_pats=['unsuccessful run completed'],
-                             checkers=cpu_checkers, parallel=False)),
-    ('mem_burn', DiagnoseLong("swapoff -a && stress-ng --vm '-1' --vm-method {device} -t 60 --maximize ; swapon -a",
-                              devices=['zero-one', 'galpat-0', 'galpat-1', 'swap', 'modulo-x'],
-                              requires='stress-ng', fail_pats=['unsuccessful run completed'],
-                              checkers=cpu_checkers, parallel=False)),
-    ('smart_test', DiagnoseLong('smartctl -t long {device} &&'               # start long test
-                                ' while [ "$(smartctl -a {device} |'         # wait till it's done
-                                ''' grep 'Self-test execution status.*in progress')" ];'''
-                                ' do sleep 10; done; smartctl -a {device}', devices=drive_devices,
-                                fail_pats=system_diagnostics['smart'].fail_pats_raw,
-                                pass_pats=system_diagnostics['smart'].pass_pats_raw)),
-))
+def format_skip(name, diagnose):
+    requires = ': requires ' + diagnose.requires if diagnose.requires else ''
+    return "SKIP {0}{1}".format(name, requires)
 
 
-def remove_skipped(diagnostics):
+def remove_skipped(diagnostics, reporter=None):
     new_diagnostics = []
     for name, diagnose in diagnostics.items():
         if diagnose.skip:
-            requires = ': requires ' + diagnose.requires if diagnose.requires else ''
-            print("SKIP {0}{1}".format(name, requires))
+            reporter.skip(name, diagnose) if reporter else print(format_skip(name, diagnose))
             continue
         new_diagnostics.append((name, diagnose))
     return OrderedDict(new_diagnostics)
 
 
-def start_parallel_diagnostics(diagnostics):
-    threads = []
-    for name, diagnose in diagnostics.items():
+def start_parallel_diagnostics(diagnostics, scheduler=None, on_result=None):
+    '''on_result(name, diagnose, failed, started, duration) is called as each one finishes.
+    The longest expected are started first (see DurationStats), the tasks are returned in
+    the order of diagnostics
+    '''
+    scheduler = scheduler or Scheduler()
+    tasks = {}
+    for name in durations.order(diagnostics):
+        diagnose = diagnostics[name]
         if diagnose.skip:
-            requires = ': requires ' + diagnose.requires if diagnose.requires else ''
-            print("SKIP {0}{1}".format(name, requires))
+            print(format_skip(name, diagnose))
             continue
-        threads.append(Thread.spawn(diagnose))
-    return threads
+        task = scheduler.submit(diagnose)
+        if on_result:
+            task.add_done_callback(
+                lambda t, name=name, diagnose=diagnose: t.exc_info or on_result(
+                    name, diagnose, t.output, t.started, t.finished - t.started))
+        tasks[name] = task
+    return [tasks[name] for name in diagnostics if name in tasks]
 
 
-def run_sequential_diagnostics(diagnostics):
-    return [d() for d in diagnostics.values()]
+def run_sequential_diagnostics(diagnostics, on_result=None):
+    results = []
+    for name, diagnose in diagnostics.items():
+        started = time.time()
+        results.append(diagnose())
+        if on_result:
+            on_result(name, diagnose, results[-1], started, time.time() - started)
+    return results
+
+
+class Result(object):
+    '''What run() yields: the outcome of a diagnostic, or of one of its commands that
+    did not pass.
+
+    :str status: PASS, FAIL, TIMEOUT, CANCELLED or SKIP
+    :str device: the device the command was run for, if any
+    :float duration: seconds the whole diagnostic took
+    :dict metrics: {name: number} found in its outputs, i.e. mem_percent or temperature
+    :tuple failures: the failing lines (or matches) as text
+    '''
+    __slots__ = ('name', 'status', 'cmd', 'device', 'duration', 'metrics', 'failures')
+
+    def __init__(self, name, status, cmd, device=None, duration=0.0, metrics=None,
+                 failures=()):
+        self.name = name
+        self.status = status
+        self.cmd = cmd
+        self.device = device
+        self.duration = duration
+        self.metrics = metrics or {}
+        self.failures = failures
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __repr__(self):
+        return 'Result({0}, {1}, {2})'.format(self.name, self.status, self.cmd)
+
+
+def _failure_text(match):
+    if isinstance(match, (list, tuple)):
+        return ' '.join(to_text(m) for m in match)
+    return to_text(match)
+
+
+def _results(name, diagnose, failed, duration, metrics):
+    '''the Results of a diagnostic: one PASS, or one for each command that did not pass'''
+    if not failed:
+        return [Result(name, 'PASS', cmdline(diagnose.cmd), None, duration, metrics)]
+    by_cmd = OrderedDict()
+    for failure in failed:
+        by_cmd.setdefault(failure.cmd, []).append(failure)
+    devices = {}
+    if diagnose.devices:
+        try:
+            devices = dict((cmdline(diagnose._format(d)), str(d)) for d in diagnose._get_devices())
+        except (CommandTimeout, RuntimeError):
+            pass
+    return [Result(name, get_status(failures), cmd, devices.get(cmd), duration, metrics,
+                   tuple(_failure_text(m) for f in failures for m in f.failures))
+            for cmd, failures in by_cmd.items()]
+
+
+def _run_one(name, diagnose):
+    metrics = {}
+    start = time.time()
+    try:
+        failed = diagnose() if isinstance(diagnose, DiagnoseLong) else diagnose(metrics)
+    except Exception as e:
+        _log.exception("{0} raised".format(name))
+        failed = [Failure(diagnose.cmd, [repr(e)])]
+    duration = time.time() - start
+    if get_status(failed) != 'CANCELLED':
+        durations.record(name, duration)
+    return _results(name, diagnose, failed, duration, metrics)
+
+
+def run(names=None, workers=None, diagnostics=None):
+    '''Run diagnostics in this process, for embedding diagnose in another program.
+
+    Yields Results as each diagnostic finishes: a PASS (or SKIP) for each one, or a Result
+    for each of its commands that did not pass. Nothing is printed. The longest expected
+    are started first, and the durations recorded in `durations`.
+
+    :list names: the diagnostics to run. Defaults to all of them
+    :int workers: maximum number of diagnostics to run at once (default: no limit)
+    :OrderedDict diagnostics: {name: Diagnose} to run. Defaults to system_diagnostics
+    '''
+    diagnostics = system_diagnostics if diagnostics is None else diagnostics
+    if names:
+        diagnostics = get_keys(diagnostics, *names)
+    rescan()
+    scheduler = Scheduler(workers)
+    finished, ready = collections.deque(), threading.Semaphore(0)
+
+    def done(task):
+        finished.append(task)
+        ready.release()
+
+    started = 0
+    for name in durations.order(diagnostics):  # longest first
+        diagnose = diagnostics[name]
+        diagnose.rescan()
+        if diagnose.skip:
+            yield Result(name, 'SKIP', cmdline(diagnose.cmd))
+            continue
+        scheduler.submit(_run_one, name, diagnose).add_done_callback(done)
+        started += 1
+    for _ in range(started):
+        ready.acquire()
+        for result in finished.popleft().join():
+            yield result
+
+
+def get_status(failed):
+    '''PASS, FAIL, CANCELLED or TIMEOUT (only if nothing actually failed) for a diagnostic's
+    results
+    '''
+    if not failed:
+        return 'PASS'
+    if not all(isinstance(f, Timeout) for f in failed):
+        return 'FAIL'
+    if any(isinstance(f, Cancelled) for f in failed):
+        return 'CANCELLED'
+    return 'TIMEOUT'
+
+
+def format_result(name, diagnose, failed):
+    if failed:
+        return "{0} {1}: {2}".format(get_status(failed), name, failed)
+    msg = ': ' + diagnose.msg if diagnose.msg else ''
+    return "PASS {0}{1}".format(name, msg)
 
 
 def print_results(diagnostics, results):
     for name, diagnose, failed in zip(diagnostics, diagnostics.values(), results):
-        if failed:
-            print("FAIL {0}: {1}".format(name, failed))
+        print(format_result(name, diagnose, failed))
+
+
+class Reporter(object):
+    '''Reports results for main. With stream, or as JSON lines, each result is reported as
+    soon as its diagnostic finishes. A summary in the order of the diagnostics follows each
+    group of them, or as JSON lines a single summary line once finish is called.
+    '''
+    def __init__(self, stream=False, json_lines=False, out=None):
+        self.stream = stream or json_lines
+        self.json_lines = json_lines
+        self.out = out or sys.stdout
+        self._lock = threading.Lock()
+        self._statuses = []  # [(name, status)] summarized by finish
+
+    def _write(self, line):
+        with self._lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+    def _json(self, record):
+        import json
+        self._write(json.dumps(record, sort_keys=True))
+
+    def info(self, line):
+        if not self.json_lines:
+            self._write(line)
+
+    def skip(self, name, diagnose):
+        if self.json_lines:
+            self._json({'name': name, 'status': 'SKIP', 'requires': diagnose.requires})
+        else:
+            self._write(format_skip(name, diagnose))
+
+    def __call__(self, name, diagnose, failed, started, duration):
+        if not self.stream:
+            return
+        if self.json_lines:
+            self._json({'name': name, 'status': get_status(failed), 'started': started,
+                        'duration': round(duration, 6),
+                        'failures': [f.to_dict() for f in failed or []]})
         else:
-            msg = ': ' + diagnose.msg if diagnose.msg else ''
-            print("PASS {0}{1}".format(name, msg))
+            self._write('{0} ({1:.3f}s)'.format(format_result(name, diagnose, failed), duration))
+
+    def summary(self, diagnostics, results):
+        if self.json_lines:
+            return self._statuses.extend(
+                (name, get_status(failed)) for name, failed in zip(diagnostics, results))
+        if self.stream and diagnostics:
+            self._write('# Summary')
+        for name, diagnose, failed in zip(diagnostics, diagnostics.values(), results):
+            self._write(format_result(name, diagnose, failed))
+
+    def profile(self, diagnostics, makespan=None):
+        '''write the profile of each of diagnostics (see Profiler) and the (predicted,
+        actual) makespan of the short diagnostics, as a table or as a JSON line'''
+        if self.json_lines:
+            record = {'profile': profiler.records(diagnostics)}
+            if makespan:
+                record['makespan'] = {'predicted': round(makespan[0], 6),
+                                      'actual': round(makespan[1], 6)}
+            return self._json(record)
+        self._write('# Profile')
+        for line in profiler.table(diagnostics):
+            self._write(line)
+        if makespan:
+            self._write('# makespan of the short diagnostics: predicted {0:.2f}s,'
+                        ' actual {1:.2f}s'.format(*makespan))
+
+    def finish(self):
+        '''write the summary line of everything summarized, as JSON lines'''
+        if self.json_lines:
+            counts = collections.Counter(status for _, status in self._statuses)
+            self._json({'summary': dict(counts), 'results': [
+                {'name': name, 'status': status} for (name, status) in self._statuses]})
+
+
+class FailureLimit(object):
+    '''Passes each result on to on_result and cancels the run (see cancel_run) as soon as
+    `limit` diagnostics have failed. Never cancels if limit is None.
+    '''
+    def __init__(self, limit=None, on_result=None):
+        self.limit = limit
+        self.on_result = on_result
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def reached(self):
+        return self.limit is not None and self.failures >= self.limit
+
+    def __call__(self, name, diagnose, failed, started, duration):
+        if self.on_result:
+            self.on_result(name, diagnose, failed, started, duration)
+        if get_status(failed) != 'FAIL':
+            return
+        with self._lock:
+            self.failures += 1
+            if self.failures != self.limit:
+                return
+        _log.debug("{0} diagnostics failed, cancelling the rest".format(self.failures))
+        cancel_run()
+
+
+def _watched(diagnose):
+    '''diagnose's results for watch, SKIP if it is skipped'''
+    return 'SKIP' if diagnose.skip else diagnose()
+
+
+def print_flushed(line):
+    '''print line now, also when stdout is a pipe or a file (i.e. the log of a daemon)'''
+    print(line)
+    sys.stdout.flush()
+
+
+def watch(diagnostics, scheduler=None, tick=1.0, ticks=None, emit=print_flushed,
+          rescan_interval=300.0):
+    '''Run each diagnostic every diagnose.interval seconds, emitting its result only when
+    its status changes (and the first time it runs). Runs forever if ticks is None.
+
+    Disks, programs and whether to skip each diagnostic are looked up again every
+    rescan_interval seconds, not every time they run.
+    '''
+    scheduler = scheduler or Scheduler()
+    wheel = TimerWheel(tick)
+    for name in diagnostics:
+        wheel.schedule(0, name)
+    statuses, running = {}, {}
+    start = time.time()
+    rescanned = None
+    while ticks is None or wheel.now < ticks:
+        time.sleep(max(0, start + (wheel.now + 1) * tick - time.time()))
+        due = [name for name in wheel.advance() if name not in running]
+        if due and (rescanned is None or time.time() - rescanned >= rescan_interval):
+            rescanned = time.time()
+            rescan()
+            for diagnose in diagnostics.values():
+                diagnose.rescan()
+        for name in due:
+            running[name] = scheduler.submit(_watched, diagnostics[name])
+        for name, task in list(running.items()):
+            if not task.done:
+                continue
+            del running[name]
+            diagnose = diagnostics[name]
+            try:
+                failed = task.join()
+            except Exception as e:
+                _log.exception("{0} raised".format(name))
+                failed = [Failure(name, [repr(e)])]
+            status = 'SKIP' if failed == 'SKIP' else get_status(failed)
+            if statuses.get(name) != status:
+                statuses[name] = status
+                emit(time.strftime('%Y-%m-%dT%H:%M:%S ') + (
+                     format_skip(name, diagnose) if status == 'SKIP'
+                     else format_result(name, diagnose, failed)))
+            wheel.schedule(diagnose.interval, name)
+    return statuses
+
+
+def terminal_width():
+    '''the columns of the terminal, like shutil.get_terminal_size (which is slow to import)'''
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        return os.get_terminal_size(sys.__stdout__.fileno()).columns
+    except (AttributeError, ValueError, OSError):  # python2, or not a terminal
+        return 80
 
 
 def main():
-    parser = argparse.ArgumentParser()
+    logging.basicConfig(level=logging.DEBUG)
+    # argparse makes a HelpFormatter for every argument added, each getting the width again
+    parser = argparse.ArgumentParser(formatter_class=functools.partial(
+        argparse.HelpFormatter, width=terminal_width() - 2))
     parser.add_argument('-s', '--short-names', nargs='+',
-                        help='list the short diagnostics you want to run. Choices are: {0}'.
-                        format(' '.join(system_diagnostics)))
+                        help='list the short diagnostics you want to run. Choices are: {0}'
+                             ' and those added by plugins'.format(' '.join(system_diagnostics)))
     parser.add_argument('-S', '--short', action='store_true', help='run all short diagnostics')
     parser.add_argument('-l', '--long-names', nargs='+',
-                        help='list the long diagnostics you want to run. Choices are: {0}'.
-                        format(' '.join(long_system_diagnostics)))
+                        help='list the long diagnostics you want to run. Choices are: {0}'
+                             ' and those added by plugins'.format(
+                                 ' '.join(long_system_diagnostics)))
     parser.add_argument('-L', '--long', action='store_true',
                         help='run all long diagnostics. These take 10s of minutes (up to an hour)'
                              ' and purposefully stress your system. Use these at your own risk!')
     parser.add_argument('--sequential', action='store_true', help='run ALL tests sequentially')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='maximum number of diagnostics to run at once (default: no limit)')
+    parser.add_argument('--device-workers', type=int, default=Diagnose.device_workers,
+                        help='maximum number of device commands (i.e. smartctl) each diagnostic'
+                             ' runs at once (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=Diagnose.default_timeout,
+                        help='seconds before a short diagnostic command is killed and reported'
+                             ' as TIMEOUT (default: %(default)s)')
+    parser.add_argument('--deadline', type=float,
+                        help='seconds the whole run may take. Commands still running at the'
+                             ' deadline are killed and reported as TIMEOUT')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only scan logs (dmesg, journalctl) written since the last'
+                             ' --incremental run')
+    parser.add_argument('--state-file', default='/var/lib/diagnose/state.json',
+                        help='where --incremental keeps its place (default: %(default)s)')
+    parser.add_argument('--keep-failures', action='store_true',
+                        help='with --incremental, keep reporting log failures found by earlier'
+                             ' runs until the next reboot')
+    parser.add_argument('--cache-ttl', type=float, default=cmd_cache.ttl,
+                        help='seconds that the output of a command is shared with checks calling'
+                             ' the same command (default: %(default)s)')
+    parser.add_argument('--max-age', type=float, metavar='SECONDS',
+                        help='reuse the results of slow drive checks (smart, hdparm) kept by runs'
+                             ' less than SECONDS ago, only running those that are stale')
+    parser.add_argument('--cache-dir', default=result_cache.path,
+                        help='where --max-age keeps results (default: %(default)s)')
+    parser.add_argument('--durations-file',
+                        help='where the duration of each diagnostic on this host is kept, so'
+                             ' that the longest can be started first, once one has run'
+                             ' (default: $DIAGNOSE_DURATIONS, or /var/lib/diagnose/durations)')
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+                        help='run diagnostics with a thread each or from one asyncio event loop'
+                             ' (python 3 only)'
+                             ' (default: %(default)s)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running the short diagnostics, each at its own interval,'
+                             ' printing only when their status changes')
+    parser.add_argument('--rescan-interval', type=float, default=300.0, metavar='SECONDS',
+                        help='with --watch, seconds between looking again for disks, programs'
+                             ' and which diagnostics to skip (default: %(default)s)')
+    parser.add_argument('--stream', action='store_true',
+                        help='print each result as soon as it finishes, followed by a summary')
+    parser.add_argument('--json', action='store_true',
+                        help='write results as JSON lines as they finish, with timing, followed'
+                             ' by a summary line')
+    parser.add_argument('--fail-fast', action='store_const', const=1, dest='max_failures',
+                        help='stop at the first failure, the same as --max-failures 1')
+    parser.add_argument('--max-failures', type=int, metavar='N',
+                        help='once N diagnostics have failed, kill the ones running, cancel the'
+                             ' rest and exit with a non-zero code')
+    parser.add_argument('--partition', action='store_true',
+                        help='run the stress-ng methods of cpu_burn and mem_burn at the same time,'
+                             ' each pinned to its own share of the CPUs of a NUMA node and sized'
+                             ' to its free memory')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time, subprocesses, output and child CPU and memory use'
+                             ' of each diagnostic after the results')
+    parser.add_argument('--profile-textfile', metavar='PATH',
+                        help='write the same measurements to PATH for the prometheus node'
+                             ' exporter textfile collector')
     args = parser.parse_args()
+    load_plugins()  # only once the arguments are good, plugins are not run for --help
+    if args.engine == 'asyncio' and import_asyncio() is None:
+        parser.error('--engine asyncio requires python 3')
+    profiler.enabled = bool(args.profile or args.profile_textfile)
+    cmd_cache.ttl = args.cache_ttl
+    result_cache.path, result_cache.max_age = args.cache_dir, args.max_age
+    if args.incremental:
+        state.load(args.state_file)
+    durations.load(args.durations_file
+                   or os.environ.get('DIAGNOSE_DURATIONS', '/var/lib/diagnose/durations'))
+    Cursor.keep_failures = args.keep_failures
+    deadline.start(args.deadline)
+    Diagnose.default_timeout = args.timeout
+    Diagnose.device_workers = 1 if args.sequential else args.device_workers
+    DiagnoseLong.partitioned = args.partition
+    scheduler = Scheduler(args.workers)
+    reporter = Reporter(stream=args.stream, json_lines=args.json)
+    on_result = FailureLimit(args.max_failures, durations.recorder(reporter))
+
+    profiled_diagnostics = OrderedDict()
+    makespan = None
 
     # parse and run short tests
     short_tests = []
@@ -508,12 +3567,22 @@ def main():
         short_tests = args.short_names
     if short_tests:
         diagnostics = get_keys(system_diagnostics, *short_tests)
-        diagnostics = remove_skipped(diagnostics)
+        if args.watch:  # which are skipped is checked as they run
+            return watch(diagnostics, Scheduler(1) if args.sequential else scheduler,
+                         rescan_interval=args.rescan_interval)
+        diagnostics = remove_skipped(diagnostics, reporter)
+        profiled_diagnostics.update(diagnostics)
+        predicted = durations.makespan(diagnostics, 1 if args.sequential else args.workers)
+        started = time.time()
         if args.sequential:
-            results = run_sequential_diagnostics(diagnostics)
+            results = run_sequential_diagnostics(diagnostics, on_result)
+        elif args.engine == 'asyncio':
+            results = AsyncEngine(args.workers, on_result).run(diagnostics)
         else:
-            results = [t.join() for t in start_parallel_diagnostics(diagnostics)]
-        print_results(diagnostics, results)
+            tasks = start_parallel_diagnostics(diagnostics, scheduler, on_result)
+            results = [t.join() for t in tasks]
+        makespan = predicted, time.time() - started
+        reporter.summary(diagnostics, results)
 
     # parse and run long tests
     long_tests = []
@@ -521,26 +3590,46 @@ def main():
         long_tests = list(long_system_diagnostics)
     elif args.long_names:
         long_tests = args.long_names
-    if long_tests:
-        print("# Running long tests, this could take a while...")
+    if long_tests and not on_result.reached:
+        reporter.info("# Running long tests, this could take a while...")
         diagnostics = get_keys(long_system_diagnostics, *long_tests)
+        diagnostics = remove_skipped(diagnostics, reporter)
+        profiled_diagnostics.update(diagnostics)
         parallel, sequential = OrderedDict(), OrderedDict()
         for k, d in diagnostics.items():
+            if isinstance(d, SmartTest):
+                d.on_progress = reporter.info
             if d.parallel:
                 parallel[k] = d
             else:
                 sequential[k] = d
-        if not args.sequential:
-            parallel_threads = start_parallel_diagnostics(parallel)
+        if args.engine == 'asyncio' and not args.sequential:
+            parallel_results, sequential_results = AsyncEngine(args.workers, on_result).run_groups(
+                (parallel, False), (sequential, True))
+            reporter.summary(sequential, sequential_results)
+        else:
+            if not args.sequential:
+                parallel_tasks = start_parallel_diagnostics(parallel, scheduler, on_result)
 
-        sequential_results = run_sequential_diagnostics(sequential)
-        print_results(sequential, sequential_results)
+            sequential_results = run_sequential_diagnostics(sequential, on_result)
+            reporter.summary(sequential, sequential_results)
 
-        if args.sequential:  # cmd line override
-            parallel_results = run_sequential_diagnostics(parallel)
-        else:
-            parallel_results = [t.join() for t in parallel_threads]
-        print_results(parallel, parallel_results)
+            if args.sequential:  # cmd line override
+                parallel_results = run_sequential_diagnostics(parallel, on_result)
+            else:
+                parallel_results = [t.join() for t in parallel_tasks]
+        reporter.summary(parallel, parallel_results)
+    if args.profile:
+        reporter.profile(profiled_diagnostics, makespan)
+    reporter.finish()
+
+    if args.profile_textfile:
+        write_atomic(args.profile_textfile,
+                     profiler.prometheus(profiled_diagnostics).encode())
+    state.save()
+    durations.save()
+    if on_result.reached:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
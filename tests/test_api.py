@@ -0,0 +1,76 @@
+import sys
+import time
+import diagnose as dg
+
+from .utils import pjoin, ex, run_tests
+
+
+def example(name):
+    with open(pjoin(ex, name), 'rb') as f:
+        return f.read()
+
+
+class RunTest(object):
+    '''run() yields a Result for each diagnostic as it finishes, or each command that failed'''
+    key = 'run'
+
+    def __call__(self):
+        diagnostics = dg.OrderedDict((
+            ('slow', dg.Diagnose(['sleep', '0.3'])),
+            ('drives', dg.Diagnose(['echo', '{device}'], devices=['/dev/sda', '/dev/sdb'],
+                                   fail_pats=['sdb'])),
+            ('skipped', dg.Diagnose('true', skip=lambda: True)),
+            ('memory', dg.Diagnose(['cat', pjoin(ex, 'memory.pass')],
+                                   process=dg.process_free_mem, metrics=dg.free_mem_metrics)),
+        ))
+        start = time.time()
+        results = list(dg.run(diagnostics=diagnostics))
+        assert time.time() - start < 1
+        assert (results[0].name, results[0].status) == ('skipped', 'SKIP')
+        assert (results[-1].name, results[-1].status) == ('slow', 'PASS')  # finished last
+        assert sorted((r.name, r.status) for r in results[1:3]) == [
+            ('drives', 'FAIL'), ('memory', 'PASS')]
+        drives = next(r for r in results if r.name == 'drives')
+        assert (drives.cmd, drives.device, drives.failures) == ('echo /dev/sdb', '/dev/sdb',
+                                                                ('sdb',))
+        memory = next(r for r in results if r.name == 'memory')
+        assert round(memory.metrics['mem_percent'], 1) == 19.2
+        assert memory.metrics['swap_percent'] == 0
+        assert results[-1].duration >= 0.3
+        assert not hasattr(results[0], '__dict__')
+        assert list(dg.run(['slow'], diagnostics=diagnostics))[0].name == 'slow'
+
+
+class MetricsTest(object):
+    '''numbers are parsed from the outputs of the diagnostics that have them'''
+    key = 'metrics'
+
+    def __call__(self):
+        assert dg.temperature_metrics(example('sensors.pass')) == {'temperature': 42}
+        assert dg.usage_metrics('disk_percent')(example('df.fail')) == {'disk_percent': 95}
+        assert dg.file_desc_usage.metrics(b'50670\nfs.file-max = 800056') == {
+            'file_desc_percent': 50670 * 100.0 / 800056}
+        metrics = {}
+        diagnose = dg.Diagnose(['echo', '{device}%'], devices=['10', '90', '40'],
+                               metrics=dg.usage_metrics('disk_percent'))
+        assert diagnose(metrics) == [] and metrics == {'disk_percent': 90}
+
+
+class ImportTest(object):
+    '''importing diagnose leaves the logging of the program embedding it alone'''
+    key = 'import'
+
+    def __call__(self):
+        code = 'import logging, diagnose; print(len(logging.getLogger().handlers))'
+        assert dg.call_cmd([sys.executable, '-c', code])[0].strip() == b'0'
+
+
+tests = [
+    RunTest(),
+    MetricsTest(),
+    ImportTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,113 @@
+import os
+import time
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+
+class SingleFlightTest(object):
+    '''concurrent callers of the same command share one subprocess'''
+    key = 'single_flight'
+
+    def __call__(self):
+        cache = dg.CommandCache(ttl=0)
+        cmd = 'sleep 0.2; echo $$'  # $$ is the pid of the shell running the command
+        outputs = dg.Scheduler().map(lambda _: cache.call(cmd)[0], range(5))
+        assert len(set(outputs)) == 1
+        assert cache.call(cmd)[0] != outputs[0]  # nothing is kept with a ttl of 0
+
+
+class TTLTest(object):
+    '''results are shared for ttl seconds'''
+    key = 'ttl'
+
+    def __call__(self):
+        cache = dg.CommandCache(ttl=0.3)
+        first = cache.call('echo $$')
+        assert cache.call('echo $$') == first
+        time.sleep(0.3)
+        assert cache.call('echo $$') != first
+        try:
+            cache.call('exit 3')
+        except RuntimeError:
+            pass
+        else:
+            assert False, "expected RuntimeError"
+        assert cache.call('exit 3', raise_on_error=False)[2] == 3
+
+
+class ResultCacheTest(object):
+    '''device outputs of commands that succeeded are kept by identity and only stale or
+    missing ones are run again'''
+    key = 'result_cache'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        original = dg.result_cache.path, dg.result_cache.max_age
+        try:
+            log = pjoin(tmp, 'log')
+            devices = [dg.Device('sda', 'sata', identity='WD-WCC4N1234567'),
+                       dg.Device('sdb', 'sata', identity='naa.5000c500a1b2c3d4'),
+                       dg.Device('sdc', 'sata')]
+            diagnose = dg.Diagnose('echo {device} >> ' + log + '; echo {device} checked',
+                                   devices=lambda: devices, fail_pats=['sdb'], cache='test')
+            dg.result_cache.path, dg.result_cache.max_age = pjoin(tmp, 'cache'), 60
+
+            assert [f.cmd for f in diagnose()] == ['echo /dev/sdb >> {0}; echo /dev/sdb checked'
+                                                   .format(log)]
+            assert sorted(os.listdir(dg.result_cache.path)) == [
+                'test@WD-WCC4N1234567', 'test@naa.5000c500a1b2c3d4']
+            devices[0].name, devices[0].path = 'sdd', '/dev/sdd'  # renamed across a reboot
+            dg.cmd_cache.clear()
+            assert len(diagnose()) == 1
+            with open(log) as f:
+                assert sorted(f.read().split()) == ['/dev/sda', '/dev/sdb', '/dev/sdc', '/dev/sdc']
+
+            stale = time.time() - 120
+            os.utime(pjoin(dg.result_cache.path, 'test@naa.5000c500a1b2c3d4'), (stale, stale))
+            dg.cmd_cache.clear()
+            diagnose()
+            with open(log) as f:
+                assert sorted(f.read().split()[4:]) == ['/dev/sdb', '/dev/sdc']
+
+            os.chmod(dg.result_cache.path, 0o777)  # results anyone could have planted
+            dg.cmd_cache.clear()
+            diagnose()
+            with open(log) as f:
+                assert len(f.read().split()) == 9
+            os.chmod(dg.result_cache.path, 0o700)
+
+            # failures and timeouts could be transient, so they are not kept
+            failing = dg.Diagnose('echo {device} >> ' + log + '; test {device} = /dev/sdd',
+                                  devices=lambda: devices, cache='rc')
+            timing_out = dg.Diagnose('echo {device} >> ' + log + '; sleep 1', timeout=0.1,
+                                     devices=lambda: devices[:1], cache='timeout')
+            for d in (failing, timing_out, failing, timing_out):
+                dg.cmd_cache.clear()
+                d()
+            assert [e for e in os.listdir(dg.result_cache.path) if '@' in e and
+                    not e.startswith('test@')] == ['rc@WD-WCC4N1234567']
+            with open(log) as f:
+                assert len(f.read().split()) == 9 + 3 + 1 + 2 + 1  # sdd is not run again
+
+            dg.result_cache.max_age = None
+            dg.cmd_cache.clear()
+            diagnose()
+            with open(log) as f:
+                assert len(f.read().split()) == 19
+        finally:
+            dg.result_cache.path, dg.result_cache.max_age = original
+            shutil.rmtree(tmp)
+
+
+tests = [
+    SingleFlightTest(),
+    TTLTest(),
+    ResultCacheTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+
+def make_sys_block(root):
+    '''a fake /sys with the devices in it, returning the path of its /sys/block'''
+    disks = {'sda': 'pci0000:00/0000:00:1f.2/ata1/host0/target0:0:0/0:0:0:0/block/sda',
+             'sdaa': 'pci0000:00/0000:03:00.0/host1/port-1:0/end_device-1:0/block/sdaa',
+             'sdb': 'pci0000:00/0000:00:14.0/usb1/1-1/host6/block/sdb',
+             'nvme0n1': 'pci0000:00/0000:01:00.0/nvme/nvme0/nvme0n1',
+             'loop0': 'virtual/block/loop0'}
+    flags = {'sda': ('1', '0'), 'sdaa': ('1', '0'), 'sdb': ('1', '1'), 'nvme0n1': ('0', '0')}
+    block = pjoin(root, 'block')
+    os.makedirs(block)
+    for name, path in disks.items():
+        path = pjoin(root, 'devices', path)
+        os.makedirs(pjoin(path, 'queue'))
+        rotational, removable = flags.get(name, ('0', '0'))
+        with open(pjoin(path, 'queue', 'rotational'), 'w') as f:
+            f.write(rotational + '\n')
+        with open(pjoin(path, 'removable'), 'w') as f:
+            f.write(removable + '\n')
+        os.symlink(path, pjoin(block, name))
+    with open(pjoin(block, 'nvme0n1', 'wwid'), 'w') as f:
+        f.write('eui.0025388b71b2c3d4\n')
+    os.makedirs(pjoin(block, 'sda', 'device'))
+    with open(pjoin(block, 'sda', 'device', 'serial'), 'w') as f:
+        f.write('WD-WCC4N1234567\n')
+    return block
+
+
+class ScanTest(object):
+    '''disks are classified from /sys/block and selected with a filter'''
+    key = 'scan'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            devices = dg.scan_block_devices(make_sys_block(tmp))
+        finally:
+            shutil.rmtree(tmp)
+        assert [(d.name, d.transport) for d in devices] == [
+            ('sda', 'sata'), ('sdb', 'usb'), ('sdaa', 'sas'), ('nvme0n1', 'nvme')]
+        assert devices[-1].rotational is False and devices[1].removable
+        assert [d.identity for d in devices] == [
+            'WD-WCC4N1234567', None, None, 'eui.0025388b71b2c3d4']
+
+        select = lambda **kwargs: [str(d) for d in devices if dg.Devices(**kwargs).select(d)]
+        assert select() == ['/dev/sda', '/dev/sdaa', '/dev/nvme0n1']
+        assert select(transports=('sata',)) == ['/dev/sda']
+        assert select(rotational=False) == ['/dev/nvme0n1']
+        assert select(removable=None) == ['/dev/sda', '/dev/sdb', '/dev/sdaa', '/dev/nvme0n1']
+
+        d = dg.Diagnose('smartctl -a {device}', devices=lambda: devices[:2])
+        assert d._get_commands() == ['smartctl -a /dev/sda', 'smartctl -a /dev/sdb']
+
+
+tests = [
+    ScanTest(),
+]
+
+
+def test_():
+    run_tests(tests)
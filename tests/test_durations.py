@@ -0,0 +1,95 @@
+import os
+import time
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+
+class OrderTest(object):
+    '''the longest expected are started first, new ones are estimated from what they do'''
+    key = 'durations_order'
+
+    def __call__(self):
+        stats = dg.DurationStats()
+        diagnostics = dg.OrderedDict((
+            ('quick', dg.Diagnose('true')),
+            ('drives', dg.Diagnose('true {device}', devices=['a', 'b'])),
+            ('stress', dg.DiagnoseLong('true')),
+            ('seen', dg.Diagnose('true')),
+        ))
+        assert stats.order(diagnostics) == ['stress', 'drives', 'quick', 'seen']
+        stats.record('seen', 2.0)
+        stats.record('stress', 1.0)
+        assert stats.order(diagnostics) == ['drives', 'seen', 'stress', 'quick']
+        stats.record('seen', 12.0)
+        assert abs(stats.estimate('seen', None) - 5.0) < 1e-9
+        assert stats.makespan(diagnostics) == 5.0
+        assert stats.makespan(diagnostics, 1) == 11.5
+        assert stats.makespan(diagnostics, 2) == 6.0  # drives | seen, stress, quick
+
+
+class FileTest(object):
+    '''durations are kept per host once a diagnostic has run, an unreadable file is the same
+    as none'''
+    key = 'durations_file'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = pjoin(tmp, 'durations')
+            stats = dg.DurationStats()
+            stats.load(path)
+            assert stats.data == {}
+            stats.save()
+            assert not os.path.exists(path)  # nothing ran
+            on_result = []
+            record = stats.recorder(lambda *args: on_result.append(args[0]))
+            record('ok', None, [], time.time(), 3.0)
+            record('cancelled', None, [dg.Cancelled('x')], time.time(), 0.0)
+            assert on_result == ['ok', 'cancelled']
+            stats.save()
+
+            loaded = dg.DurationStats()
+            loaded.load(path)
+            assert loaded.data == {stats.host: {'ok': 3.0}}
+            loaded.host = 'other'
+            assert loaded.estimate('ok', dg.Diagnose('true')) == 0.5
+
+            os.chmod(path, 0o666)  # anyone could have written it
+            loaded.load(path)
+            assert loaded.data == {}
+
+            with open(path) as f:
+                assert f.read() == '{0} ok 3.0\n'.format(stats.host)
+
+            # names can have spaces, a line that cannot be read does not lose the others
+            stats.record('site check', 2.5)
+            stats.save()
+            with open(path, 'a') as f:
+                f.write('garbled\nother ok nan?\n')
+            loaded.load(path)
+            assert loaded.data == {stats.host: {'ok': 3.0, 'site check': 2.5}}
+            stats.data.pop(stats.host).pop('site check')
+            stats.save()
+            with open(path, 'w') as f:
+                f.write('not durations')
+            loaded.load(path)
+            assert loaded.data == {}
+            os.chmod(tmp, 0o500)
+            loaded.record('ok', 1.0)
+            loaded.save()  # no error
+        finally:
+            os.chmod(tmp, 0o700)
+            shutil.rmtree(tmp)
+
+
+tests = [
+    OrderTest(),
+    FileTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+import diagnose as dg
+
+from .utils import run_tests
+
+
+def diagnostics():
+    return dg.OrderedDict((
+        ('devices', dg.Diagnose('echo {device}', devices=['sda', 'sdb', 'sdc'],
+                                fail_pats=['sdb'])),
+        ('sequential', dg.Diagnose('echo {device}', devices=['sda', 'sdb'], parallel=False,
+                                   pass_pats=['sd'])),
+        ('timeout', dg.Diagnose('sleep 5', timeout=0.2)),
+        ('long', dg.DiagnoseLong("echo 'unsuccessful run completed'; sleep 5",
+                                 fail_pats=['unsuccessful run completed'])),
+        ('checkers', dg.DiagnoseLong('sleep 5', loop_sleep=0.05,
+                                     checkers=[dg.Diagnose('echo hot', fail_pats=['hot'])])),
+        ('long_pass', dg.DiagnoseLong('echo {device}', devices=['a', 'b'])),
+        ('argv', dg.Diagnose(['echo', '{device}', "it's"], devices=['sda', 'sdb'],
+                             fail_pats=['sdb it'])),
+        ('pipe', dg.Diagnose(['printf', r'ok\nbad\n'], pipe=dg.grep_lines('^ok'),
+                             fail_pats=['bad'])),
+        ('missing', dg.Diagnose(['no-such-diagnose-command'], pass_pats=['.'])),
+    ))
+
+
+class EngineTest(object):
+    '''the asyncio engine gives the same results as calling the diagnostics'''
+    def __init__(self, workers):
+        self.workers = workers
+        self.key = 'asyncio_engine_{0}'.format(workers)
+
+    def __call__(self):
+        if dg.import_asyncio() is None:
+            return
+        start = time.time()
+        results = dg.AsyncEngine(self.workers).run(diagnostics())
+        assert time.time() - start < 3
+        assert repr(results) == repr([d() for d in diagnostics().values()])
+        assert [dg.get_status(r) for r in results] == [
+            'FAIL', 'PASS', 'TIMEOUT', 'FAIL', 'FAIL', 'PASS', 'FAIL', 'PASS', 'FAIL']
+        assert [f.cmd for f in results[6]] == ["echo sdb 'it'\"'\"'s'"]
+
+
+class ThreadsTest(object):
+    '''the asyncio engine runs commands without a thread for each'''
+    key = 'asyncio_threads'
+
+    def __call__(self):
+        if dg.import_asyncio() is None or not hasattr(os, 'pidfd_open'):
+            return
+        diagnostics = dg.OrderedDict(
+            ('diag{0}'.format(i), dg.Diagnose('sleep 0.3; echo {0} {{device}}'.format(i),
+                                              devices=[str(d) for d in range(10)]))
+            for i in range(3))
+        before, peak, stop = threading.active_count(), [0], threading.Event()
+
+        def sample():
+            while not stop.wait(0.01):
+                peak[0] = max(peak[0], threading.active_count())
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        try:
+            results = dg.AsyncEngine().run(diagnostics)
+        finally:
+            stop.set()
+            sampler.join()
+        assert results == [[], [], []]
+        assert peak[0] <= before + 1  # the sampler
+
+
+class ArgvTest(object):
+    '''argv commands run without a shell, shell strings still run with one'''
+    key = 'argv'
+
+    def __call__(self):
+        assert dg.call_cmd(['echo', '$HOME', '|', 'cat'])[0] == b'$HOME | cat\n'
+        assert dg.call_cmd('echo a | tr a b')[0] == b'b\n'
+        stdout, stderr, rc = dg.call_cmd(['no-such-diagnose-command'], raise_on_error=False)
+        assert (stdout, rc) == (b'', 127) and stderr
+        try:
+            dg.call_cmd(['sleep', '5'], timeout=0.1)
+        except dg.CommandTimeout as e:
+            assert str(e) == 'Command [sleep 5] timed out after 0.1s'
+        else:
+            assert False, "expected CommandTimeout"
+        assert len(dg.running) == 0
+        failed = dg.DiagnoseLong(['echo', 'hi $HOME'], fail_pats=['hi'], loop_sleep=0.01)()
+        assert [(f.cmd, f.failures) for f in failed] == [('echo \'hi $HOME\'', (b'hi',))]
+
+
+tests = [
+    ArgvTest(),
+    EngineTest(None),
+    EngineTest(1),
+    ThreadsTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,63 @@
+import time
+import diagnose as dg
+
+from .utils import run_tests
+
+
+class FailFastTest(object):
+    '''the first failure kills the long test running beside it and cancels the one waiting'''
+    def __init__(self, engine):
+        self.engine = engine
+        self.key = 'failfast_' + engine
+
+    def __call__(self):
+        if self.engine == 'asyncio' and dg.import_asyncio() is None:
+            return
+        diagnostics = dg.OrderedDict((
+            ('hang', dg.DiagnoseLong('sleep 30', loop_sleep=0.05)),
+            ('bad', dg.Diagnose('sleep 0.2; echo bad', fail_pats=['bad'])),
+            ('waiting', dg.Diagnose('true')),
+        ))
+        limit = dg.FailureLimit(1)
+        start = time.time()
+        try:
+            if self.engine == 'asyncio':
+                results = dg.AsyncEngine(2, limit).run(diagnostics)
+            else:
+                tasks = dg.start_parallel_diagnostics(diagnostics, dg.Scheduler(2), limit)
+                results = [t.join() for t in tasks]
+        finally:
+            dg.deadline.start(None)
+        assert time.time() - start < 5
+        assert limit.reached
+        assert [dg.get_status(r) for r in results] == ['CANCELLED', 'FAIL', 'CANCELLED']
+        assert len(dg.running) == 0
+
+
+class MaxFailuresTest(object):
+    '''the run is only cancelled once the limit is reached'''
+    key = 'max_failures'
+
+    def __call__(self):
+        limit = dg.FailureLimit(2)
+        try:
+            results = dg.run_sequential_diagnostics(dg.OrderedDict((
+                ('bad1', dg.Diagnose('echo bad', fail_pats=['bad'])),
+                ('timeout', dg.Diagnose('sleep 5', timeout=0.1)),
+                ('bad2', dg.Diagnose('echo bad', fail_pats=['bad'])),
+                ('after', dg.Diagnose('true')),
+            )), limit)
+        finally:
+            dg.deadline.start(None)
+        assert [dg.get_status(r) for r in results] == ['FAIL', 'TIMEOUT', 'FAIL', 'CANCELLED']
+
+
+tests = [
+    FailFastTest('thread'),
+    FailFastTest('asyncio'),
+    MaxFailuresTest(),
+]
+
+
+def test_():
+    run_tests(tests)
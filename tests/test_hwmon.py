@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+
+def write(path, value):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(value + '\n')
+
+
+def make_sys_class(root):
+    '''a fake /sys/class with coretemp and acpitz hwmon devices and two thermal zones, one
+    of them also registered as hwmon
+    '''
+    hwmon, thermal = pjoin(root, 'hwmon'), pjoin(root, 'thermal')
+    write(pjoin(hwmon, 'hwmon1', 'name'), 'coretemp')
+    for n, (label, temp) in enumerate([('Package id 0', '45000'), ('Core 0', '42000'),
+                                       ('Core 1', '43500')]):
+        attr = lambda a: pjoin(hwmon, 'hwmon1', 'temp{0}_{1}'.format(n + 1, a))
+        write(attr('label'), label)
+        write(attr('input'), temp)
+        write(attr('max'), '95000')
+        write(attr('crit'), '105000')
+    write(pjoin(hwmon, 'hwmon0', 'name'), 'acpitz')
+    write(pjoin(hwmon, 'hwmon0', 'temp1_input'), '27800')
+    write(pjoin(hwmon, 'hwmon0', 'temp1_crit'), '98000')
+    write(pjoin(thermal, 'thermal_zone0', 'type'), 'acpitz')
+    write(pjoin(thermal, 'thermal_zone0', 'temp'), '27800')
+    write(pjoin(thermal, 'thermal_zone1', 'type'), 'x86_pkg_temp')
+    write(pjoin(thermal, 'thermal_zone1', 'temp'), '50000')
+    write(pjoin(thermal, 'thermal_zone1', 'trip_point_0_type'), 'critical')
+    write(pjoin(thermal, 'thermal_zone1', 'trip_point_0_temp'), '100000')
+    return root
+
+
+class HwmonTest(object):
+    '''sensors are found once (until rescan), printed like `sensors` does and re-read on every
+    call'''
+    key = 'hwmon'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            root = make_sys_class(tmp)
+            collector = dg.HwmonCollector(root)
+            diagnose = dg.Diagnose('sensors', process=dg.process_temperatures, collect=collector,
+                                   skip=dg.Skip('which no-such-sensors-detect'))
+            assert not diagnose.skip
+            assert collector().decode('utf-8').split('\n') == [
+                u'acpitz',
+                u'temp1:  +27.8\xb0C  (crit = +98.0\xb0C)',
+                u'',
+                u'coretemp',
+                u'Package id 0:  +45.0\xb0C  (high = +95.0\xb0C, crit = +105.0\xb0C)',
+                u'Core 0:  +42.0\xb0C  (high = +95.0\xb0C, crit = +105.0\xb0C)',
+                u'Core 1:  +43.5\xb0C  (high = +95.0\xb0C, crit = +105.0\xb0C)',
+                u'',
+                u'x86_pkg_temp',
+                u'temp1:  +50.0\xb0C  (crit = +100.0\xb0C)',
+                u'']
+            assert diagnose() == []
+
+            write(pjoin(root, 'hwmon', 'hwmon1', 'temp3_input'), '96000')
+            failed = diagnose()
+            assert [f.failures for f in failed] == [
+                [u'Core 1:  +96.0\xb0C  (high = +95.0\xb0C, crit = +105.0\xb0C)']]
+            assert len(collector.sensors()) == 5
+
+            # readings are checked against the limits of their sensors, not parsed as text
+            get_info, dg.get_info = dg.get_info, None
+            try:
+                write(pjoin(root, 'hwmon', 'hwmon1', 'temp3_input'), '43500')
+                write(pjoin(root, 'hwmon', 'hwmon0', 'temp1_input'), '88500')  # crit - 10 = 88
+                readings = collector()
+                assert isinstance(readings, dg.Temperatures)
+                assert [(s.chip, s.label, d, s.limit) for s, d in readings.readings][:2] == [
+                    ('acpitz', 'temp1', 88.5, 88.0), ('coretemp', 'Package id 0', 45.0, 95.0)]
+                assert dg.process_temperatures(readings) == [
+                    [u'temp1:  +88.5\xb0C  (crit = +98.0\xb0C)']]
+                assert dg.temperature_metrics(readings) == {'temperature': 88.5}
+                assert collector.hottest() == (88.5, 88.0)
+            finally:
+                dg.get_info = get_info
+
+            # rescan closes the files of the sensors found so far and finds new ones
+            fds = len(os.listdir('/proc/self/fd'))
+            write(pjoin(root, 'hwmon', 'hwmon2', 'name'), 'nvme')
+            write(pjoin(root, 'hwmon', 'hwmon2', 'temp1_input'), '38000')
+            hwmon, dg.hwmon = dg.hwmon, collector
+            try:
+                dg.rescan()
+            finally:
+                dg.hwmon = hwmon
+            assert len(os.listdir('/proc/self/fd')) == fds - 5
+            assert [s.chip for s in collector.sensors()][-2:] == ['nvme', 'x86_pkg_temp']
+            assert len(os.listdir('/proc/self/fd')) == fds + 1
+            collector.close()
+            assert len(os.listdir('/proc/self/fd')) == fds - 5
+        finally:
+            shutil.rmtree(tmp)
+
+        empty = dg.HwmonCollector(tempfile.gettempdir() + '/no-such-sys-class')
+        assert not empty.available()
+        assert dg.Diagnose('sensors', collect=empty,
+                           skip=dg.Skip('which no-such-sensors-detect')).skip
+
+
+tests = [
+    HwmonTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+import diagnose as dg
+
+from .utils import run_tests
+
+
+@contextmanager
+def temp_state():
+    tmp = tempfile.mkdtemp()
+    try:
+        dg.state.load(os.path.join(tmp, 'state.json'))
+        yield
+    finally:
+        dg.state.path, dg.state.data = None, {}
+        dg.Cursor.keep_failures = False
+        shutil.rmtree(tmp)
+
+
+def dmesg(*lines):
+    return b''.join(b'[' + '{0:12.6f}'.format(t).encode() + b'] ' + m + b'\n' for t, m in lines)
+
+
+class DmesgCursorTest(object):
+    '''each run only scans kernel messages newer than the last one'''
+    key = 'dmesg_cursor'
+
+    def __call__(self):
+        obj = dg.Diagnose('dmesg', cursor=dg.DmesgCursor('dmesg'),
+                          fail_pats=[r'UncorrectableError'])
+        outputs = [dmesg((1.5, b'boot'), (2.0, b'UncorrectableError')),
+                   dmesg((1.5, b'boot'), (2.0, b'UncorrectableError'), (3.25, b'ok'))]
+        obj._call_subprocesses = lambda: [('dmesg', outputs[0])]
+        with temp_state():
+            assert obj()
+            obj._call_subprocesses = lambda: [('dmesg', outputs[1])]
+            assert not obj()
+            assert dg.state.get('dmesg')['position'] == 3.25
+            dg.Cursor.keep_failures = True
+            assert obj()  # the earlier failure is still reported
+            dg.state.save()
+            dg.state.load(dg.state.path)
+            assert dg.state.get('dmesg')['position'] == 3.25
+            # a matched line that is not utf-8 is still kept
+            obj = dg.Diagnose('dmesg', cursor=dg.DmesgCursor('dmesg'),
+                              fail_pats=[r'(UncorrectableError[^\n]*)'])
+            obj._call_subprocesses = lambda: [('dmesg', dmesg((4.0, b'UncorrectableError \xff')))]
+            assert obj()
+            assert dg.state.get('dmesg')['failures'][-1][1] == [u'UncorrectableError \ufffd']
+            dg.state.path = '/proc/no-such-dir/state.json'
+            dg.state.save()  # not saved, but no error
+
+
+class FindAfterTest(object):
+    '''the binary search finds the first message after a timestamp'''
+    key = 'find_after'
+
+    def __call__(self):
+        output = dmesg(*[(t * 0.5, b'message\ncontinued') for t in range(1000)])
+        for last in (-1, 0, 0.25, 0.5, 200.1, 499.5, 1000):
+            start = dg.DmesgCursor._find_after(output, last)
+            expected = [l for l in output.split(b'\n') if l.startswith(b'[')
+                        and float(l[1:13]) > last]
+            assert output[start:].startswith(expected[0] if expected else b'')
+            assert output[start:].count(b'[') == len(expected)
+
+
+class JournalCursorTest(object):
+    '''the journal cursor is passed to the next run and removed from the output'''
+    key = 'journal_cursor'
+
+    def __call__(self):
+        obj = dg.system_diagnostics['journalctl']
+        with temp_state():
+            assert obj._get_commands()[0].endswith('--show-cursor')
+            obj._call_subprocesses = lambda: [('journalctl', b'-- No entries --\n'
+                                               b'-- cursor: s=ab;i=1\n')]
+            try:
+                assert not obj()
+            finally:
+                del obj._call_subprocesses
+            assert obj._get_commands()[0].endswith("--after-cursor 's=ab;i=1'")
+
+
+tests = [
+    DmesgCursorTest(),
+    FindAfterTest(),
+    JournalCursorTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -1,40 +1,80 @@
 from __future__ import print_function
 
+import io
+import os
+import re
 import time
 import glob
+import shutil
+import tempfile
 from contextlib import contextmanager
 import diagnose as dg
 
 from .utils import pjoin, ex, run_tests
 
 
+@contextmanager
+def mock_smart(obj, result_path):
+    '''a drive that starts its test at once and finishes it with the output at result_path'''
+    def smartctl(cmd):
+        if cmd.startswith('smartctl -a'):
+            with open(result_path, 'rb') as f:
+                return f.read()
+        if cmd.startswith('smartctl -t'):
+            return b'Testing has begun.\n'
+        return b'Self-test execution status:      (   0)\tThe previous self-test routine\n'
+
+    original = obj._smartctl, obj._get_devices, obj.poll_interval
+    try:
+        obj._smartctl = smartctl
+        obj._get_devices = lambda: ['/dev/mocked']
+        obj.poll_interval = 0
+        yield
+    finally:
+        obj._smartctl, obj._get_devices, obj.poll_interval = original
+
+
 @contextmanager
 def mock_long(obj, result_path, name='mocked'):
+    if isinstance(obj, dg.SmartTest):
+        with mock_smart(obj, result_path):
+            yield
+        return
     class Popen(object):
+        pid = None
+
+        def __init__(self):
+            with open(result_path, 'rb') as f:
+                self.stdout = io.BytesIO(f.read())
+            self.stderr = io.BytesIO()
+
         def kill(self):
             raise RuntimeError("kill called")
 
-        def communicate(self):
-            with open(result_path, 'rb') as f:
-                return f.read(), None
+        def wait(self):
+            return 0
 
         def poll(self):
             return True
 
-    def _popen_all():
+    def _popen_all(cmds):
         return [(name, Popen())]
 
-    original = obj._popen_all
+    original = obj._popen_all, obj._get_batches
     original_checkers = obj.checkers
+    original_setup = obj.setup, obj.teardown
     original_sleep = time.sleep
     try:
         time.sleep = lambda t: None
         obj._popen_all = _popen_all
+        obj._get_batches = lambda: [[name]]
         obj.checkers = []
+        obj.setup = obj.teardown = None
         yield
     finally:
-        obj._popen_all = original
+        obj._popen_all, obj._get_batches = original
         obj.checkers = original_checkers
+        obj.setup, obj.teardown = original_setup
         time.sleep = original_sleep
 
 
@@ -57,7 +97,164 @@ class LongTest(object):
                 result = obj()
                 assert result
 
+class StreamTest(object):
+    '''a fail pattern kills a long test as soon as it is printed'''
+    key = 'stream'
+
+    def __call__(self):
+        obj = dg.DiagnoseLong("echo start; echo 'unsuccessful run completed'; sleep 10",
+                              fail_pats=['unsuccessful run completed'])
+        start = time.time()
+        result = obj()
+        assert time.time() - start < 5
+        assert result and result[0].failures == (b'unsuccessful run completed',)
+
+
+class BoundedStreamTest(object):
+    '''matches spanning chunks are found while only the ends of the output are kept'''
+    key = 'bounded_stream'
+
+    def __call__(self):
+        pats = dg.PatternSet([br'(ERROR\nat line \d+)'], re.M)
+        data = b'filler line\n' * 100000 + b'ERROR\nat line 12\n' + b'filler line\n' * 100000
+        class SmallScanner(dg.StreamScanner):
+            keep = 1000
+        scanner = SmallScanner(io.BytesIO(data), pats).join()
+        assert scanner.findall() == [(b'ERROR\nat line 12',)]
+        assert scanner.size == len(data)
+        assert len(scanner.output) < 2100
+
+
+class MonitorTest(object):
+    '''checkers run on their own thread, faster as it gets hotter, and kill the test at once'''
+    key = 'monitor'
+
+    def __call__(self):
+        temperatures = iter(range(80, 200))
+        calls = []
+
+        def checker():
+            calls.append(time.time())
+            return [dg.Failure('checker', ['too hot'])] if len(calls) == 8 else []
+        obj = dg.DiagnoseLong('sleep 30', checkers=[checker], loop_sleep=0.2,
+                              sample=lambda: (next(temperatures), 95))
+        start = time.time()
+        result = obj()
+        assert time.time() - start < 5
+        assert len(result) == 1
+        too_hot, summary = result[0].failures
+        assert too_hot == 'too hot'
+        assert summary.startswith('peak 87.0C, trend +') and summary.endswith(' over 8 samples')
+        assert calls[-1] - calls[-2] < calls[1] - calls[0]
+
+        monitor = obj.monitor()
+        assert monitor.times.typecode == monitor.temperatures.typecode == 'd'
+        assert monitor.next_interval(None) == monitor.next_interval((80, 95)) == 0.2
+        assert monitor.next_interval((95, 95)) == monitor.next_interval((99, 95)) == 0.05
+
+
+class SmartProgressTest(object):
+    '''all drives test at once, each reported when it finishes along with the ETA of the
+    rest, and checked with the patterns of the registered smart_test'''
+    key = 'smart_progress'
+
+    def __call__(self):
+        # percent of the test remaining on each poll, None once it is done
+        progress = {'/dev/sda': [90, None], '/dev/sdb': [90, 50, 20, None],
+                    '/dev/nvme0n1': [80, 40, 20, 10, None], '/dev/nvme1n1': [80, 40, 20, 10, None]}
+        results = {'/dev/sda': 'smart_test.pass', '/dev/sdb': 'smart_test.fail',
+                   '/dev/nvme0n1': 'smart_test.pass_nvme', '/dev/nvme1n1': 'smart_test.fail_nvme'}
+        started, reported = [], []
+
+        def smartctl(cmd):
+            device = cmd.split()[-1]
+            if cmd.startswith('smartctl -t'):
+                started.append(device)
+                return b'Testing has begun.\n'
+            if cmd.startswith('smartctl -c -l selftest'):
+                remaining = progress[device].pop(0)
+                if device.startswith('/dev/nvme'):  # only in the self-test log
+                    return (b'Self-test status: No self-test in progress\n' if remaining is None
+                            else 'Self-test status: Extended self-test in progress ({0}% '
+                                 'completed)\n'.format(100 - remaining).encode())
+                status = 0 if remaining is None else 0xf0 + remaining // 10
+                return ('Self-test execution status:      ({0:>4d})\n'
+                        'Extended self-test routine\n'
+                        'recommended polling time:        (  10) minutes.\n'.format(status)
+                        ).encode()
+            with open(pjoin(ex, results[device]), 'rb') as f:
+                return f.read()
+
+        registered = dg.long_system_diagnostics['smart_test']
+        obj = dg.SmartTest(devices=sorted(progress), poll_interval=0.01,
+                           skip_pats=registered.skip_pats_raw,
+                           fail_pats=registered.fail_pats_raw,
+                           pass_pats=registered.pass_pats_raw, on_progress=reported.append)
+        obj._smartctl = smartctl
+        result = obj()
+        assert sorted(started) == sorted(progress)
+        assert [f.cmd for f in result] == ['smartctl -a /dev/sdb', 'smartctl -a /dev/nvme1n1']
+        assert result[1].failures == (b'Completed: failed segments            6121          1932'
+                                      b'     1   3   -    -',)
+        assert reported[0].startswith('smart_test /dev/sda: PASS (1 of 4 drives done, ETA 0h')
+        assert reported[1].startswith('smart_test /dev/sdb: FAIL (2 of 4 drives done, ETA 0h')
+        assert reported[2].startswith('smart_test /dev/nvme0n1: PASS (3 of 4 drives done, ETA')
+        assert reported[3] == 'smart_test /dev/nvme1n1: FAIL (4 of 4 drives done)'
+        assert dg.self_test_remaining(b'Self-test status: Extended self-test in progress '
+                                      b'(12% completed)') == 88
+
+
+class SmartTimeoutTest(object):
+    '''a hung poll is retried, and every drive's test is aborted when it times out or the
+    run is cancelled'''
+    key = 'smart_timeout'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        path, timeout = os.environ['PATH'], dg.Diagnose.default_timeout
+        try:
+            log = pjoin(tmp, 'log')
+            with open(pjoin(tmp, 'smartctl'), 'w') as f:
+                f.write('#!/bin/sh\n'
+                        'case "$1" in\n'
+                        '  -t) echo Testing has begun. ;;\n'
+                        '  -c) sleep 5 ;;\n'
+                        '  -X) echo "$2" >> {0} ;;\n'
+                        'esac\n'.format(log))
+            os.chmod(pjoin(tmp, 'smartctl'), 0o755)
+            os.environ['PATH'] = tmp + os.pathsep + path
+            dg.Diagnose.default_timeout = 0.2
+            obj = dg.SmartTest(devices=['/dev/sda', '/dev/sdb'], poll_interval=0.01,
+                               timeout=0.5, on_progress=lambda msg: None)
+            assert dg.get_status(obj()) == 'TIMEOUT'
+            with open(log) as f:
+                assert sorted(f.read().split()) == ['/dev/sda', '/dev/sdb']
+
+            def devices():  # i.e. the `ls /dev/sd*` fallback timed out
+                raise dg.CommandTimeout('ls /dev/sd*', 0.2)
+            assert dg.get_status(dg.SmartTest(devices=devices)()) == 'TIMEOUT'
+
+            # cancelling wakes the poller up instead of waiting for the next poll
+            task = dg.Scheduler().submit(dg.SmartTest(devices=['/dev/sda'], poll_interval=30))
+            time.sleep(0.3)
+            cancelled = time.time()
+            dg.cancel_run()
+            assert dg.get_status(task.join(5)) == 'CANCELLED'
+            assert time.time() - cancelled < 2
+            with open(log) as f:
+                assert f.read().split()[-1] == '/dev/sda'
+        finally:
+            os.environ['PATH'], dg.Diagnose.default_timeout = path, timeout
+            dg.deadline.start(None)
+            shutil.rmtree(tmp)
+
+
 tests = [
+    StreamTest(),
+    SmartProgressTest(),
+    SmartTimeoutTest(),
+    MonitorTest(),
+    BoundedStreamTest(),
     LongTest('cpu_burn'),
     LongTest('mem_burn'),
     LongTest('smart_test'),
@@ -0,0 +1,94 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+MOUNTINFO = '''\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro
+23 22 0:21 / /proc rw,nosuid,nodev,noexec,relatime shared:12 - proc proc rw
+24 22 0:5 / /dev rw,nosuid,relatime shared:2 - devtmpfs udev rw,size=8152344k,mode=755
+40 22 8:17 / /srv/my\\040data rw,relatime shared:20 - xfs /dev/sdb1 rw,attr2,inode64
+41 22 0:45 / /mnt/nfs rw,relatime shared:21 - nfs4 server:/export rw,vers=4.2
+42 22 8:33 / /srv/my\\040data rw,relatime shared:22 - xfs /dev/sdc1 rw,attr2,inode64
+'''
+
+
+class StatvfsResult(object):
+    f_frsize = 4096
+    f_blocks, f_bfree, f_bavail = 1000, 40, 20
+    f_files, f_ffree = 500, 400
+
+
+class MountsTest(object):
+    '''mounts holding data are statted once for df and df_inode, a stuck one times out alone'''
+    key = 'mounts'
+
+    def __call__(self):
+        mounts = dg.parse_mountinfo(MOUNTINFO.encode())
+        assert [(m.path, m.fstype, m.source) for m in mounts] == [
+            ('/', 'ext4', '/dev/sda1'), ('/dev', 'devtmpfs', 'udev'),
+            ('/mnt/nfs', 'nfs4', 'server:/export'), ('/srv/my data', 'xfs', '/dev/sdc1')]
+
+        tmp = tempfile.mkdtemp()
+        calls, release = [], threading.Event()
+
+        def statvfs(path):
+            calls.append(path)
+            if path == '/mnt/nfs':
+                release.wait()
+            result = StatvfsResult()
+            if path == '/dev':
+                result.f_blocks = 0
+            return result
+        original = os.statvfs
+        try:
+            with open(pjoin(tmp, 'mountinfo'), 'w') as f:
+                f.write(MOUNTINFO)
+            os.statvfs = statvfs
+            collector = dg.StatvfsCollector(pjoin(tmp, 'mountinfo'), timeout=0.2)
+            df = dg.Diagnose('df', fail_pats=[r'((?:9[5-9]|100)%.*$)'], collect=collector.blocks)
+            df_inode = dg.Diagnose('df -i', fail_pats=[r'((?:[7-9]\d|100)%.*$)'],
+                                   collect=collector.inodes)
+            start = time.time()
+            failed = df()
+            assert time.time() - start < 1
+            assert [(f.status, f.cmd) for f in failed] == [
+                ('FAIL', 'df /'), ('TIMEOUT', 'df /mnt/nfs'), ('FAIL', 'df /srv/my data')]
+            assert failed[0].failures == (b'98% /',)
+            assert collector.blocks.collect().split(b'\n')[0] == b'/dev/sda1 4000 3840 80 98% /'
+            assert [(f.status, f.cmd) for f in df_inode()] == [('TIMEOUT', 'df -i /mnt/nfs')]
+            blocks = collector.blocks.outputs()  # as df and df_inode run at the same time
+            collector.inodes.outputs()
+            assert [o.failure().cmd for _, o in blocks if isinstance(o, dg.CommandTimeout)] == [
+                'df /mnt/nfs']
+            assert sorted(calls) == ['/', '/dev', '/mnt/nfs', '/srv/my data']
+
+            collector._stats = None  # the next pass does not wait for the stuck mount again
+            start = time.time()
+            assert [f.cmd for f in df() if f.status == 'TIMEOUT'] == ['df /mnt/nfs']
+            assert time.time() - start < 0.1
+            assert calls.count('/mnt/nfs') == 1
+
+            # without a timeout of its own, a mount gets the timeout of the diagnostic
+            collector = dg.StatvfsCollector(pjoin(tmp, 'mountinfo'))
+            df = dg.Diagnose('df', collect=collector.blocks, timeout=0.3)
+            start = time.time()
+            assert [f.failures for f in df() if f.status == 'TIMEOUT'] == [[['killed after 0.3s']]]
+            assert time.time() - start < 1
+        finally:
+            release.set()
+            os.statvfs = original
+            shutil.rmtree(tmp)
+
+
+tests = [
+    MountsTest(),
+]
+
+
+def test_():
+    run_tests(tests)
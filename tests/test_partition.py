@@ -0,0 +1,155 @@
+import os
+import time
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+GB = 1 << 30
+
+
+def make_nodes(root):
+    '''a fake /sys/devices/system/node with two nodes of 4 cpus, with 8 and 4GB free'''
+    for node, cpulist, free in (('node0', '0-3', 8 * GB), ('node1', '4-7', 4 * GB)):
+        os.makedirs(pjoin(root, node))
+        with open(pjoin(root, node, 'cpulist'), 'w') as f:
+            f.write(cpulist + '\n')
+        with open(pjoin(root, node, 'meminfo'), 'w') as f:
+            f.write('Node {0} MemTotal: {1} kB\nNode {0} MemFree: {2} kB\n'.format(
+                    node[4:], 2 * free // 1024, free // 1024))
+    return root
+
+
+class SplitTest(object):
+    '''nodes are shared out among the methods by their cpus'''
+    key = 'split'
+
+    def __call__(self):
+        assert dg.parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+        assert dg.format_cpulist([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+        tmp = tempfile.mkdtemp()
+        try:
+            partitions = dg.CpuPartitions(make_nodes(tmp), memory_fraction=1, cpus=range(8))
+            split = lambda n: [(dg.format_cpulist(p.cpus), p.memory // GB)
+                               for p in partitions.split(n)]
+            assert split(1) == [('0-7', 12)]
+            assert split(2) == [('0-3', 8), ('4-7', 4)]
+            assert split(3) == [('0-1', 4), ('2-3', 4), ('4-7', 4)]
+            assert len(split(20)) == 8
+            allowed = dg.CpuPartitions(tmp, memory_fraction=1, cpus=[1, 2, 5])
+            assert [p.cpus for p in allowed.split(2)] == [[1, 2], [5]]
+            assert partitions.split(2)[1].options() == {
+                'workers': 4, 'affinity': ' --taskset 4-7', 'memory': ' --vm-bytes 1048576k'}
+        finally:
+            shutil.rmtree(tmp)
+
+
+class PartitionedTest(object):
+    '''partitioned methods run at the same time, failures are still per method'''
+    key = 'partitioned'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            partitions = dg.CpuPartitions(make_nodes(tmp), cpus=range(8), max_partitions=2)
+            obj = dg.DiagnoseLong('sleep 0.5; echo {device} {workers}{affinity}',
+                                  devices=['a', 'b', 'c'], fail_pats=[r'^b \d'],
+                                  partitions=partitions, loop_sleep=0.05)
+            assert obj._get_batches() == [['sleep 0.5; echo a {workers}{affinity}'
+                                           .format(**obj.unpartitioned)],
+                                          ['sleep 0.5; echo b {workers}{affinity}'
+                                           .format(**obj.unpartitioned)],
+                                          ['sleep 0.5; echo c {workers}{affinity}'
+                                           .format(**obj.unpartitioned)]]
+            obj.partitioned = True
+            assert obj._get_batches() == [
+                ['sleep 0.5; echo a 4 --taskset 0-3', 'sleep 0.5; echo b 4 --taskset 4-7'],
+                ['sleep 0.5; echo c 4 --taskset 0-3']]
+            start = time.time()
+            result = obj()
+            assert time.time() - start < 1.0
+            assert [(f.cmd, f.failures) for f in result] == [
+                ('sleep 0.5; echo b 4 --taskset 4-7', (b'b 4',))]
+        finally:
+            shutil.rmtree(tmp)
+
+
+class SetupTest(object):
+    '''setup runs once before the test, teardown once after it, even when it or the setup
+    fails, with either engine. Neither runs once the run is cancelled'''
+    def __init__(self, engine):
+        self.engine = engine
+        self.key = 'setup_' + engine
+
+    def run(self, obj):
+        if self.engine == 'asyncio':
+            return dg.AsyncEngine().run(dg.OrderedDict([('long', obj)]))[0]
+        return obj()
+
+    def __call__(self):
+        if self.engine == 'asyncio' and dg.import_asyncio() is None:
+            return
+        tmp = tempfile.mkdtemp()
+        try:
+            log = pjoin(tmp, 'log')
+            obj = dg.DiagnoseLong('echo {device} >> ' + log + '; echo {device}',
+                                  devices=['a', 'fail', 'b'],
+                                  setup='echo setup >> ' + log,
+                                  teardown='echo teardown >> ' + log, fail_pats=['fail'])
+            assert self.run(obj)
+            with open(log) as f:
+                assert f.read().split() == ['setup', 'a', 'fail', 'teardown']
+            failing = dg.DiagnoseLong('echo test >> ' + log,
+                                      setup='echo partly >> {0}; exit 1'.format(log),
+                                      teardown='echo restored >> ' + log)
+            assert dg.get_status(self.run(failing)) == 'FAIL'
+            with open(log) as f:
+                assert f.read().split()[-2:] == ['partly', 'restored']
+
+            with open(log) as f:
+                before = f.read()
+            dg.cancel_run()
+            assert dg.get_status(self.run(failing)) == 'CANCELLED'
+            with open(log) as f:
+                assert f.read() == before
+        finally:
+            dg.deadline.start(None)
+            shutil.rmtree(tmp)
+
+
+class CancelledTeardownTest(object):
+    '''the teardown still runs once the deadline has passed or the run is cancelled'''
+    key = 'cancelled_teardown'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            log = pjoin(tmp, 'log')
+            obj = dg.DiagnoseLong('sleep 30', setup='echo setup >> ' + log,
+                                  teardown='echo teardown >> ' + log, loop_sleep=0.05)
+            dg.deadline.start(0.5)
+            assert dg.get_status(obj()) == 'TIMEOUT'
+            dg.deadline.start(None)
+            task = dg.Scheduler().submit(obj)
+            time.sleep(0.5)
+            dg.cancel_run()
+            assert dg.get_status(task.join(5)) == 'CANCELLED'
+            with open(log) as f:
+                assert f.read().split() == ['setup', 'teardown'] * 2
+        finally:
+            dg.deadline.start(None)
+            shutil.rmtree(tmp)
+
+
+tests = [
+    SplitTest(),
+    PartitionedTest(),
+    SetupTest('thread'),
+    SetupTest('asyncio'),
+    CancelledTeardownTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,42 @@
+import re
+import glob
+import diagnose as dg
+
+from .utils import pjoin, ex, run_tests
+
+
+class PatternSetTest(object):
+    '''PatternSet finds exactly what match_pats finds on every example'''
+    def __init__(self, key):
+        self.key = key
+
+    def __call__(self):
+        obj = dg.system_diagnostics.get(self.key) or dg.long_system_diagnostics[self.key]
+        for test_file in glob.glob(pjoin(ex, self.key) + '.*'):
+            with open(test_file, 'rb') as f:
+                text = f.read()
+            for pats in (obj.skip_pats, obj.fail_pats, obj.pass_pats):
+                if pats:
+                    assert pats.findall(text) == dg.match_pats(pats.pats, text)
+                    assert pats.search(text) == bool(dg.match_pats(pats.pats, text))
+
+
+class OverlapTest(object):
+    '''overlapping patterns are each found at their own first match'''
+    key = 'overlap'
+
+    def __call__(self):
+        raw = [b'(b+)', b'(ab)(b)', b'x(?=y)', b'^(c)$', b'(?<!not)\\s(locked)']
+        pats = dg.PatternSet(raw, re.S + re.M)
+        for text in (b'abbb', b'xy abb\nc\n', b'not locked but locked', b'', b'zzz'):
+            assert pats.findall(text) == dg.match_pats(pats.pats, text), text
+
+
+tests = [PatternSetTest(key) for key in dg.system_diagnostics] + [
+    PatternSetTest('smart_test'),
+    OverlapTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import run_tests
+
+
+class CollectorTest(object):
+    '''collectors read /proc in-process and feed the same processing as the commands'''
+    def __init__(self, key):
+        self.key = key
+
+    def __call__(self):
+        obj = dg.system_diagnostics[self.key]
+        if not obj.collect.available():
+            return
+        (name, output), = obj._call_subprocesses()
+        assert name == obj.collect.name
+        assert isinstance(obj.process(output), list)
+
+
+class FallbackTest(object):
+    '''the command is used when the collector's files do not exist'''
+    key = 'fallback'
+
+    def __call__(self):
+        collect = dg.Collector(lambda: b'never', '/proc/does/not/exist')
+        d = dg.Diagnose('echo fallback', collect=collect, skip=dg.Skip('which doesnotexist'))
+        assert d._call_subprocesses() == [('echo fallback', b'fallback\n')]
+        assert d.skip
+
+
+class MemoryTableTest(object):
+    '''/proc/meminfo is formatted with the rows and columns process_free_mem reads'''
+    key = 'memory_table'
+
+    def __call__(self):
+        if not os.path.exists('/proc/meminfo'):
+            return
+        lines = dg.collect_memory().decode().split('\n')
+        assert lines[0].split()[:3] == ['total', 'used', 'free']
+        assert lines[1].startswith('Mem:') and lines[2].startswith('Swap:')
+
+
+MEMINFO = '''MemTotal:       16384000 kB
+MemFree:         1024000 kB
+MemAvailable:    {available} kB
+Buffers:          102400 kB
+Cached:          2048000 kB
+SwapCached:            0 kB
+Shmem:             51200 kB
+SReclaimable:     102400 kB
+SwapTotal:       2048000 kB
+SwapFree:        {swap_free} kB
+'''
+
+
+class FixtureTest(object):
+    '''usage is computed from fixture /proc files and checked against the thresholds'''
+    key = 'procfs_fixtures'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            self.memory(tmp)
+            self.file_desc(tmp)
+            self.threads(tmp)
+        finally:
+            shutil.rmtree(tmp)
+
+    @staticmethod
+    def write(tmp, name, text):
+        path = os.path.join(tmp, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def memory(self, tmp):
+        path = self.write(tmp, 'meminfo', MEMINFO.format(available=3276800, swap_free=1536000))
+        output = dg.collect_memory(path)
+        lines = [l.split() for l in output.decode().split('\n') if l]
+        assert lines[1] == ['Mem:', '16000', '12800', '1000', '50', '2200', '3200']
+        assert lines[2] == ['Swap:', '2000', '500', '1500']
+        assert dg.free_mem_usage(output) == (0.8, 0.25)
+        assert dg.process_free_mem(output) == []
+        assert dg.free_mem_metrics(output) == {'mem_percent': 80.0, 'swap_percent': 25.0}
+
+        path = self.write(tmp, 'meminfo', MEMINFO.format(available=1024000, swap_free=1024000))
+        output = dg.collect_memory(path)
+        assert dg.free_mem_usage(output) == (0.9375, 0.5)
+        assert dg.process_free_mem(output) == [['mem usage > 90%'], ['swap usage > 25%']]
+
+        # kernels before 3.14 have no MemAvailable: free + buffers/cache is used instead
+        text = MEMINFO.replace('MemAvailable:    {available} kB\n', '')
+        path = self.write(tmp, 'meminfo', text.format(swap_free=2048000))
+        output = dg.collect_memory(path)
+        assert dg.free_mem_usage(output) == (12800 / 16000.0, 0.0)
+
+    def file_desc(self, tmp):
+        usage = dg.file_desc_usage
+        output = dg.collect_file_desc(self.write(tmp, 'file-nr', '7008\t1008\t100000\n'))
+        assert output == b'6000\n100000\n'
+        assert usage.usage(output) == 0.06
+        assert usage(output) == []
+        assert usage.metrics(output) == {'file_desc_percent': 6.0}
+
+        output = dg.collect_file_desc(self.write(tmp, 'file-nr', '75000\t0\t100000\n'))
+        assert usage(output) == [['file_desc > 70%']]
+
+    def threads(self, tmp):
+        output = dg.collect_threads(self.write(tmp, 'loadavg', '0.50 0.40 0.30 3/1234 5678\n'))
+        threads, limit = output.split()
+        assert int(threads) == 1234 and int(limit) > 0
+        usage = dg.ProcessCurrentMax('threads', 0.7)
+        assert usage(b'1234\n10000\n') == []
+        assert usage(b'7001\n10000\n') == [['threads > 70%']]
+
+
+tests = [
+    CollectorTest('file_desc'),
+    CollectorTest('threads'),
+    CollectorTest('memory'),
+    FallbackTest(),
+    MemoryTableTest(),
+    FixtureTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,105 @@
+import io
+import os
+import json
+import sys
+import stat
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+
+def profile(diagnose):
+    dg.profiler.enabled = True
+    try:
+        diagnose()
+    finally:
+        dg.profiler.enabled = False
+    return dg.profiler.profiles[diagnose]
+
+
+class ProfileTest(object):
+    '''subprocesses, their output and their resource usage are added to the diagnostic'''
+    key = 'profile'
+
+    def __call__(self):
+        diagnose = dg.Diagnose('echo {device}; echo err >&2', devices=['profile', 'p2'])
+        p = profile(diagnose)
+        assert p.subprocesses == 2
+        assert (p.stdout_bytes, p.stderr_bytes) == (len('profile\np2\n'), len('err\n' * 2))
+        assert p.wall >= p.parse > 0
+
+        long = dg.DiagnoseLong('echo profile long', loop_sleep=0.01)
+        p = profile(long)
+        assert (p.subprocesses, p.stdout_bytes) == (1, len('profile long\n'))
+
+        metrics = dg.profiler.prometheus(dg.OrderedDict((('short', diagnose), ('long', long))))
+        assert 'diagnose_subprocesses{diagnostic="short"} 2\n' in metrics
+        assert 'diagnose_subprocesses{diagnostic="long"} 1\n' in metrics
+        assert '# TYPE diagnose_wall_seconds gauge\n' in metrics
+
+        out = io.StringIO()
+        dg.Reporter(json_lines=True, out=out).profile(dg.OrderedDict((('short', diagnose),)),
+                                                      (0.5, 0.25))
+        record = json.loads(out.getvalue())
+        assert record['makespan'] == {'predicted': 0.5, 'actual': 0.25}
+        assert [(p['name'], p['subprocesses']) for p in record['profile']] == [('short', 2)]
+
+
+class MemoryTest(object):
+    '''the peak memory is that of the command, not of the (larger) process that started it'''
+    key = 'profile_memory'
+    # holds 40 MiB for a moment, in a shell pipeline so that it is not the process started
+    cmd = ('{0} -c "import time; x = b\'x\' * (40 << 20); time.sleep(0.3)" | cat'.format(
+        sys.executable))
+
+    def __call__(self):
+        if not os.path.exists('/proc/self/status'):
+            return
+        ballast = b'x' * (150 << 20)  # the peak of this process is at least this
+        mib = lambda p: p.max_rss / float(1 << 20)
+        p = profile(dg.Diagnose(self.cmd))
+        assert 40 <= mib(p) < 100, mib(p)
+        p = profile(dg.DiagnoseLong(self.cmd, loop_sleep=0.05))
+        assert 40 <= mib(p) < 100, mib(p)
+        p = profile(dg.Diagnose('true'))
+        assert mib(p) < 100, mib(p)
+
+
+class DisabledTest(object):
+    '''nothing is recorded unless the profiler is enabled'''
+    key = 'profile_disabled'
+
+    def __call__(self):
+        diagnose = dg.Diagnose('echo not profiled')
+        diagnose()
+        assert diagnose not in dg.profiler.profiles
+
+
+class TextfileTest(object):
+    '''the textfile can be read by node_exporter, running as another user'''
+    key = 'profile_textfile'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = pjoin(tmp, 'diagnose.prom')
+            dg.write_atomic(path, dg.profiler.prometheus({}).encode())
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+            dg.write_atomic(path, b'', mode=0o600)
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        finally:
+            shutil.rmtree(tmp)
+
+
+tests = [
+    ProfileTest(),
+    MemoryTest(),
+    DisabledTest(),
+    TextfileTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,83 @@
+import os
+import sys
+import shutil
+import tempfile
+import diagnose as dg
+
+from .utils import pjoin, run_tests
+
+PLUGIN = '''
+diagnose.register('site_check', diagnose.Spec(diagnose.Diagnose, ['echo', 'site'],
+                                              fail_pats=['site']))
+'''
+PLANTED = "diagnose.register('{0}', diagnose.Spec(diagnose.Diagnose, ['true']))\n"
+
+
+class LazyTest(object):
+    '''only the diagnostics that are selected are built, and built once'''
+    key = 'lazy'
+
+    def __call__(self):
+        code = ('import sys, diagnose; list(diagnose.run(["readonly"]));'
+                ' print(diagnose.system_diagnostics.built(),'
+                ' diagnose.long_system_diagnostics.built(), "asyncio" in sys.modules)')
+        output = dg.call_cmd([sys.executable, '-c', code])[0]
+        assert output.strip() == b"['readonly'] [] False"
+
+        built = []
+        registry = dg.Registry((
+            ('a', dg.Spec(lambda *args, **kwargs: built.append((args, kwargs)) or len(built),
+                          [dg.Spec(int, '3')], key=dg.Spec(str, 4))),
+            ('b', 'already built'),
+        ))
+        assert list(registry) == ['a', 'b'] and registry.built() == ['b']
+        assert registry['a'] == registry['a'] == 1
+        assert built == [(([3],), {'key': '4'})]
+        assert dg.get_keys(registry, 'b') == dg.OrderedDict([('b', 'already built')])
+
+        # checkers can be Specs, even when a long test is made without one
+        long = dg.DiagnoseLong('true', checkers=[dg.Spec(dg.Diagnose, 'true')])
+        assert isinstance(long.checkers[0], dg.Diagnose)
+        checkers = dg.long_system_diagnostics['cpu_burn'].checkers
+        assert checkers[0] is dg.system_diagnostics['sensors']
+
+
+class PluginTest(object):
+    '''plugins register their own diagnostics, ones that others could have written are not run'''
+    key = 'plugin'
+
+    def __call__(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(pjoin(tmp, 'site.py'), 'w') as f:
+                f.write(PLUGIN)
+            with open(pjoin(tmp, 'broken.py'), 'w') as f:
+                f.write('raise ValueError("broken plugin")\n')
+            with open(pjoin(tmp, 'planted.py'), 'w') as f:
+                f.write(PLANTED.format('planted'))
+            os.chmod(pjoin(tmp, 'planted.py'), 0o666)
+            shared = pjoin(tmp, 'shared')
+            os.mkdir(shared)
+            with open(pjoin(shared, 'planted.py'), 'w') as f:
+                f.write(PLANTED.format('planted_shared'))
+            os.chmod(shared, 0o777)
+            dg.load_plugins(os.pathsep.join([tmp, pjoin(tmp, 'missing'), shared]))
+            assert list(dg.system_diagnostics)[-1] == 'site_check'
+            assert 'planted' not in dg.system_diagnostics
+            assert 'planted_shared' not in dg.system_diagnostics
+            result = list(dg.run(['site_check']))
+            assert [(r.status, r.cmd) for r in result] == [('FAIL', 'echo site')]
+        finally:
+            shutil.rmtree(tmp)
+            for name in ('site_check', 'planted', 'planted_shared'):
+                dg.system_diagnostics._specs.pop(name, None)
+
+
+tests = [
+    LazyTest(),
+    PluginTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,51 @@
+import io
+import json
+import diagnose as dg
+
+from .utils import run_tests
+
+
+class StreamTest(object):
+    '''results are written as they finish, then summarized in the order given by one line'''
+    def __init__(self, engine):
+        self.engine = engine
+        self.key = 'stream_' + engine
+
+    def __call__(self):
+        if self.engine == 'asyncio' and dg.import_asyncio() is None:
+            return
+        dg.cmd_cache.clear()  # both engines share the output of commands
+        out = io.StringIO()
+        reporter = dg.Reporter(json_lines=True, out=out)
+        diagnostics = dg.OrderedDict((('slow', dg.Diagnose('sleep 0.3; echo bad',
+                                                           fail_pats=['bad'])),
+                                      ('fast', dg.Diagnose('true'))))
+        if self.engine == 'asyncio':
+            results = dg.AsyncEngine(on_result=reporter).run(diagnostics)
+        else:
+            tasks = dg.start_parallel_diagnostics(diagnostics, on_result=reporter)
+            results = [t.join() for t in tasks]
+        reporter.summary(diagnostics, results)
+        reporter.summary(dg.OrderedDict(), [])  # i.e. no sequential long tests
+        reporter.summary(dg.OrderedDict((('long', dg.Diagnose('true')),)), [None])
+        reporter.finish()
+
+        records = [json.loads(l) for l in out.getvalue().splitlines()]
+        assert [(r['name'], r['status']) for r in records[:2]] == [('fast', 'PASS'),
+                                                                   ('slow', 'FAIL')]
+        assert records[1]['duration'] >= 0.3 > records[0]['duration']
+        assert records[1]['failures'][0]['failures'] == ['bad']
+        assert len(records) == 3
+        assert records[2] == {'summary': {'PASS': 2, 'FAIL': 1}, 'results': [
+            {'name': 'slow', 'status': 'FAIL'}, {'name': 'fast', 'status': 'PASS'},
+            {'name': 'long', 'status': 'PASS'}]}
+
+
+tests = [
+    StreamTest('thread'),
+    StreamTest('asyncio'),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,80 @@
+import time
+import threading
+import diagnose as dg
+
+from .utils import run_tests
+
+
+class SchedulerTest(object):
+    '''map returns results in order while never running more than `workers` at once'''
+    key = 'scheduler'
+
+    def __call__(self):
+        lock = threading.Lock()
+        running = [0, 0]  # current, peak
+
+        def work(n):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01 * (n % 3))
+            with lock:
+                running[0] -= 1
+            return n * 2
+
+        assert dg.Scheduler(3).map(work, range(20)) == [n * 2 for n in range(20)]
+        assert running[1] <= 3
+
+
+class DeviceFanoutTest(object):
+    '''device commands are run in parallel and returned in device order'''
+    key = 'device_fanout'
+
+    def __init__(self, parallel):
+        self.parallel = parallel
+
+    def __call__(self):
+        devices = ['/dev/sd' + c for c in 'abcdefgh']
+        d = dg.Diagnose('smartctl -a {device}', devices=devices, parallel=self.parallel, workers=4)
+        threads = set()
+
+        def call(cmd):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            return cmd, cmd.encode()
+        d._call_subprocess = call
+        results = d._call_subprocesses()
+        assert [c for (c, _) in results] == ['smartctl -a ' + dev for dev in devices]
+        assert (len(threads) > 1) == self.parallel
+
+
+class CallbackTest(object):
+    '''join returns once the done callbacks have run, ones added later run at once and one
+    that raises does not stop the worker'''
+    key = 'task_callbacks'
+
+    def __call__(self):
+        called = []
+        task = dg.Scheduler().submit(time.sleep, 0.05)
+        task.add_done_callback(lambda t: time.sleep(0.2) or called.append('slow'))
+        task.join()
+        assert task.done and called == ['slow']
+        task.add_done_callback(lambda t: called.append('late'))
+        assert called == ['slow', 'late']
+
+        scheduler = dg.Scheduler(1)
+        first = scheduler.submit(time.sleep, 0.05)
+        first.add_done_callback(lambda t: 1 / 0)
+        assert scheduler.submit(lambda: 'second').join(5) == 'second'
+
+
+tests = [
+    SchedulerTest(),
+    CallbackTest(),
+    DeviceFanoutTest(True),
+    DeviceFanoutTest(False),
+]
+
+
+def test_():
+    run_tests(tests)
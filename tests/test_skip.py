@@ -1,4 +1,7 @@
+import os
+import time
 from contextlib import contextmanager
+import diagnose as dg
 from diagnose import Skip
 
 from .utils import run_tests
@@ -28,6 +31,52 @@ class SkipTest(object):
             assert s() == self.willskip
 
 
+class WhichTest(object):
+    '''`which` probes are answered from the PATH index without calling a command'''
+    key = 'which'
+
+    def __call__(self):
+        original = dg.call_cmd
+
+        def call_cmd(*args, **kwargs):
+            raise AssertionError("called a command")
+        try:
+            dg.call_cmd = call_cmd
+            assert not Skip('which sh')()
+            assert Skip('which does-not-exist-anywhere')()
+        finally:
+            dg.call_cmd = original
+
+
+class SkipOnceTest(object):
+    '''a diagnostic's skip is only checked once'''
+    key = 'skip_once'
+
+    def __call__(self):
+        calls = []
+        d = dg.Diagnose('true', skip=lambda: calls.append(1) or True)
+        assert d.skip and d.skip
+        assert len(calls) == 1
+
+
+class HungProbeTest(object):
+    '''a skip probe or device listing that hangs times out like any other command'''
+    key = 'hung_probe'
+
+    def __call__(self):
+        timeout, isdir = dg.Diagnose.default_timeout, os.path.isdir
+        try:
+            dg.Diagnose.default_timeout = 0.2
+            start = time.time()
+            assert Skip('sleep 5', process=lambda text: False)()
+            os.path.isdir = lambda path: path != '/sys/block' and isdir(path)  # no /sys
+            d = dg.Diagnose('echo {device}', devices=dg.Devices(fallback='sleep 5'))
+            assert dg.get_status(d()) == 'TIMEOUT'
+            assert time.time() - start < 2
+        finally:
+            dg.Diagnose.default_timeout, os.path.isdir = timeout, isdir
+
+
 journalctl_stderr = (
     b'/usr/bin/which: no journalctl in (/usr/lib64/qt-3.3/bin:/usr/local/sbin:/usr/local/bin'
     b':/sbin:/bin:/usr/sbin:/usr/bin:/root/bin)')
@@ -36,6 +85,9 @@ tests = [
     SkipTest(False, 'which systemctl', (b'/usr/bin/systemctl', None, 0)),
     SkipTest(True, 'which systemctl', (b'systemctl not found', None, 0)),
     SkipTest(True, 'which journalctl', (b'', journalctl_stderr, 1)),
+    WhichTest(),
+    SkipOnceTest(),
+    HungProbeTest(),
 ]
 
 
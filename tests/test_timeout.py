@@ -0,0 +1,47 @@
+import time
+import diagnose as dg
+
+from .utils import run_tests
+
+
+class TimeoutTest(object):
+    '''a hung command is killed (with its children) and reported as TIMEOUT'''
+    key = 'timeout'
+
+    def __call__(self):
+        start = time.time()
+        d = dg.Diagnose('sleep 5 | cat', timeout=0.2)
+        failed = d()
+        assert time.time() - start < 2
+        assert dg.get_status(failed) == 'TIMEOUT'
+        assert repr(failed[0]).startswith('TIMEOUT [sleep 5 | cat]')
+
+
+class DeadlineTest(object):
+    '''nothing is started after the deadline has passed'''
+    key = 'deadline'
+
+    def __call__(self):
+        try:
+            dg.deadline.start(0)
+            assert dg.deadline.expired
+            try:
+                dg.call_cmd('echo never')
+            except dg.CommandTimeout:
+                pass
+            else:
+                assert False, "expected CommandTimeout"
+            assert dg.get_status(dg.Diagnose('echo never')()) == 'TIMEOUT'
+        finally:
+            dg.deadline.start(None)
+        assert dg.deadline.timeout(3) == 3
+
+
+tests = [
+    TimeoutTest(),
+    DeadlineTest(),
+]
+
+
+def test_():
+    run_tests(tests)
@@ -0,0 +1,113 @@
+import os
+import sys
+import diagnose as dg
+
+from .utils import run_tests
+
+
+class TimerWheelTest(object):
+    '''items come due after their delay, including delays longer than the wheel'''
+    key = 'timer_wheel'
+
+    def __call__(self):
+        wheel = dg.TimerWheel(tick=1, size=4)
+        for delay in (0, 1, 3, 6, 9):
+            wheel.schedule(delay, delay)
+        due = dict((wheel.now, wheel.advance()) for _ in range(10))
+        assert due[0] == [0, 1] and due[2] == [3] and due[5] == [6] and due[8] == [9]
+        assert sum(due.values(), []) == [0, 1, 3, 6, 9]
+
+
+class Flipping(dg.Diagnose):
+    '''fails on the given runs'''
+    def __init__(self, fail_on, interval):
+        super(Flipping, self).__init__('flipping', interval=interval)
+        self.fail_on = fail_on
+        self.runs = 0
+
+    def __call__(self):
+        self.runs += 1
+        return [dg.Failure('flipping', ['bad'])] if self.runs in self.fail_on else []
+
+
+class WatchTest(object):
+    '''checks run at their own interval and only status changes are emitted'''
+    key = 'watch'
+
+    def __call__(self):
+        flipping, steady = Flipping({3, 4}, interval=0.01), Flipping(set(), interval=0.05)
+        emitted = []
+        dg.watch(dg.OrderedDict((('flipping', flipping), ('steady', steady))),
+                 tick=0.01, ticks=30, emit=emitted.append)
+        assert flipping.runs > 2 * steady.runs
+        emitted = [e.split()[1:3] for e in emitted]
+        assert sorted(emitted[:2]) == [['PASS', 'flipping'], ['PASS', 'steady']]
+        assert emitted[2:] == [['FAIL', 'flipping:'], ['PASS', 'flipping']]
+
+
+class RescanTest(object):
+    '''disks swapped in and programs installed while watching are found by the next rescan,
+    without looking for them every time the diagnostics run'''
+    key = 'watch_rescan'
+
+    def __call__(self):
+        disks = [dg.Device('sda', 'sata')]
+        scans, probes, runs, emitted = [], [], [], []
+        original = dg.scan_block_devices
+
+        def scan():
+            scans.append(1)
+            return list(disks)
+
+        def skip():  # installed once it has been looked for
+            probes.append(1)
+            return len(probes) == 1
+
+        def emit(line):
+            emitted.append(line.split()[1:3])
+            if len(emitted) == 2:
+                disks.append(dg.Device('sdb', 'sata'))
+        try:
+            dg.scan_block_devices = scan
+            drives = dg.Diagnose('echo {device}', devices=dg.Devices(), fail_pats=['sdb'],
+                                 interval=0.01)
+            tool = dg.Diagnose('true', skip=skip, process=lambda output: runs.append(1) or [],
+                               interval=0.01)
+            dg.watch(dg.OrderedDict((('drives', drives), ('tool', tool))), tick=0.01,
+                     ticks=40, emit=emit, rescan_interval=0.1)
+        finally:
+            dg.scan_block_devices = original
+            dg.rescan()
+        assert sorted(emitted[:2]) == [['PASS', 'drives'], ['SKIP', 'tool']]
+        assert sorted(emitted[2:]) == [['FAIL', 'drives:'], ['PASS', 'tool']]
+        assert len(scans) == len(probes) < len(runs) / 2, (len(scans), len(probes), len(runs))
+
+
+class FlushTest(object):
+    '''what watch prints is written at once, also to a pipe or a file'''
+    key = 'watch_flush'
+
+    def __call__(self):
+        read, write = os.pipe()
+        os.set_blocking(read, False)  # nothing written fails the test instead of hanging it
+        stdout = sys.stdout
+        try:
+            sys.stdout = os.fdopen(write, 'w')  # block buffered, like a pipe to a log
+            dg.watch(dg.OrderedDict((('tool', dg.Diagnose('true')),)), tick=0.01, ticks=2)
+            assert b'PASS tool' in os.read(read, 1024)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            os.close(read)
+
+
+tests = [
+    TimerWheelTest(),
+    WatchTest(),
+    RescanTest(),
+    FlushTest(),
+]
+
+
+def test_():
+    run_tests(tests)